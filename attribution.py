@@ -0,0 +1,125 @@
+import math
+
+import cv2
+import numpy as np
+
+# Поле общего результата damage_parts: повреждения по деталям (не параллельный массив колонок)
+ATTRIBUTION_KEY = 'attribution'
+# Версия формата привязки: входит в ключ кэша общего результата
+ATTRIBUTION_VERSION = 1
+
+# Число единичных битов в каждом значении байта
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+def box_overlaps(boxes: np.ndarray, others: np.ndarray) -> np.ndarray:
+    """Матрица пересечения рамок: какие пары вообще могут пересекаться масками"""
+    return (
+        (boxes[:, None, 0] < others[None, :, 2]) & (others[None, :, 0] < boxes[:, None, 2]) &
+        (boxes[:, None, 1] < others[None, :, 3]) & (others[None, :, 1] < boxes[:, None, 3])
+    )
+
+
+def rasterize(columns: dict, indices: np.ndarray, scale: float, grid_size: tuple) -> np.ndarray:
+    """Маски выбранных детекций на общей сетке, упакованные по 8 клеток в байт; без полигона - по рамке"""
+    grid_width, grid_height = grid_size
+    masks = np.zeros((len(indices), grid_height, grid_width), dtype=np.uint8)
+    for plane, i in zip(masks, indices):
+        polygon = columns['mask_polygon'][i]
+        if polygon is not None and len(polygon) >= 6:
+            points = np.round(np.asarray(polygon, dtype=np.float64).reshape(-1, 2) * scale).astype(np.int32)
+            cv2.fillPoly(plane, [points], 1)
+        else:
+            x0, y0, x1, y1 = np.round(np.asarray(columns['bbox'][i], dtype=np.float64) * scale).astype(np.int32)
+            plane[max(y0, 0):max(y1, y0 + 1), max(x0, 0):max(x1, x0 + 1)] = 1
+    return np.packbits(masks.reshape(len(indices), -1), axis=1)
+
+
+def popcount(bits: np.ndarray) -> np.ndarray:
+    """Число закрашенных клеток в каждой строке упакованных масок"""
+    return POPCOUNT[bits].sum(axis=1, dtype=np.int64)
+
+
+def mask_areas(columns: dict) -> np.ndarray:
+    """Точные площади масок по полигонам (без полигона - площадь рамки)"""
+    areas = []
+    for box, polygon in zip(columns['bbox'], columns['mask_polygon']):
+        if polygon is not None and len(polygon) >= 6:
+            areas.append(cv2.contourArea(np.asarray(polygon, dtype=np.float32).reshape(-1, 2)))
+        else:
+            areas.append(max(0.0, box[2] - box[0]) * max(0.0, box[3] - box[1]))
+    return np.asarray(areas, dtype=np.float64)
+
+
+def attribute_damages(damage: dict, parts: dict, max_side: int = 256) -> list:
+    """Повреждения по деталям одного изображения.
+
+    Маски растеризуются на сетке со стороной не больше max_side и упаковываются в биты.
+    Рамки отсекают пары, которые не могут пересекаться; пересечения всех оставшихся пар
+    считаются одной операцией AND над упакованными масками. Доли считаются по клеткам
+    сетки (растеризация одинаково расширяет числитель и знаменатель), площади - доля
+    от точной площади детали в пикселях изображения. Индексы указывают на детекции
+    общего результата: сначала повреждения, затем детали.
+    """
+    part_count, damage_count = parts['count'], damage['count']
+    if not part_count:
+        return []
+    width, height = parts['image_size']
+    scale = min(1.0, max_side / max(width, height, 1))
+    grid_size = (max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale)))
+
+    part_bits = rasterize(parts, np.arange(part_count), scale, grid_size)
+    part_cells = popcount(part_bits)
+    part_areas = mask_areas(parts)
+    damaged_cells = np.zeros(part_count, dtype=np.int64)
+    pair_parts = pair_damages = inter = np.zeros(0, dtype=np.int64)
+    damage_cells = np.zeros(damage_count, dtype=np.int64)
+    if damage_count:
+        candidates = box_overlaps(np.asarray(parts['bbox'], dtype=np.float64).reshape(-1, 4),
+                                  np.asarray(damage['bbox'], dtype=np.float64).reshape(-1, 4))
+        # Пары упорядочены по детали: для объединения повреждений каждой детали
+        pair_parts, pair_damages = np.nonzero(candidates)
+    if len(pair_parts):
+        damage_columns = np.flatnonzero(candidates.any(axis=0))
+        damage_bits = np.zeros((damage_count, part_bits.shape[1]), dtype=np.uint8)
+        damage_bits[damage_columns] = rasterize(damage, damage_columns, scale, grid_size)
+        damage_cells[damage_columns] = popcount(damage_bits[damage_columns])
+        inter = popcount(part_bits[pair_parts] & damage_bits[pair_damages])
+        # Поврежденная доля детали - по объединению масок, а не по сумме (повреждения перекрываются)
+        starts = np.flatnonzero(np.r_[True, pair_parts[1:] != pair_parts[:-1]])
+        union = np.bitwise_or.reduceat(damage_bits[pair_damages], starts, axis=0)
+        damaged_cells[pair_parts[starts]] = popcount(union & part_bits[pair_parts[starts]])
+
+    damages_by_part = [[] for _ in range(part_count)]
+    for j, i, cells in zip(pair_parts.tolist(), pair_damages.tolist(), inter.tolist()):
+        if not cells:
+            continue
+        part_ratio = cells / part_cells[j] if part_cells[j] else 0.0
+        damages_by_part[j].append({
+            "damage": i,
+            "class_name": damage['class_name'][i],
+            "confidence": damage['confidence'][i],
+            "area": round(float(part_ratio * part_areas[j]), 1),
+            "part_ratio": round(float(part_ratio), 4),
+            "damage_ratio": round(cells / float(damage_cells[i]), 4) if damage_cells[i] else 0.0,
+        })
+
+    attribution = []
+    for j, damages in enumerate(damages_by_part):
+        damages.sort(key=lambda item: item['area'], reverse=True)
+        attribution.append({
+            "part": damage_count + j,
+            "class_name": parts['class_name'][j],
+            "confidence": parts['confidence'][j],
+            "area": round(float(part_areas[j]), 1),
+            "damaged_ratio": round(float(damaged_cells[j] / part_cells[j]), 4) if part_cells[j] else 0.0,
+            "damages": damages,
+        })
+    return attribution
+
+
+def split_attribution(columns: dict):
+    """Колонки без привязки (для формата ответа) и сама привязка, если она есть"""
+    if ATTRIBUTION_KEY not in columns:
+        return columns, None
+    return {key: value for key, value in columns.items() if key != ATTRIBUTION_KEY}, columns[ATTRIBUTION_KEY]
@@ -0,0 +1,255 @@
+import argparse
+import json
+import logging
+import shutil
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger('app')
+
+# Поддерживаемые бэкенды инференса на CPU
+SUPPORTED_BACKENDS = ('torch', 'onnx', 'openvino')
+
+# Максимальное количество изображений для калибровки INT8
+CALIBRATION_LIMIT = 64
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+
+
+def letterbox(image: np.ndarray, imgsz: int) -> np.ndarray:
+    """Вписывает BGR-изображение в квадрат imgsz x imgsz с серыми полями (как в YOLO)"""
+    height, width = image.shape[:2]
+    scale = min(imgsz / height, imgsz / width)
+    new_width, new_height = int(round(width * scale)), int(round(height * scale))
+    resized = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    canvas = np.full((imgsz, imgsz, 3), 114, dtype=np.uint8)
+    top = (imgsz - new_height) // 2
+    left = (imgsz - new_width) // 2
+    canvas[top:top + new_height, left:left + new_width] = resized
+    return canvas
+
+
+def load_calibration_images(calibration_dir: Path, imgsz: int, limit: int = CALIBRATION_LIMIT) -> list:
+    """Готовит тензоры (1, 3, imgsz, imgsz) float32 из папки с калибровочными изображениями"""
+    calibration_dir = Path(calibration_dir)
+    if not calibration_dir.is_dir():
+        raise FileNotFoundError(f"Папка калибровки {calibration_dir} не найдена")
+
+    samples = []
+    for image_path in sorted(calibration_dir.iterdir()):
+        if image_path.suffix.lower() not in IMAGE_SUFFIXES:
+            continue
+        image = cv2.imread(str(image_path))
+        if image is None:
+            continue
+        rgb = cv2.cvtColor(letterbox(image, imgsz), cv2.COLOR_BGR2RGB)
+        samples.append(np.ascontiguousarray(rgb.transpose(2, 0, 1)[None], dtype=np.float32) / 255.0)
+        if len(samples) >= limit:
+            break
+
+    if not samples:
+        raise ValueError(f"В папке калибровки {calibration_dir} нет изображений")
+    logger.info(f"🎯 Загружено {len(samples)} калибровочных изображений из {calibration_dir}")
+    return samples
+
+
+def _quantize_onnx(fp32_path: Path, int8_path: Path, calibration: list):
+    """Статическая INT8-квантизация ONNX модели через ONNX Runtime"""
+    import onnx
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self._samples = iter(calibration)
+
+        def get_next(self):
+            sample = next(self._samples, None)
+            return None if sample is None else {'images': sample}
+
+    quantize_static(
+        str(fp32_path), str(int8_path), Reader(),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+    )
+
+    # Квантизация теряет метаданные ultralytics (stride, task, names), переносим их
+    fp32_model = onnx.load(str(fp32_path))
+    int8_model = onnx.load(str(int8_path))
+    existing = {prop.key for prop in int8_model.metadata_props}
+    for prop in fp32_model.metadata_props:
+        if prop.key not in existing:
+            int8_model.metadata_props.add(key=prop.key, value=prop.value)
+    onnx.save(int8_model, str(int8_path))
+
+
+def _quantize_openvino(fp32_dir: Path, int8_dir: Path, calibration: list):
+    """Статическая INT8-квантизация OpenVINO IR через NNCF"""
+    import nncf
+    import openvino.runtime as ov
+
+    core = ov.Core()
+    xml_path = next(fp32_dir.glob('*.xml'))
+    ov_model = core.read_model(str(xml_path))
+    quantized = nncf.quantize(
+        ov_model,
+        nncf.Dataset(calibration),
+        preset=nncf.QuantizationPreset.MIXED,
+        ignored_scope=nncf.IgnoredScope(types=['Multiply', 'Subtract', 'Sigmoid']),
+    )
+    int8_dir.mkdir(parents=True, exist_ok=True)
+    ov.serialize(quantized, str(int8_dir / xml_path.name))
+    shutil.copy2(fp32_dir / 'metadata.yaml', int8_dir / 'metadata.yaml')
+
+
+def _remove(path: Path):
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+
+def _artifact_path(pt_file: Path, backend: str, export_dir: Path, int8: bool) -> Path:
+    suffix = '_int8' if int8 else ''
+    if backend == 'onnx':
+        return export_dir / backend / f"{pt_file.stem}{suffix}.onnx"
+    return export_dir / backend / f"{pt_file.stem}{suffix}_openvino_model"
+
+
+def export_model(pt_file: Path, backend: str, export_dir: Path, imgsz: int = 640,
+                 int8: bool = False, calibration_dir: Path = None):
+    """Экспортирует .pt модель в ONNX или OpenVINO IR один раз и кэширует артефакт.
+
+    Возвращает путь к артефакту и задачу модели (segment/detect). Повторный экспорт
+    выполняется только если .pt файл изменился.
+    """
+    if backend not in ('onnx', 'openvino'):
+        raise ValueError(f"Экспорт не поддерживается для бэкенда {backend}")
+
+    artifact = _artifact_path(pt_file, backend, export_dir, int8)
+    manifest_path = artifact.with_name(artifact.name + '.json')
+    source_mtime = pt_file.stat().st_mtime
+
+    if artifact.exists() and manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text(encoding='utf-8'))
+        if manifest.get('source_mtime') == source_mtime and manifest.get('imgsz') == imgsz:
+            return artifact, manifest['task']
+
+    logger.info(f"📤 Экспорт {pt_file.name} в {backend}{' INT8' if int8 else ''}...")
+    start_time = time.time()
+    artifact.parent.mkdir(parents=True, exist_ok=True)
+
+    from ultralytics import YOLO
+
+    model = YOLO(str(pt_file))
+    task = model.task
+    # ultralytics кладет результат рядом с .pt, затем переносим его в кэш экспорта
+    exported = Path(model.export(format=backend, imgsz=imgsz, dynamic=True, verbose=False))
+    fp32_artifact = _artifact_path(pt_file, backend, export_dir, False)
+    _remove(fp32_artifact)
+    shutil.move(str(exported), str(fp32_artifact))
+    if backend == 'openvino':
+        # Промежуточный ONNX, созданный при экспорте в OpenVINO, не нужен
+        pt_file.with_suffix('.onnx').unlink(missing_ok=True)
+
+    if int8:
+        if calibration_dir is None:
+            raise ValueError("Для INT8 квантизации нужна папка калибровки (CALIBRATION_DIR)")
+        calibration = load_calibration_images(calibration_dir, imgsz)
+        _remove(artifact)
+        if backend == 'onnx':
+            _quantize_onnx(fp32_artifact, artifact, calibration)
+        else:
+            _quantize_openvino(fp32_artifact, artifact, calibration)
+
+    manifest_path.write_text(json.dumps({
+        'source': pt_file.name,
+        'source_mtime': source_mtime,
+        'backend': backend,
+        'int8': int8,
+        'imgsz': imgsz,
+        'task': task,
+    }), encoding='utf-8')
+    logger.info(f"✅ {pt_file.name} экспортирована в {artifact} за {time.time() - start_time:.2f}с")
+    return artifact, task
+
+
+def _load_torch(pt_file: Path, **_):
+    from ultralytics import YOLO
+
+    model = YOLO(str(pt_file))
+    model.to('cpu')
+    # Оптимизация модели для CPU
+    model.fuse()
+    # eval() вызываем у nn.Module: у обертки YOLO метод train() перегружен и запускает обучение
+    model.model.eval()
+    return model
+
+
+def _load_exported(pt_file: Path, backend: str, export_dir: Path, imgsz: int = 640,
+                   int8: bool = False, calibration_dir: Path = None):
+    from ultralytics import YOLO
+
+    artifact, task = export_model(pt_file, backend, export_dir, imgsz, int8, calibration_dir)
+    # Задачу передаем явно: по имени файла ultralytics определил бы ее как detect
+    return YOLO(str(artifact), task=task)
+
+
+BACKEND_LOADERS = {
+    'torch': _load_torch,
+    'onnx': lambda pt_file, **kwargs: _load_exported(pt_file, 'onnx', **kwargs),
+    'openvino': lambda pt_file, **kwargs: _load_exported(pt_file, 'openvino', **kwargs),
+}
+
+
+def load_backend_model(pt_file: Path, backend: str = 'torch', **kwargs):
+    """Загружает модель через выбранный бэкенд. Вызов модели остается как у YOLO"""
+    if backend not in BACKEND_LOADERS:
+        raise ValueError(f"Неизвестный бэкенд {backend}, доступны: {', '.join(SUPPORTED_BACKENDS)}")
+    return BACKEND_LOADERS[backend](pt_file, **kwargs)
+
+
+def benchmark_backends(pt_file: Path, backends: list, images: list, imgsz: int, export_dir: Path,
+                       runs: int = 10, int8: bool = False, calibration_dir: Path = None) -> dict:
+    """Сравнивает среднее время инференса бэкендов на одном и том же батче"""
+    report = {}
+    for backend in backends:
+        model = load_backend_model(pt_file, backend, export_dir=export_dir, imgsz=imgsz,
+                                   int8=int8 and backend != 'torch', calibration_dir=calibration_dir)
+        model(images, imgsz=imgsz, verbose=False)  # прогрев
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            model(images, imgsz=imgsz, verbose=False)
+            timings.append(time.perf_counter() - start)
+        report[backend] = {
+            'mean_seconds': float(np.mean(timings)),
+            'p50_seconds': float(np.percentile(timings, 50)),
+            'images_per_second': len(images) / float(np.mean(timings)),
+        }
+    if 'torch' in report:
+        for backend, stats in report.items():
+            stats['speedup_vs_torch'] = report['torch']['mean_seconds'] / stats['mean_seconds']
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Экспорт моделей и сравнение бэкендов инференса")
+    parser.add_argument('weights', type=Path, help="Путь к .pt модели")
+    parser.add_argument('--images', type=Path, required=True, help="Папка с изображениями для замера")
+    parser.add_argument('--backends', nargs='+', default=list(SUPPORTED_BACKENDS), choices=SUPPORTED_BACKENDS)
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--int8', action='store_true')
+    parser.add_argument('--calibration', type=Path, default=None)
+    parser.add_argument('--export-dir', type=Path, default=Path(__file__).resolve().parent / "models_exported")
+    args = parser.parse_args()
+
+    batch = [cv2.imread(str(p)) for p in sorted(args.images.iterdir()) if p.suffix.lower() in IMAGE_SUFFIXES]
+    result = benchmark_backends(args.weights, args.backends, batch, args.imgsz, args.export_dir,
+                                args.runs, args.int8, args.calibration or args.images)
+    print(json.dumps(result, indent=2, ensure_ascii=False))
@@ -0,0 +1,151 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger('app')
+
+# Как часто во время ожидания батча проверяется, остались ли задачи, которые могут его дополнить
+IDLE_POLL_SECONDS = 0.001
+
+
+class _PendingImage:
+    __slots__ = ('image', 'key', 'num_threads', 'future', 'enqueued_at')
+
+    def __init__(self, image, key, num_threads):
+        self.image = image
+        self.key = key
+        self.num_threads = num_threads
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class BatchScheduler:
+    """Динамический микробатчинг для одной модели.
+
+    Изображения из параллельных запросов собираются в течение max_wait_ms
+    (но не больше max_batch_size) и прогоняются одним forward-проходом.
+    В один батч попадают только изображения с одинаковыми imgsz/conf/iou.
+    busy() - сколько задач еще может отправить изображения: если ни одной,
+    батч уходит сразу, не дожидаясь max_wait_ms. Изображения без заданного числа
+    потоков считаются с default_threads: батч получает явное число потоков,
+    а не то, что осталось в потоке планировщика от прошлого батча.
+    """
+
+    def __init__(self, model_name: str, run_batch, max_batch_size: int = 8, max_wait_ms: float = 5.0, busy=None,
+                 default_threads: int = None):
+        self.model_name = model_name
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self._run_batch = run_batch
+        self._busy = busy
+        self.default_threads = default_threads
+        self._queue = queue.Queue()
+        # Изображения с другими параметрами, отложенные до следующего батча
+        self._deferred = []
+        self._stopped = False
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._images = 0
+        self._total_wait = 0.0
+        self._max_batch_seen = 0
+        self._thread = threading.Thread(target=self._loop, name=f'batch-{model_name}', daemon=True)
+        self._thread.start()
+
+    def submit(self, images: list, imgsz: int, conf: float, iou: float, num_threads: int = None) -> list:
+        """Ставит изображения в очередь и блокирующе ждет результаты в исходном порядке"""
+        key = (imgsz, conf, iou)
+        pending = [_PendingImage(image, key, num_threads) for image in images]
+        for item in pending:
+            self._queue.put(item)
+        return [item.future.result() for item in pending]
+
+    def _next_item(self, timeout=None):
+        if self._deferred:
+            return self._deferred.pop(0)
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _collect_batch(self) -> list:
+        first = self._next_item()
+        if first is None:
+            return []
+        batch = [first]
+        deferred = []
+        deadline = time.perf_counter() + self.max_wait
+
+        # Сначала забираем подходящие отложенные изображения
+        for item in self._deferred:
+            if item.key == first.key and len(batch) < self.max_batch_size:
+                batch.append(item)
+            else:
+                deferred.append(item)
+        self._deferred = deferred
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            if self._busy is not None:
+                # Дополнить батч некому - ожидание только добавило бы задержку
+                if self._queue.empty() and not self._busy():
+                    break
+                remaining = min(remaining, IDLE_POLL_SECONDS)
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if item is None:
+                self._stopped = True
+                break
+            if item.key == first.key:
+                batch.append(item)
+            else:
+                self._deferred.append(item)
+        return batch
+
+    def _loop(self):
+        while not self._stopped:
+            batch = self._collect_batch()
+            if not batch:
+                continue
+            imgsz, conf, iou = batch[0].key
+            num_threads = max((item.num_threads or self.default_threads or 0) for item in batch) or None
+            started_at = time.perf_counter()
+            try:
+                results = self._run_batch(self.model_name, [item.image for item in batch], imgsz, conf, iou, num_threads)
+                for item, result in zip(batch, results):
+                    item.future.set_result(result)
+            except Exception as e:
+                logger.error(f"❌ Ошибка батча модели {self.model_name}: {str(e)}")
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+            with self._stats_lock:
+                self._batches += 1
+                self._images += len(batch)
+                self._total_wait += sum(started_at - item.enqueued_at for item in batch)
+                self._max_batch_seen = max(self._max_batch_seen, len(batch))
+            logger.debug(f"📦 {self.model_name}: батч из {len(batch)} изображений")
+
+    def stats(self) -> dict:
+        """Статистика заполнения батчей"""
+        with self._stats_lock:
+            return {
+                "batches": self._batches,
+                "images": self._images,
+                "avg_batch_size": round(self._images / self._batches, 2) if self._batches else 0.0,
+                "max_batch_size_seen": self._max_batch_seen,
+                "fill_rate": round(self._images / (self._batches * self.max_batch_size), 3) if self._batches else 0.0,
+                "avg_queue_wait_ms": round(self._total_wait / self._images * 1000, 2) if self._images else 0.0,
+                "queue_depth": self._queue.qsize() + len(self._deferred),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+            }
+
+    def stop(self):
+        self._stopped = True
+        self._queue.put(None)
@@ -0,0 +1,105 @@
+"""Офлайн-окружение для бенчмарков: крошечные YOLO-seg модели со случайными весами и синтетические фото машин.
+
+Сеть и настоящие веса не нужны: модели собираются из yaml-конфигов ultralytics.
+"""
+import io
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# Классы для случайных моделей, чтобы подписи в ответе были похожи на настоящие
+DAMAGE_CLASSES = ['scratch', 'dent', 'crack', 'broken_glass', 'broken_lamp', 'rust']
+PART_CLASSES = ['bumper', 'hood', 'door', 'fender', 'headlight', 'mirror', 'wheel', 'windshield', 'trunk', 'roof']
+
+# Цвета кузова (BGR)
+BODY_COLORS = [(40, 40, 200), (200, 200, 200), (30, 30, 30), (180, 120, 40), (60, 160, 60), (230, 230, 230)]
+
+
+def build_tiny_model(path: Path, class_names: list, scale: str = 'n', seed: int = 0):
+    """Собирает YOLOv8-seg из yaml-конфига со случайными весами и сохраняет как чекпойнт ultralytics"""
+    import torch
+    from ultralytics.nn.tasks import SegmentationModel
+
+    torch.manual_seed(seed)
+    model = SegmentationModel(f'yolov8{scale}-seg.yaml', nc=len(class_names), verbose=False)
+    model.names = dict(enumerate(class_names))
+    model.args = {'task': 'segment', 'imgsz': 640}
+    # Как в чекпойнтах после обучения (strip_optimizer): градиенты отключены
+    for parameter in model.parameters():
+        parameter.requires_grad = False
+    checkpoint = {'model': model.half(), 'train_args': {'task': 'segment', 'imgsz': 640}, 'date': None}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    torch.save(checkpoint, path)
+
+
+def build_models(models_dir: Path, model_map: dict, scale: str = 'n') -> Path:
+    """Готовит по модели на каждую запись MODEL_MAP (уже собранные не пересобираются)"""
+    models_dir = Path(models_dir) / f'yolov8{scale}-seg'
+    for seed, (model_name, filename) in enumerate(sorted(model_map.items())):
+        path = models_dir / filename
+        if path.exists():
+            continue
+        class_names = PART_CLASSES if 'parts' in model_name else DAMAGE_CLASSES
+        build_tiny_model(path, class_names, scale, seed)
+    return models_dir
+
+
+def synthetic_car_image(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """BGR изображение, похожее на фото машины: фон-градиент, кузов, окна, колеса, фары, шум"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    sky = np.array(rng.integers(120, 220, size=3), dtype=np.float32)
+    ground = np.array(rng.integers(40, 110, size=3), dtype=np.float32)
+    mix = (y / height)[..., None]
+    image = (sky * (1 - mix) + ground * mix + x[..., None] / width * 20).astype(np.uint8)
+
+    scale = min(width, height)
+    cx = int(width * rng.uniform(0.4, 0.6))
+    cy = int(height * rng.uniform(0.5, 0.65))
+    body_w = int(width * rng.uniform(0.55, 0.8)) // 2
+    body_h = int(scale * rng.uniform(0.12, 0.18))
+    color = BODY_COLORS[int(rng.integers(len(BODY_COLORS)))]
+
+    # Кузов, крыша и окна
+    cv2.rectangle(image, (cx - body_w, cy - body_h), (cx + body_w, cy + body_h), color, -1)
+    roof = np.array([
+        (cx - body_w // 2, cy - body_h), (cx - body_w // 3, cy - body_h * 2),
+        (cx + body_w // 3, cy - body_h * 2), (cx + body_w // 2, cy - body_h)
+    ], dtype=np.int32)
+    cv2.fillPoly(image, [roof], color)
+    window = np.array([
+        (cx - body_w // 2 + body_h // 4, cy - body_h - 2), (cx - body_w // 3 + body_h // 6, cy - body_h * 2 + body_h // 4),
+        (cx + body_w // 3 - body_h // 6, cy - body_h * 2 + body_h // 4), (cx + body_w // 2 - body_h // 4, cy - body_h - 2)
+    ], dtype=np.int32)
+    cv2.fillPoly(image, [window], (90, 70, 50))
+
+    # Колеса, фары и царапины
+    wheel_r = max(2, int(body_h * 0.8))
+    for wx in (cx - body_w * 2 // 3, cx + body_w * 2 // 3):
+        cv2.circle(image, (wx, cy + body_h), wheel_r, (20, 20, 20), -1)
+        cv2.circle(image, (wx, cy + body_h), wheel_r // 2, (150, 150, 150), -1)
+    lamp = max(2, body_h // 3)
+    cv2.rectangle(image, (cx + body_w - lamp * 2, cy - body_h + lamp), (cx + body_w, cy - body_h + lamp * 2), (200, 240, 255), -1)
+    for _ in range(int(rng.integers(1, 5))):
+        x1 = int(rng.integers(cx - body_w, cx + body_w))
+        y1 = int(rng.integers(cy - body_h, cy + body_h))
+        cv2.line(image, (x1, y1), (x1 + int(rng.integers(-body_w // 4, body_w // 4)), y1 + int(rng.integers(-body_h, body_h))),
+                 (230, 230, 230), max(1, scale // 400))
+
+    # Шум сенсора, чтобы JPEG по размеру был похож на снимок с телефона
+    noise = rng.normal(0, 6, size=image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def make_jpeg(image: np.ndarray, quality: int = 90) -> bytes:
+    """Кодирует BGR изображение в JPEG так же, как это делает камера телефона (через PIL)"""
+    buffer = io.BytesIO()
+    Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)).save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def parse_sizes(sizes: list) -> list:
+    """'1920x1080' -> (1920, 1080)"""
+    return [tuple(int(v) for v in size.lower().split('x')) for size in sizes]
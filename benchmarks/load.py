@@ -0,0 +1,291 @@
+"""Нагрузочный тест /process: смесь запросов с заданной конкурентностью или частотой поступления.
+
+По умолчанию поднимает локальный uvicorn с крошечными моделями со случайными весами
+(см. benchmarks.fixtures), поэтому запускается где угодно без сети. С --url бьет
+в уже запущенный сервер.
+
+Режимы:
+    закрытый цикл (--concurrency N): N клиентов шлют следующий запрос сразу после ответа;
+    открытый цикл (--rate R): запросы приходят пуассоновским потоком R в секунду
+    независимо от ответов, задержка считается от запланированного времени отправки.
+
+Смесь запросов: тип:изображения:imgsz[:conf[:iou]]=вес, например
+    python -m benchmarks.load --mix damage_parts:2:640=3 all_models:1:320=1 --concurrency 4 --duration 60
+    python -m benchmarks.load --rate 0.5 --duration 120 --output load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.fixtures import make_jpeg, parse_sizes, synthetic_car_image
+from benchmarks.pipeline import summarize
+
+DEFAULT_MIX = ['damage_parts:2:640=3', 'all_models:1:640=1', 'parts_only:4:320=1']
+# Поля /status, которые попадают в снимки (остальное - статичная конфигурация)
+STATUS_FIELDS = ('inference_executor', 'jobs', 'tmp_sessions', 'result_cache', 'micro_batching')
+
+
+def parse_mix(items: list) -> list:
+    """'damage_parts:2:640:0.25:0.45=3' -> сценарий с весом 3"""
+    scenarios = []
+    for item in items:
+        spec, _, weight = item.partition('=')
+        parts = spec.split(':')
+        if len(parts) < 3:
+            raise ValueError(f"Сценарий {item}: ожидается тип:изображения:imgsz[:conf[:iou]]=вес")
+        scenarios.append({
+            'name': spec,
+            'processing_type': parts[0],
+            'images': int(parts[1]),
+            'imgsz': int(parts[2]),
+            'conf': float(parts[3]) if len(parts) > 3 else 0.001,
+            'iou': float(parts[4]) if len(parts) > 4 else 0.45,
+            'weight': float(weight or 1),
+        })
+    return scenarios
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve(port: int, models_dir: Path):
+    """Точка входа дочернего процесса: приложение с моделями бенчмарка на localhost"""
+    import uvicorn
+    from benchmarks.pipeline import import_app
+    main = import_app(models_dir)
+    uvicorn.run(main.app, host='127.0.0.1', port=port, log_level='warning')
+
+
+def start_server(models_dir: Path, env: dict) -> tuple:
+    """Запускает сервер в отдельном процессе и ждет, пока он начнет отвечать на /status"""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.load', '--serve', str(port), '--models-dir', str(models_dir)],
+        cwd=ROOT, env={**os.environ, **env}
+    )
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Сервер завершился с кодом {process.returncode}")
+        try:
+            if httpx.get(f'{url}/status', timeout=2).status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError("Сервер не ответил за 120с")
+
+
+class LoadRun:
+    """Состояние одного прогона: результаты запросов и снимки /status"""
+
+    def __init__(self, url: str, scenarios: list, images: list, timeout: float, seed: int):
+        self.url = url
+        self.scenarios = scenarios
+        self.images = images
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.results = []
+        self.snapshots = []
+        self.measure_from = None
+        self.start = None
+
+    def pick(self) -> dict:
+        return self.random.choices(self.scenarios, weights=[s['weight'] for s in self.scenarios])[0]
+
+    async def send(self, client: httpx.AsyncClient, scenario: dict, scheduled: float = None):
+        """Один запрос /process. Задержка открытого цикла считается от запланированного времени"""
+        files = [
+            ('files', (f'car_{i}.jpg', self.images[self.random.randrange(len(self.images))], 'image/jpeg'))
+            for i in range(scenario['images'])
+        ]
+        data = {'model_name': scenario['processing_type'], 'imgsz': scenario['imgsz'],
+                'conf': scenario['conf'], 'iou': scenario['iou']}
+        started = time.perf_counter()
+        try:
+            response = await client.post(f'{self.url}/process', files=files, data=data, timeout=self.timeout)
+            status = response.status_code
+        except httpx.TimeoutException:
+            status = 'timeout'
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        finished = time.perf_counter()
+        if started >= self.measure_from:
+            self.results.append({
+                'scenario': scenario['name'],
+                'images': scenario['images'],
+                'status': status,
+                'latency': finished - (scheduled if scheduled is not None else started),
+                'service_time': finished - started,
+                'finished': finished - self.start,
+            })
+
+    async def closed_loop(self, client, concurrency: int, end: float):
+        async def worker():
+            while time.perf_counter() < end:
+                await self.send(client, self.pick())
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    async def open_loop(self, client, rate: float, end: float, max_outstanding: int):
+        """Пуассоновский поток: следующий запрос не ждет ответа на предыдущий"""
+        tasks = set()
+        scheduled = time.perf_counter()
+        while True:
+            scheduled += self.random.expovariate(rate)
+            if scheduled >= end:
+                break
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            if len(tasks) >= max_outstanding:
+                # Защита генератора: сервер не успевает, лишние запросы считаются отброшенными
+                if scheduled >= self.measure_from:
+                    self.results.append({'scenario': 'dropped', 'images': 0, 'status': 'dropped', 'latency': None,
+                                         'service_time': None, 'finished': scheduled - self.start})
+                continue
+            task = asyncio.create_task(self.send(client, self.pick(), scheduled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def poll_status(self, client, interval: float):
+        while True:
+            try:
+                response = await client.get(f'{self.url}/status', timeout=10)
+                status = response.json()
+                self.snapshots.append({'t': round(time.perf_counter() - self.start, 2),
+                                       **{field: status.get(field) for field in STATUS_FIELDS}})
+            except (httpx.HTTPError, ValueError):
+                pass
+            await asyncio.sleep(interval)
+
+    async def run(self, args):
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(limits=limits) as client:
+            self.start = time.perf_counter()
+            self.measure_from = self.start + args.warmup
+            end = self.measure_from + args.duration
+            poller = asyncio.create_task(self.poll_status(client, args.status_interval))
+            if args.rate:
+                await self.open_loop(client, args.rate, end, args.max_outstanding)
+            else:
+                await self.closed_loop(client, args.concurrency, end)
+            poller.cancel()
+
+    def report(self, duration: float) -> dict:
+        """Пропускная способность, перцентили задержки и доли ошибок (общие и по сценариям)"""
+        def describe(results: list) -> dict:
+            ok = [r for r in results if r['status'] == 200]
+            statuses = {}
+            for r in results:
+                statuses[str(r['status'])] = statuses.get(str(r['status']), 0) + 1
+            entry = {
+                'requests': len(results),
+                'ok': len(ok),
+                'error_rate': round(1 - len(ok) / len(results), 4) if results else 0.0,
+                'statuses': statuses,
+                'throughput_rps': round(len(ok) / duration, 3),
+                'throughput_images_per_s': round(sum(r['images'] for r in ok) / duration, 3),
+            }
+            if ok:
+                entry['latency'] = summarize([r['latency'] for r in ok])
+                entry['service_time'] = summarize([r['service_time'] for r in ok])
+            return entry
+
+        scenarios = {}
+        for result in self.results:
+            scenarios.setdefault(result['scenario'], []).append(result)
+        return {
+            'overall': describe(self.results),
+            'scenarios': {name: describe(results) for name, results in scenarios.items() if name != 'dropped'},
+            'status_snapshots': self.snapshots,
+        }
+
+
+def run_load(args) -> dict:
+    scenarios = parse_mix(args.mix)
+    rng = np.random.default_rng(args.seed)
+    sizes = parse_sizes(args.sizes)
+    # Пул разных изображений, чтобы запросы не совпадали по содержимому
+    images = [make_jpeg(synthetic_car_image(w, h, int(rng.integers(1 << 30)))) for w, h in sizes for _ in range(args.pool)]
+
+    server = None
+    url = args.url
+    if url is None:
+        from benchmarks.fixtures import build_models
+        from benchmarks.pipeline import discover
+        models_dir = build_models(args.models_dir, discover()['model_map'], args.scale)
+        env = {'RESULT_CACHE': '1' if args.result_cache else '0', 'LOG_LEVEL': 'WARNING'}
+        server, url = start_server(models_dir, env)
+    try:
+        load = LoadRun(url, scenarios, images, args.timeout, args.seed)
+        asyncio.run(load.run(args))
+        report = load.report(args.duration)
+    finally:
+        if server is not None:
+            # Сессии локального сервера не должны оставаться в tmp
+            try:
+                httpx.post(f'{url}/clear_tmp', timeout=30)
+            except httpx.HTTPError:
+                pass
+            server.terminate()
+            server.wait()
+
+    report['settings'] = {
+        'url': args.url or 'local',
+        'mode': f'open-loop {args.rate} rps' if args.rate else f'closed-loop x{args.concurrency}',
+        'mix': args.mix,
+        'duration': args.duration,
+        'warmup': args.warmup,
+        'sizes': args.sizes,
+        'result_cache': args.result_cache if args.url is None else None,
+    }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='адрес запущенного сервера (по умолчанию поднимается локальный)')
+    parser.add_argument('--mix', nargs='+', default=DEFAULT_MIX)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rate', type=float, help='запросов в секунду (открытый цикл вместо --concurrency)')
+    parser.add_argument('--max-outstanding', type=int, default=256, help='предел одновременных запросов открытого цикла')
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--warmup', type=float, default=10, help='секунды в начале, не попадающие в статистику')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--status-interval', type=float, default=5)
+    parser.add_argument('--sizes', nargs='+', default=['1920x1080', '4000x3000'])
+    parser.add_argument('--pool', type=int, default=8, help='разных изображений на каждое разрешение')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--result-cache', action='store_true', help='включить кэш результатов локального сервера')
+    parser.add_argument('--scale', default='n')
+    parser.add_argument('--models-dir', type=Path, default=ROOT / 'benchmarks' / '.models')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--output', type=Path)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.models_dir)
+        sys.exit(0)
+
+    report = run_load(args)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        args.output.write_text(text, encoding='utf-8')
+    print(text)
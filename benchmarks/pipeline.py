@@ -0,0 +1,341 @@
+"""Офлайн-бенчмарк полного пайплайна /process для каждого типа обработки.
+
+Модели собираются из yaml-конфигов ultralytics со случайными весами, изображения
+генерируются. Каждая конфигурация (тип обработки x размер батча x imgsz x размер тайла) запускается
+в отдельном процессе: пиковая память не смешивается, модели грузятся заново.
+Время этапов берется из итоговой записи запроса (app.requests), сквозное - на клиенте.
+
+Для каскада (cascade) отчет добавляет долю входа моделей относительно целых кадров,
+полноту повреждений относительно тех же моделей по целым кадрам и сравнение с all_models.
+Со случайными весами детектор находит области по всему кадру, и каскад почти всегда
+уходит на целый кадр: показательные числа получаются только с настоящими весами
+(--models-dir с файлами моделей, уже существующие файлы не пересобираются).
+
+Запуск:
+    python -m benchmarks.pipeline --batch-sizes 1 4 --imgsz 320 640 --runs 10 --output report.json
+    python -m benchmarks.pipeline --types damage_only --tile-sizes 0 640 1024 --imgsz 640
+    python -m benchmarks.pipeline --compare old.json new.json
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.fixtures import build_models, make_jpeg, parse_sizes, synthetic_car_image
+from benchmarks.resize import peak_rss_mb
+
+PERCENTILES = (50, 95, 99)
+# Поля времени в model_timings (остальные, например threads, не являются длительностями)
+MODEL_STAGES = ('inference', 'extraction', 'total')
+# Счетчики каскада в model_timings: суммируются по прогонам
+CASCADE_COUNTERS = ('crops', 'full_frames', 'input_pixels', 'full_frame_pixels')
+# Детекция считается найденной каскадом, если есть бокс того же класса с IoU не ниже порога
+RECALL_IOU = 0.5
+
+
+def summarize(values: list) -> dict:
+    """p50/p95/p99 и среднее в миллисекундах"""
+    values = np.asarray(values, dtype=np.float64) * 1000
+    summary = {f'p{p}_ms': round(float(np.percentile(values, p)), 3) for p in PERCENTILES}
+    summary['mean_ms'] = round(float(values.mean()), 3)
+    return summary
+
+
+def import_app(models_dir: Path):
+    """Импортирует main с моделями бенчмарка, без кэша результатов, фоновой очистки и прогрева"""
+    os.environ['MODELS_DIR'] = str(models_dir)
+    os.environ.setdefault('RESULT_CACHE', '0')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('JANITOR_INTERVAL_SECONDS', '0')
+    # Прогрев шел бы в фоне одновременно с замерами; замеры прогреваются своими прогонами
+    os.environ.setdefault('MODEL_WARMUP', '0')
+    os.chdir(ROOT)
+    import main
+    return main
+
+
+def box_iou(boxes: np.ndarray, others: np.ndarray) -> np.ndarray:
+    """Матрица IoU боксов (x0, y0, x1, y1)"""
+    top_left = np.maximum(boxes[:, None, :2], others[None, :, :2])
+    bottom_right = np.minimum(boxes[:, None, 2:], others[None, :, 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area = np.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+    other_area = np.prod(others[:, 2:] - others[:, :2], axis=1)
+    return inter / np.maximum(area[:, None] + other_area[None, :] - inter, 1e-9)
+
+
+def matched_count(reference: dict, found: dict) -> int:
+    """Сколько детекций reference жадно сопоставляются детекциям found (тот же класс, IoU >= RECALL_IOU)"""
+    if not reference['count'] or not found['count']:
+        return 0
+    iou = box_iou(np.asarray(reference['bbox'], dtype=np.float64), np.asarray(found['bbox'], dtype=np.float64))
+    iou[np.asarray(reference['class_name'])[:, None] != np.asarray(found['class_name'])[None, :]] = 0
+    matched = 0
+    used = np.zeros(iou.shape[1], dtype=bool)
+    for row in iou:
+        row = np.where(used, 0, row)
+        best = int(row.argmax())
+        if row[best] >= RECALL_IOU:
+            used[best] = True
+            matched += 1
+    return matched
+
+
+def cascade_recall(client, main, files: list, data: dict) -> dict:
+    """Полнота детекций моделей повреждений: каскад против тех же моделей по целым кадрам"""
+    data = {**data, 'response_format': 'columnar'}
+    cascade = client.post('/process', files=files, data=data).json()['detections']
+    reference_total = 0
+    matched = 0
+    for model_name in main.PROCESSING_TYPES['cascade'][1:]:
+        reference = client.post('/process', files=files, data={**data, 'model_name': model_name}).json()['detections']
+        for filename, models_data in reference.items():
+            reference_total += models_data[model_name]['count']
+            matched += matched_count(models_data[model_name], cascade[filename]['cascade'])
+    return {
+        'iou': RECALL_IOU,
+        'reference_detections': reference_total,
+        'matched': matched,
+        'recall': round(matched / reference_total, 4) if reference_total else None,
+    }
+
+
+class RecordCapture(logging.Handler):
+    """Перехватывает итоговые записи запросов вместо файла logs/requests_*.jsonl"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(json.loads(record.getMessage()))
+
+
+def _discover(queue):
+    main = import_app(ROOT / 'models_from_hub')
+    queue.put({'model_map': dict(main.MODEL_MAP), 'processing_types': dict(main.PROCESSING_TYPES)})
+
+
+def _run_config(config: dict, models_dir: Path, images: list, runs: int, warmup: int, queue):
+    main = import_app(models_dir)
+    from fastapi.testclient import TestClient
+
+    capture = RecordCapture()
+    main.request_logger.propagate = False
+    main.request_logger.addHandler(capture)
+
+    batch = [images[i % len(images)] for i in range(config['batch_size'])]
+    files = [('files', (f'car_{i}.jpg', contents, 'image/jpeg')) for i, contents in enumerate(batch)]
+    data = {'model_name': config['processing_type'], 'imgsz': config['imgsz'], 'conf': config['conf'], 'iou': 0.45,
+            'response_format': config['response_format'], 'tile_size': config['tile_size']}
+
+    wall = []
+    stages = {}
+    models = {}
+    detections = []
+    counters = {}
+    recall = None
+    errors = 0
+    with TestClient(main.app) as client:
+        for _ in range(warmup):
+            client.post('/process', files=files, data=data)
+        capture.records.clear()
+        for _ in range(runs):
+            start = time.perf_counter()
+            response = client.post('/process', files=files, data=data)
+            wall.append(time.perf_counter() - start)
+            if response.status_code != 200 or not capture.records:
+                errors += 1
+                continue
+            record = capture.records[-1]
+            for stage, seconds in record.get('stages', {}).items():
+                stages.setdefault(stage, []).append(seconds)
+            for model_name, timings in record.get('models', {}).items():
+                for stage in MODEL_STAGES:
+                    seconds = timings.get(stage)
+                    if seconds is None:
+                        continue
+                    models.setdefault(model_name, {}).setdefault(stage, []).append(seconds)
+                for counter in CASCADE_COUNTERS:
+                    if counter in timings:
+                        counters[counter] = counters.get(counter, 0) + timings[counter]
+            detections.append(record.get('detections', 0))
+        if config['processing_type'] == 'cascade':
+            recall = cascade_recall(client, main, files, data)
+        # Сессии бенчмарка не должны оставаться в tmp
+        main.SESSION_STORE.clear()
+
+    queue.put({
+        **config,
+        'runs': runs,
+        'errors': errors,
+        'throughput_images_per_s': round(config['batch_size'] * runs / sum(wall), 3),
+        'end_to_end': summarize(wall),
+        'stages': {stage: summarize(values) for stage, values in stages.items()},
+        'models': {name: {stage: summarize(values) for stage, values in timings.items()} for name, timings in models.items()},
+        'detections_mean': round(float(np.mean(detections)), 1) if detections else 0.0,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        **({'cascade': cascade_summary(counters, config['batch_size'] * runs, recall)} if recall else {}),
+    })
+
+
+def cascade_summary(counters: dict, images: int, recall: dict) -> dict:
+    """Кропы на изображение, доля целых кадров и входа моделей относительно целых кадров"""
+    full_frame_pixels = counters.get('full_frame_pixels', 0)
+    return {
+        'crops_per_image': round(counters.get('crops', 0) / images, 3),
+        'full_frame_share': round(counters.get('full_frames', 0) / images, 3),
+        'input_pixels_ratio': round(counters.get('input_pixels', 0) / full_frame_pixels, 4) if full_frame_pixels else None,
+        'damage_recall': recall,
+    }
+
+
+def _in_process(context, target, *args):
+    queue = context.Queue()
+    process = context.Process(target=target, args=(*args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def environment() -> dict:
+    """Описание окружения, чтобы отчеты разных машин и коммитов можно было сравнивать"""
+    import torch
+    import ultralytics
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'ultralytics': ultralytics.__version__,
+        'cpu': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'cpu_threads': os.getenv('CPU_THREADS'),
+        'inference_backend': os.getenv('INFERENCE_BACKEND', 'torch'),
+    }
+
+
+def discover() -> dict:
+    """MODEL_MAP и PROCESSING_TYPES приложения (импорт main в отдельном процессе)"""
+    return _in_process(multiprocessing.get_context('spawn'), _discover)
+
+
+def run(args) -> dict:
+    context = multiprocessing.get_context('spawn')
+    discovered = discover()
+    models_dir = build_models(args.models_dir, discovered['model_map'], args.scale)
+    types = args.types or list(discovered['processing_types'])
+
+    sizes = parse_sizes(args.sizes)
+    images = [make_jpeg(synthetic_car_image(w, h, seed)) for seed, (w, h) in enumerate(sizes)]
+
+    results = []
+    for processing_type in types:
+        for batch_size in args.batch_sizes:
+            for imgsz in args.imgsz:
+                for tile_size in args.tile_sizes:
+                    if tile_size and processing_type == 'cascade':
+                        continue
+                    config = {'processing_type': processing_type, 'batch_size': batch_size, 'imgsz': imgsz,
+                              'tile_size': tile_size, 'conf': args.conf, 'response_format': args.response_format}
+                    result = _in_process(context, _run_config, config, models_dir, images, args.runs, args.warmup)
+                    print(f"{processing_type:>14} batch={batch_size:<3} imgsz={imgsz:<5} tile={tile_size:<5} "
+                          f"p50={result['end_to_end']['p50_ms']:9.1f}ms p95={result['end_to_end']['p95_ms']:9.1f}ms "
+                          f"{result['throughput_images_per_s']:7.2f} img/s rss={result['peak_rss_mb']:.0f}MB", file=sys.stderr)
+                    results.append(result)
+
+    for result in results:
+        if 'cascade' in result:
+            result['cascade']['vs_all_models'] = versus_all_models(result, results, discovered['processing_types'])
+
+    return {
+        'environment': environment(),
+        'settings': {'scale': args.scale, 'sizes': args.sizes, 'jpeg_bytes': [len(i) for i in images],
+                     'runs': args.runs, 'warmup': args.warmup, 'conf': args.conf},
+        'results': results,
+    }
+
+
+def versus_all_models(cascade: dict, results: list, processing_types: dict):
+    """Каскад против прогона всех моделей по целым кадрам в той же конфигурации"""
+    baseline = next((r for r in results if r['processing_type'] == 'all_models' and not r.get('tile_size')
+                     and r['batch_size'] == cascade['batch_size'] and r['imgsz'] == cascade['imgsz']), None)
+    ratio = cascade['cascade']['input_pixels_ratio']
+    return {
+        # input_pixels_ratio считается от моделей каскада по целым кадрам; all_models гоняет свой набор моделей
+        'input_pixels_ratio': round(ratio * len(processing_types['cascade']) / len(processing_types['all_models']), 4)
+        if ratio is not None else None,
+        'p50_ratio': round(cascade['end_to_end']['p50_ms'] / baseline['end_to_end']['p50_ms'], 3) if baseline else None,
+        'throughput_ratio': round(cascade['throughput_images_per_s'] / baseline['throughput_images_per_s'], 3)
+        if baseline else None,
+    }
+
+
+def compare(old_path: Path, new_path: Path) -> list:
+    """Отношение p50/p95 сквозного времени нового отчета к старому по совпадающим конфигурациям"""
+    def key(result):
+        return result['processing_type'], result['batch_size'], result['imgsz'], result.get('tile_size', 0)
+
+    old = {key(r): r for r in json.loads(Path(old_path).read_text(encoding='utf-8'))['results']}
+    rows = []
+    for result in json.loads(Path(new_path).read_text(encoding='utf-8'))['results']:
+        before = old.get(key(result))
+        if before is None:
+            continue
+        rows.append({
+            'processing_type': result['processing_type'],
+            'batch_size': result['batch_size'],
+            'imgsz': result['imgsz'],
+            'tile_size': result.get('tile_size', 0),
+            'p50_ratio': round(result['end_to_end']['p50_ms'] / before['end_to_end']['p50_ms'], 3),
+            'p95_ratio': round(result['end_to_end']['p95_ms'] / before['end_to_end']['p95_ms'], 3),
+            'throughput_ratio': round(result['throughput_images_per_s'] / before['throughput_images_per_s'], 3),
+            'peak_rss_delta_mb': round(result['peak_rss_mb'] - before['peak_rss_mb'], 1),
+        })
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--types', nargs='+', help='типы обработки (по умолчанию все из PROCESSING_TYPES)')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 4])
+    parser.add_argument('--imgsz', nargs='+', type=int, default=[320, 640])
+    parser.add_argument('--tile-sizes', nargs='+', type=int, default=[0],
+                        help='размеры тайлов потайлового режима (0 - без тайлов)')
+    parser.add_argument('--sizes', nargs='+', default=['1280x960', '1920x1080', '4000x3000'],
+                        help='разрешения синтетических фото (файлы батча берутся по кругу)')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    # У случайных весов уверенность порядка 1e-3: такой порог дает 10-40 детекций на фото, как у настоящих моделей
+    parser.add_argument('--conf', type=float, default=0.001)
+    parser.add_argument('--response-format', default='records')
+    parser.add_argument('--scale', default='n', help='масштаб YOLOv8 для случайных моделей (n, s, m, ...)')
+    parser.add_argument('--models-dir', type=Path, default=ROOT / 'benchmarks' / '.models')
+    parser.add_argument('--output', type=Path)
+    parser.add_argument('--compare', nargs=2, type=Path, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare:
+        print(json.dumps(compare(*args.compare), indent=2, ensure_ascii=False))
+        sys.exit(0)
+
+    report = run(args)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        args.output.write_text(text, encoding='utf-8')
+    print(text)
@@ -0,0 +1,110 @@
+"""Сравнение быстрого пути уменьшения изображений (draft + reduce) с прежним LANCZOS.
+
+Запуск: python -m benchmarks.resize --sizes 4000x3000 8000x6000 --runs 5
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import resource
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def make_jpeg(width: int, height: int, quality: int = 92) -> bytes:
+    """Синтетическое фото: плавные градиенты с шумом, чтобы JPEG был похож на снимок с телефона"""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([x / width * 255, y / height * 255, (x + y) / (width + height) * 255], axis=-1)
+    noise = rng.normal(0, 12, size=(height, width, 3))
+    image = np.clip(base + noise, 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def legacy_path(contents: bytes, max_size: int):
+    """Прежний путь: полное декодирование, LANCZOS и пересохранение JPEG с optimize=True"""
+    with Image.open(io.BytesIO(contents)) as img:
+        width, height = img.size
+        if width > height:
+            new_size = (max_size, int(height * max_size / width))
+        else:
+            new_size = (int(width * max_size / height), max_size)
+        img_resized = img.resize(new_size, Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        img_resized.save(buffer, 'JPEG', quality=80, optimize=True)
+    with Image.open(io.BytesIO(buffer.getvalue())) as img:
+        return np.asarray(img.convert('RGB'))
+
+
+def fast_path(contents: bytes, max_size: int):
+    """Новый путь из image_pipeline.decode_upload: draft + reduce + LANCZOS на остатке, без перекодирования"""
+    from image_pipeline import decode_upload
+    image, _ = decode_upload(contents, 'bench.jpg', max_size)
+    return image
+
+
+PATHS = {'legacy_lanczos': legacy_path, 'fast_draft_reduce': fast_path}
+
+
+def peak_rss_mb() -> float:
+    """Пиковая память текущего процесса (VmHWM сбрасывается при exec, в отличие от ru_maxrss)"""
+    try:
+        with open('/proc/self/status', encoding='utf-8') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss в Linux возвращается в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _measure(path_name: str, contents: bytes, max_size: int, runs: int, queue):
+    func = PATHS[path_name]
+    func(contents, max_size)  # прогрев
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func(contents, max_size)
+        timings.append(time.perf_counter() - start)
+    queue.put({
+        'mean_ms': float(np.mean(timings) * 1000),
+        'p50_ms': float(np.percentile(timings, 50) * 1000),
+        'peak_rss_mb': peak_rss_mb(),
+    })
+
+
+def run(sizes: list, runs: int, max_size: int) -> dict:
+    """Замеряет каждый путь в отдельном процессе, чтобы пиковая память не смешивалась"""
+    context = multiprocessing.get_context('spawn')
+    report = {}
+    for width, height in sizes:
+        contents = make_jpeg(width, height)
+        entry = {'megapixels': round(width * height / 1e6, 1), 'jpeg_bytes': len(contents)}
+        for path_name in PATHS:
+            queue = context.Queue()
+            process = context.Process(target=_measure, args=(path_name, contents, max_size, runs, queue))
+            process.start()
+            entry[path_name] = queue.get()
+            process.join()
+        entry['speedup'] = entry['legacy_lanczos']['mean_ms'] / entry['fast_draft_reduce']['mean_ms']
+        report[f'{width}x{height}'] = entry
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', nargs='+', default=['4000x3000', '8000x6000'])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-size', type=int, default=512)
+    args = parser.parse_args()
+    parsed = [tuple(int(v) for v in size.split('x')) for size in args.sizes]
+    print(json.dumps(run(parsed, args.runs, args.max_size), indent=2, ensure_ascii=False))
@@ -0,0 +1,105 @@
+import math
+
+import numpy as np
+
+# Шаг размеров входа для вырезанных областей: кропы одной формы идут одним батчем
+CROP_IMGSZ_STEP = 64
+# Шаг, до которого ultralytics дополняет вход (stride модели)
+MODEL_STRIDE = 32
+
+
+def merge_regions(boxes: np.ndarray, width: int, height: int, pad_ratio: float) -> np.ndarray:
+    """Расширяет боксы на pad_ratio их стороны и объединяет пересекающиеся в общие прямоугольники.
+
+    Возвращает непересекающиеся области (x0, y0, x1, y1) в пикселях изображения,
+    поэтому одна и та же детекция не попадает в два кропа.
+    """
+    if len(boxes) == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    pad = np.maximum(boxes[:, 2:] - boxes[:, :2], 1.0) * pad_ratio
+    regions = np.concatenate([boxes[:, :2] - pad, boxes[:, 2:] + pad], axis=1)
+    regions = np.clip(np.round(regions), 0, [width, height, width, height])
+
+    # Слияние до неподвижной точки: объединение двух областей может задеть третью
+    merged = True
+    while merged and len(regions) > 1:
+        merged = False
+        overlap = (
+            (regions[:, None, 0] < regions[None, :, 2]) & (regions[None, :, 0] < regions[:, None, 2]) &
+            (regions[:, None, 1] < regions[None, :, 3]) & (regions[None, :, 1] < regions[:, None, 3])
+        )
+        keep = np.ones(len(regions), dtype=bool)
+        for i in range(len(regions)):
+            if not keep[i]:
+                continue
+            group = overlap[i] & keep
+            if group.sum() > 1:
+                regions[i, :2] = regions[group, :2].min(axis=0)
+                regions[i, 2:] = regions[group, 2:].max(axis=0)
+                group[i] = False
+                keep &= ~group
+                merged = True
+        regions = regions[keep]
+    regions = regions[(regions[:, 2] > regions[:, 0]) & (regions[:, 3] > regions[:, 1])]
+    return regions.astype(np.int64)
+
+
+def letterbox_pixels(width: int, height: int, imgsz: int) -> int:
+    """Площадь входа модели для целого кадра (прямоугольный вход, дополненный до stride)"""
+    scale = imgsz / max(width, height)
+    padded_width = math.ceil(round(width * scale) / MODEL_STRIDE) * MODEL_STRIDE
+    padded_height = math.ceil(round(height * scale) / MODEL_STRIDE) * MODEL_STRIDE
+    return padded_width * padded_height
+
+
+def _fit_span(start: int, end: int, size: int, limit: int) -> tuple:
+    """Отрезок длины size вокруг [start, end), сдвинутый внутрь [0, limit)"""
+    size = min(size, limit)
+    start = max(0, min((start + end - size) // 2, limit - size))
+    return start, start + size
+
+
+def fit_crop(region, width: int, height: int, image_scale: float, min_imgsz: int) -> tuple:
+    """Расширяет область так, чтобы ее вход модели был кратен CROP_IMGSZ_STEP по обеим сторонам.
+
+    Масштаб пикселей остается тем же, что у целого кадра, поэтому мелкие повреждения
+    видны модели так же, как без каскада. Возвращает (x0, y0, x1, y1, imgsz).
+    """
+    x0, y0, x1, y1 = (int(v) for v in region)
+    input_width = max(CROP_IMGSZ_STEP, math.ceil((x1 - x0) * image_scale / CROP_IMGSZ_STEP) * CROP_IMGSZ_STEP)
+    input_height = max(CROP_IMGSZ_STEP, math.ceil((y1 - y0) * image_scale / CROP_IMGSZ_STEP) * CROP_IMGSZ_STEP)
+    imgsz = max(input_width, input_height, min_imgsz)
+    if input_width >= input_height:
+        input_width = imgsz
+    else:
+        input_height = imgsz
+    x0, x1 = _fit_span(x0, x1, round(input_width / image_scale), width)
+    y0, y1 = _fit_span(y0, y1, round(input_height / image_scale), height)
+    return x0, y0, x1, y1, imgsz
+
+
+def plan_crops(region_boxes, width: int, height: int, imgsz: int, pad_ratio: float,
+               full_frame_ratio: float, crop_scale: float = 1.0, min_imgsz: int = 128) -> list:
+    """Кропы одного изображения: [(x0, y0, x1, y1, imgsz), ...].
+
+    Если детектор ничего не нашел или вход моделей по кропам больше full_frame_ratio
+    входа по целому кадру, модели повреждений прогоняются по целому кадру: кропы
+    не дали бы экономии, а пропуск кадра без деталей потерял бы повреждения крупным планом.
+    """
+    full_frame = [(0, 0, width, height, imgsz)]
+    regions = merge_regions(region_boxes, width, height, pad_ratio)
+    if len(regions) == 0:
+        return full_frame
+    image_scale = imgsz / max(width, height) * crop_scale
+    # Расширение до сетки может снова сблизить области - сливаем, пока кропы не перестанут пересекаться
+    while True:
+        crops = [fit_crop(region, width, height, image_scale, min_imgsz) for region in regions]
+        merged = merge_regions(np.array([crop[:4] for crop in crops]), width, height, 0.0)
+        if len(merged) == len(crops):
+            break
+        regions = merged
+    crops_pixels = sum(letterbox_pixels(x1 - x0, y1 - y0, crop_imgsz) for x0, y0, x1, y1, crop_imgsz in crops)
+    if crops_pixels > full_frame_ratio * letterbox_pixels(width, height, imgsz):
+        return full_frame
+    return crops
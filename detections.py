@@ -0,0 +1,149 @@
+from functools import lru_cache
+
+import numpy as np
+
+from mask_encoding import MASK_FIELDS, encode_masks
+
+# Форматы ответа /process: список словарей (по умолчанию) или колонки
+RESPONSE_FORMATS = ('records', 'columnar')
+
+# Параллельные массивы колоночного формата (по элементу на детекцию)
+COLUMN_KEYS = ('bbox', 'class_id', 'class_name', 'confidence', 'model_color', 'mask_polygon')
+
+
+@lru_cache(maxsize=1)
+def _palette() -> np.ndarray:
+    """Палитра YOLO (BGR) с заменой почти черных цветов на красный.
+
+    Строится при первом обращении: импорт ultralytics тянет за собой torch.
+    """
+    from ultralytics.utils.plotting import colors
+
+    palette = np.array([colors(i, bgr=True) for i in range(colors.n)], dtype=np.int32)
+    # БАН-ЛИСТ для черного цвета: на черной маске не видно повреждений
+    palette[(palette < 30).all(axis=1)] = (0, 0, 255)
+    return palette
+
+
+def class_colors(class_ids: np.ndarray) -> np.ndarray:
+    """Цвета классов одним обращением к палитре"""
+    palette = _palette()
+    return palette[np.asarray(class_ids, dtype=np.int64) % len(palette)]
+
+
+def _to_numpy(values) -> np.ndarray:
+    return values.cpu().numpy() if hasattr(values, 'cpu') else np.asarray(values)
+
+
+def empty_columns(width: int = 0, height: int = 0) -> dict:
+    """Колонки без детекций"""
+    columns = {'count': 0, 'image_size': [int(width), int(height)]}
+    columns.update({key: [] for key in COLUMN_KEYS})
+    return columns
+
+
+def extract_columns(result) -> dict:
+    """Извлекает детекции одного результата YOLO в колонки (параллельные массивы).
+
+    Тензоры боксов, классов и уверенностей конвертируются один раз,
+    полигоны масок переводятся в плоские списки через numpy.
+    """
+    height, width = result.orig_shape[:2]
+    columns = empty_columns(width, height)
+    boxes = result.boxes
+    if boxes is None or len(boxes) == 0:
+        return columns
+
+    class_ids = _to_numpy(boxes.cls).astype(np.int64)
+    names = result.names
+    columns['count'] = len(class_ids)
+    columns['bbox'] = _to_numpy(boxes.xyxy).tolist()
+    columns['class_id'] = class_ids.tolist()
+    columns['class_name'] = [str(names[class_id]) for class_id in columns['class_id']]
+    columns['confidence'] = _to_numpy(boxes.conf).tolist()
+    columns['model_color'] = class_colors(class_ids).tolist()
+
+    masks_xy = result.masks.xy if result.masks is not None else []
+    columns['mask_polygon'] = [
+        masks_xy[i].ravel().tolist() if i < len(masks_xy) else None
+        for i in range(columns['count'])
+    ]
+    return columns
+
+
+def concat_columns(columns_list: list) -> dict:
+    """Склеивает колонки нескольких моделей одного изображения"""
+    combined = empty_columns(*columns_list[0]['image_size']) if columns_list else empty_columns()
+    for key in COLUMN_KEYS:
+        combined[key] = [value for columns in columns_list for value in columns[key]]
+    combined['count'] = len(combined['class_id'])
+    return combined
+
+
+def offset_columns(columns: dict, x0: int, y0: int, width: int, height: int) -> dict:
+    """Переводит детекции кропа в координаты целого изображения"""
+    shifted = empty_columns(width, height)
+    if not columns['count']:
+        return shifted
+    shift = np.array([x0, y0], dtype=np.float64)
+    for key in shifted:
+        if key not in ('count', 'image_size', 'bbox', 'mask_polygon'):
+            shifted[key] = columns[key]
+    shifted['count'] = columns['count']
+    shifted['bbox'] = (np.asarray(columns['bbox'], dtype=np.float64) + np.tile(shift, 2)).tolist()
+    shifted['mask_polygon'] = [
+        None if polygon is None else (np.asarray(polygon, dtype=np.float64).reshape(-1, 2) + shift).ravel().tolist()
+        for polygon in columns['mask_polygon']
+    ]
+    return shifted
+
+
+def scale_columns(columns: dict, width: int, height: int) -> dict:
+    """Переводит детекции в координаты того же изображения другого размера"""
+    scaled = dict(columns)
+    scaled['image_size'] = [int(width), int(height)]
+    if not columns['count']:
+        return scaled
+    source_width, source_height = columns['image_size']
+    scale = np.array([width / source_width, height / source_height], dtype=np.float64)
+    scaled['bbox'] = (np.asarray(columns['bbox'], dtype=np.float64) * np.tile(scale, 2)).tolist()
+    scaled['mask_polygon'] = [
+        None if polygon is None else (np.asarray(polygon, dtype=np.float64).reshape(-1, 2) * scale).ravel().tolist()
+        for polygon in columns['mask_polygon']
+    ]
+    return scaled
+
+
+def columns_to_records(columns: dict, include_normalized: bool = True) -> list:
+    """Преобразует колонки в привычный список словарей (по словарю на детекцию)"""
+    width, height = columns['image_size']
+    mask_fields = [field for field in MASK_FIELDS.values() if field in columns]
+    records = []
+    for i in range(columns['count']):
+        detection = {
+            'bbox': columns['bbox'][i],
+            'class_id': columns['class_id'][i],
+            'class_name': columns['class_name'][i],
+            'confidence': columns['confidence'][i],
+            'model_color': columns['model_color'][i],
+        }
+        for field in mask_fields:
+            mask = columns[field][i]
+            if mask is None:
+                continue
+            detection[field] = mask
+            if field == 'mask_polygon' and include_normalized:
+                normalized = np.asarray(mask, dtype=np.float32).reshape(-1, 2) / (width, height)
+                detection['mask_polygon_normalized'] = normalized.ravel().tolist()
+        records.append(detection)
+    return records
+
+
+def format_detections(columns: dict, response_format: str = 'records',
+                      mask_encoding: str = 'polygon', mask_tolerance: float = 0.0):
+    """Детекции в формате ответа и кодировке масок, выбранных клиентом"""
+    columns = encode_masks(columns, mask_encoding, mask_tolerance)
+    if response_format == 'columnar':
+        return columns
+    # Нормализованная копия полигона остается только в формате по умолчанию
+    return columns_to_records(columns, include_normalized=mask_encoding == 'polygon' and mask_tolerance <= 0)
@@ -0,0 +1,139 @@
+import io
+import logging
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image, ExifTags
+
+logger = logging.getLogger('app')
+
+# Поворот/отражение для каждого значения тега Orientation из EXIF
+EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# Ориентации, при которых ширина и высота меняются местами
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+# Режимы, которые умеет Image.reduce() (палитра, 1-бит и I;16 - нет)
+REDUCE_MODES = ('L', 'LA', 'RGB', 'RGBA', 'CMYK', 'I', 'F')
+
+def get_exif_orientation(img: Image.Image) -> int:
+    """Возвращает значение тега Orientation (1 - без поворота)"""
+    try:
+        return int(img.getexif().get(ExifTags.Base.Orientation, 1))
+    except Exception:
+        return 1
+
+def fit_size(width: int, height: int, max_size: int) -> tuple:
+    """Размер с сохранением пропорций, у которого большая сторона равна max_size"""
+    # Очень вытянутые изображения (6000x5) не должны сжиматься в ноль пикселей
+    if width > height:
+        return max_size, max(1, int(height * max_size / width))
+    return max(1, int(width * max_size / height)), max_size
+
+def downscale(img: Image.Image, size: tuple) -> Image.Image:
+    """Целую часть коэффициента снимает усреднением блоков (reduce), остаток меньше 2x - LANCZOS"""
+    new_width, new_height = size
+    factor = min(img.size[0] // new_width, img.size[1] // new_height)
+    if factor >= 2 and img.mode not in REDUCE_MODES:
+        # Модели все равно получают RGB, поэтому переводим заранее
+        img = img.convert('RGB')
+    img_resized = img.reduce(factor) if factor >= 2 else img
+    return img_resized.resize((new_width, new_height), Image.Resampling.LANCZOS)
+
+def optimize_image_size(img: Image.Image, name: str, max_size: int = 512) -> Image.Image:
+    """Быстро уменьшает изображение в памяти для обработки на CPU.
+
+    Для JPEG масштабирование делается еще при декодировании (draft, DCT 1/2-1/8),
+    оставшийся целый множитель снимается через reduce(), и только последний шаг
+    меньше 2x выполняется LANCZOS. Ориентация из EXIF применяется к результату.
+    """
+    # Получаем размеры
+    width, height = img.size
+    orientation = get_exif_orientation(img)
+    
+    # Если изображение больше max_size, уменьшаем его
+    if max(width, height) > max_size:
+        # Вычисляем новые размеры с сохранением пропорций
+        new_width, new_height = fit_size(width, height, max_size)
+        
+        # JPEG декодируется сразу в уменьшенном виде (не меньше целевого размера)
+        if img.format == 'JPEG':
+            img.draft('RGB', (new_width, new_height))
+        
+        img_resized = downscale(img, (new_width, new_height))
+        logger.debug(f"🔧 Изображение {name} оптимизировано: {width}x{height} -> {new_width}x{new_height}")
+    else:
+        img_resized = img
+        logger.debug(f"🔧 Изображение {name} уже оптимального размера: {width}x{height}")
+    
+    # Поворачиваем согласно EXIF, чтобы модель и браузер видели одинаковую ориентацию
+    if orientation in EXIF_TRANSPOSE:
+        img_resized = img_resized.transpose(EXIF_TRANSPOSE[orientation])
+    return img_resized
+
+def decode_upload(source, name: str, max_size: int = 512):
+    """Декодирует загруженный файл (байты или путь) один раз и уменьшает его в памяти.
+
+    Возвращает BGR массив (в таком виде его принимают модели) и признак того,
+    что изображение изменилось (размер или ориентация) и его нужно перекодировать
+    для отображения.
+    """
+    try:
+        with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as img:
+            original_size = img.size
+            orientation = get_exif_orientation(img)
+            optimized = optimize_image_size(img, name, max_size)
+            changed = optimized.size != original_size or orientation in EXIF_TRANSPOSE
+            image = cv2.cvtColor(np.asarray(optimized.convert('RGB')), cv2.COLOR_RGB2BGR)
+    except Exception as e:
+        raise ValueError(f"Не удалось прочитать изображение {name}: {str(e)}") from e
+    return image, changed
+
+def decode_upload_full(source, name: str, max_size: int, full_max_size: int):
+    """Один проход декодирования для потайлового режима.
+
+    Возвращает (копия как у decode_upload, признак изменения) и BGR изображение
+    со стороной не больше full_max_size; копия уменьшается из него, а не из файла.
+    """
+    try:
+        with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as img:
+            original_size = img.size
+            orientation = get_exif_orientation(img)
+            full = optimize_image_size(img, name, full_max_size)
+            # Размер копии считается от исходного файла, как в decode_upload
+            display_size = fit_size(*original_size, max_size) if max(original_size) > max_size else original_size
+            if orientation in TRANSPOSED_ORIENTATIONS:
+                display_size = display_size[::-1]
+            display = downscale(full, display_size) if display_size != full.size else full
+            changed = display.size != original_size or orientation in EXIF_TRANSPOSE
+            full_image = cv2.cvtColor(np.asarray(full.convert('RGB')), cv2.COLOR_RGB2BGR)
+            image = full_image if display is full else cv2.cvtColor(np.asarray(display.convert('RGB')), cv2.COLOR_RGB2BGR)
+    except Exception as e:
+        raise ValueError(f"Не удалось прочитать изображение {name}: {str(e)}") from e
+    return (image, changed), full_image
+
+def persist_image(image_path: Path, image: np.ndarray, changed: bool) -> bytes:
+    """Готовит изображение для отображения в /tmp/{session_id} поверх сохраненного оригинала.
+
+    Если изображение менялось, оригинал заменяется обработанной копией - координаты
+    детекций относятся именно к ней. Иначе оригинал остается как есть.
+    Возвращает байты файла для отображения.
+    """
+    if not changed:
+        return image_path.read_bytes()
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 80])
+    if not ok:
+        raise ValueError(f"Не удалось закодировать изображение {image_path.name}")
+    contents = encoded.tobytes()
+    image_path.write_bytes(contents)
+    logger.debug(f"💾 Файл сохранен: {image_path}")
+    return contents
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+logger = logging.getLogger('app')
+
+
+class _SlotLease:
+    """Слот пула, занятый одной задачей.
+
+    Задача отдает слот, пока все ее потоки (включая потоки пула моделей) ждут батч
+    планировщика: forward идет в потоке планировщика, и слот нужен другим запросам,
+    чтобы их изображения успели попасть в тот же батч.
+    """
+
+    __slots__ = ('_executor', '_lock', '_reacquire', '_active', 'held')
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._lock = threading.Lock()
+        # Поток, вернувшийся из ожидания, занимает слот заново, остальные ждут его
+        self._reacquire = threading.Lock()
+        self._active = 1
+        self.held = True
+
+    def join(self):
+        """Еще один поток работает в счет слота (вызывается из активного потока задачи)"""
+        with self._lock:
+            self._active += 1
+
+    def pause(self):
+        with self._lock:
+            self._active -= 1
+            release = self._active == 0 and self.held
+            if release:
+                self.held = False
+        if release:
+            self._executor._release_slot(paused=True)
+
+    def resume(self):
+        with self._reacquire:
+            with self._lock:
+                self._active += 1
+                if self.held:
+                    return
+            self._executor._acquire_slot(paused=True)
+            with self._lock:
+                self.held = True
+
+
+class InferenceExecutor:
+    """Ограниченный пул потоков для CPU-тяжелой работы (инференс, ресайз, извлечение детекций).
+
+    Event loop только ожидает результат, поэтому /status, статика и другие загрузки
+    не блокируются одним тяжелым запросом. Torch отпускает GIL внутри операций,
+    так что потоки реально выполняются параллельно.
+
+    Одновременно работают max_workers задач (слоты). Задача, ожидающая микробатч
+    (paused), слот отпускает; таких задач может быть еще max_waiting.
+    """
+
+    def __init__(self, max_workers: int, max_waiting: int = 0):
+        self.max_workers = max(1, max_workers)
+        self.max_waiting = max(0, max_waiting)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers + self.max_waiting, thread_name_prefix='inference')
+        self._slots = threading.Semaphore(self.max_workers)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._paused = 0
+        self._completed = 0
+        self._failed = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._last_wait = 0.0
+
+    def _acquire_slot(self, paused: bool = False):
+        self._slots.acquire()
+        if paused:
+            with self._lock:
+                self._paused -= 1
+
+    def _release_slot(self, paused: bool = False):
+        if paused:
+            with self._lock:
+                self._paused += 1
+        self._slots.release()
+
+    @contextmanager
+    def paused(self):
+        """Ожидание, на время которого задача отпускает слот (вне задачи пула ничего не делает)"""
+        lease = getattr(self._local, 'lease', None)
+        if lease is None:
+            yield
+            return
+        lease.pause()
+        try:
+            yield
+        finally:
+            lease.resume()
+
+    def carry(self, func):
+        """Оборачивает func для другого пула потоков: поток работает в счет слота текущей задачи"""
+        lease = getattr(self._local, 'lease', None)
+        if lease is None:
+            return func
+        lease.join()
+
+        def run(*args, **kwargs):
+            self._local.lease = lease
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.lease = None
+                lease.pause()
+        return run
+
+    def busy(self) -> int:
+        """Задачи, которые работают или ждут слот, то есть еще могут отправить изображения в батч"""
+        with self._lock:
+            return max(0, self._queued + self._running - self._paused)
+
+    async def run(self, func, *args, **kwargs):
+        """Выполняет func в пуле и асинхронно ожидает результат"""
+        submitted_at = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+
+        def task():
+            self._acquire_slot()
+            lease = self._local.lease = _SlotLease(self)
+            wait_time = time.perf_counter() - submitted_at
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+                self._total_wait += wait_time
+                self._last_wait = wait_time
+                self._max_wait = max(self._max_wait, wait_time)
+            if wait_time > 1.0:
+                logger.warning(f"⏳ Задача {getattr(func, '__name__', func)} ждала слот {wait_time:.2f}с")
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self._failed += 1
+                raise
+            finally:
+                self._local.lease = None
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+                if lease.held:
+                    self._release_slot()
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, task)
+
+    def stats(self) -> dict:
+        """Снимок состояния пула: глубина очереди, занятые слоты и время ожидания"""
+        with self._lock:
+            started = self._completed + self._running
+            return {
+                "slots": self.max_workers,
+                "max_waiting": self.max_waiting,
+                "queue_depth": self._queued,
+                "running": max(0, self._running - self._paused),
+                "waiting_on_batch": self._paused,
+                "completed": self._completed,
+                "failed": self._failed,
+                "avg_wait_seconds": round(self._total_wait / started, 4) if started else 0.0,
+                "max_wait_seconds": round(self._max_wait, 4),
+                "last_wait_seconds": round(self._last_wait, 4),
+            }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
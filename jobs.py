@@ -0,0 +1,297 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from state_db import StateDB, pid_alive
+
+logger = logging.getLogger('app')
+
+# Состояния задачи
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class JobQueueFull(Exception):
+    """Очередь задач заполнена, клиенту стоит повторить через retry_after секунд"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Очередь задач заполнена, повторите через {retry_after}с")
+        self.retry_after = retry_after
+
+
+class Job:
+    """Состояние одной задачи обработки: прогресс, результаты и флаг отмены"""
+
+    def __init__(self, job_id: str, model_name: str, files_count: int):
+        self.id = job_id
+        self.model_name = model_name
+        self.files_count = files_count
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.completed = 0
+        self.total = 0
+        self.original_images = {}
+        self.results = {}
+        self.detections = {}
+        self.model_errors = {}
+        self.summary = None
+        self.error = None
+        # Флаг проверяется рабочими потоками между частями батча
+        self.cancel_event = threading.Event()
+
+    def snapshot(self, include_results: bool = True) -> dict:
+        """Состояние задачи для ответа GET /jobs/{id}"""
+        data = {
+            "job_id": self.id,
+            "status": self.status,
+            "model_name": self.model_name,
+            "files": self.files_count,
+            "completed": self.completed,
+            "total": self.total,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "model_errors": self.model_errors,
+            "error": self.error,
+        }
+        if include_results:
+            data.update({
+                "results": self.results,
+                "detections": self.detections,
+                "original_images": self.original_images,
+                "summary": self.summary,
+            })
+        return data
+
+
+# Живое состояние задач в общей базе: статус и прогресс без результатов
+JOB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    model_name TEXT,
+    files INTEGER,
+    completed INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    created_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    error TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at);
+CREATE INDEX IF NOT EXISTS jobs_cancel ON jobs (pid, cancel_requested);
+"""
+
+JOB_INDEX_FIELDS = ("status", "model_name", "files", "completed", "total", "created_at", "started_at",
+                    "finished_at", "error")
+
+
+class JobIndex:
+    """Статус задач всех воркеров в общей базе.
+
+    Задача живет в памяти воркера, который ее принял (владельца), но статус,
+    прогресс и запрос отмены видны через любой воркер. Отмену из чужого воркера
+    владелец забирает периодическим опросом (cancel_requests).
+    """
+
+    def __init__(self, db: StateDB, finished_ttl: float = 3600.0):
+        self._db = db
+        self.finished_ttl = finished_ttl
+        self._db.executescript(JOB_SCHEMA)
+
+    def save(self, job: Job):
+        """Сохраняет состояние задачи (вызывается владельцем при каждой его смене)"""
+        self._db.execute(
+            "INSERT INTO jobs (id, pid, status, model_name, files, completed, total, created_at, started_at, finished_at, error) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET status = excluded.status, completed = excluded.completed, "
+            "total = excluded.total, started_at = excluded.started_at, finished_at = excluded.finished_at, "
+            "error = excluded.error",
+            (job.id, os.getpid(), job.status, job.model_name, job.files_count, job.completed, job.total,
+             job.created_at, job.started_at, job.finished_at, job.error)
+        )
+        if job.status in FINISHED_STATES:
+            self._db.execute("DELETE FROM jobs WHERE finished_at < ?", (time.time() - self.finished_ttl,))
+
+    def progress(self, job: Job):
+        """Обновляет только прогресс запущенной задачи"""
+        self._db.execute("UPDATE jobs SET completed = ?, total = ? WHERE id = ?", (job.completed, job.total, job.id))
+
+    def get(self, job_id: str):
+        """Поля снимка задачи из базы или None. Задача упавшего воркера считается завершенной с ошибкой"""
+        rows = self._db.query(f"SELECT pid, {', '.join(JOB_INDEX_FIELDS)} FROM jobs WHERE id = ?", (job_id,))
+        if not rows:
+            return None
+        pid, *values = rows[0]
+        data = {"job_id": job_id, **dict(zip(JOB_INDEX_FIELDS, values))}
+        if data["status"] not in FINISHED_STATES and not pid_alive(pid):
+            data["status"] = FAILED
+            data["error"] = f"Воркер задачи (pid {pid}) завершился"
+        return data
+
+    def request_cancel(self, job_id: str) -> bool:
+        """Просит владельца отменить незавершенную задачу. False, если отменять нечего"""
+        return self._db.execute(
+            f"UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status NOT IN ({', '.join('?' * len(FINISHED_STATES))})",
+            (job_id, *FINISHED_STATES)
+        ) > 0
+
+    def cancel_requests(self, pid: int) -> list:
+        """Забирает запросы отмены задач процесса pid (каждый возвращается один раз)"""
+        with self._db.transaction() as connection:
+            job_ids = [row[0] for row in connection.execute(
+                "SELECT id FROM jobs WHERE pid = ? AND cancel_requested = 1", (pid,)
+            )]
+            if job_ids:
+                connection.execute("UPDATE jobs SET cancel_requested = 0 WHERE pid = ? AND cancel_requested = 1", (pid,))
+        return job_ids
+
+
+class JobManager:
+    """Ограниченная очередь задач с фиксированным числом обработчиков.
+
+    Новая задача принимается только при наличии места в очереди, иначе
+    JobQueueFull с оценкой времени до освобождения места. Завершенные задачи
+    хранятся в памяти ограниченное время и в ограниченном количестве.
+    on_change вызывается при каждой смене состояния задачи.
+    """
+
+    def __init__(self, run_job, workers: int = 1, max_queue: int = 16,
+                 keep_finished: int = 256, finished_ttl: float = 3600.0, on_change=None):
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self.keep_finished = keep_finished
+        self.finished_ttl = finished_ttl
+        self._run_job = run_job
+        self._on_change = on_change
+        self._queue = None
+        self._tasks = []
+        self._jobs = OrderedDict()
+        self._durations = []
+        self._running = 0
+        self._rejected = 0
+
+    def start(self):
+        """Запускает обработчики (вызывается из event loop при старте приложения)"""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"📬 Очередь задач: {self.workers} обработчиков, до {self.max_queue} задач в очереди")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def retry_after(self) -> int:
+        """Оценка ожидания места в очереди по среднему времени последних задач"""
+        average = sum(self._durations) / len(self._durations) if self._durations else 10.0
+        return max(1, math.ceil(average * (self.queue_depth() + 1) / self.workers))
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def check_capacity(self):
+        """Отказ до приема файлов, если очередь уже заполнена"""
+        if self._queue is None or self._queue.full():
+            self._rejected += 1
+            raise JobQueueFull(self.retry_after())
+
+    def submit(self, job: Job, payload):
+        """Ставит задачу в очередь или поднимает JobQueueFull"""
+        self.check_capacity()
+        self._queue.put_nowait((job, payload))
+        self._jobs[job.id] = job
+        self._evict_finished()
+        self._notify(job)
+        return job
+
+    def get(self, job_id: str):
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str):
+        """Отменяет задачу: из очереди она не будет запущена, запущенная остановится после текущей части"""
+        job = self._jobs.get(job_id)
+        if job is None or job.status in FINISHED_STATES:
+            return job
+        job.cancel_event.set()
+        if job.status == QUEUED:
+            job.status = CANCELLED
+            job.finished_at = time.time()
+            self._notify(job)
+        return job
+
+    def _notify(self, job: Job):
+        if self._on_change is None:
+            return
+        try:
+            self._on_change(job)
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения состояния задачи {job.id}: {str(e)}")
+
+    def _evict_finished(self):
+        """Удаляет из памяти старые завершенные задачи сверх лимита или TTL"""
+        now = time.time()
+        finished = [job for job in self._jobs.values() if job.status in FINISHED_STATES]
+        excess = len(finished) - self.keep_finished
+        for job in finished:
+            if excess > 0 or now - job.finished_at > self.finished_ttl:
+                del self._jobs[job.id]
+                excess -= 1
+
+    async def _worker(self, index: int):
+        while True:
+            job, payload = await self._queue.get()
+            try:
+                if job.status == CANCELLED:
+                    continue
+                job.status = RUNNING
+                job.started_at = time.time()
+                self._running += 1
+                self._notify(job)
+                logger.info(f"📬 Обработчик {index}: задача {job.id} запущена")
+                await self._run_job(job, payload)
+                job.status = CANCELLED if job.cancel_event.is_set() else DONE
+            except asyncio.CancelledError:
+                job.status = CANCELLED
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка задачи {job.id}: {str(e)}")
+                job.status = FAILED
+                job.error = str(e)
+            finally:
+                if job.started_at is not None and job.finished_at is None:
+                    self._running -= 1
+                    job.finished_at = time.time()
+                    self._durations = (self._durations + [job.finished_at - job.started_at])[-20:]
+                    logger.info(f"📬 Задача {job.id}: {job.status} за {job.finished_at - job.started_at:.2f}с")
+                    self._notify(job)
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        statuses = {}
+        for job in self._jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue_depth(),
+            "max_queue": self.max_queue,
+            "running": self._running,
+            "rejected": self._rejected,
+            "jobs": statuses,
+            "avg_job_seconds": round(sum(self._durations) / len(self._durations), 3) if self._durations else None,
+        }
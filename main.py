@@ -1,37 +1,64 @@
-from fastapi import FastAPI, Request, File, UploadFile, Form
+from fastapi import FastAPI, Request, File, UploadFile, Form, Query
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from model_config import MODEL_MAP
 import uvicorn
-from fastapi.responses import JSONResponse
-from PIL import Image
-import shutil
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import uuid
 from pathlib import Path
 import time
-from ultralytics import YOLO
-from ultralytics.utils.plotting import colors
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
 import logging
-import torch
 import gc
 from datetime import datetime
 import sys
 import cv2
 import numpy as np
 import traceback
+import json
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
 from typing import List, Dict, Any
 import random
+import os
+import shutil
+from urllib.parse import quote
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from inference_executor import InferenceExecutor
+from batching import BatchScheduler
+from backends import load_backend_model, SUPPORTED_BACKENDS
+from image_pipeline import decode_upload, decode_upload_full, persist_image
+from uploads import save_uploads, UploadTooLarge
+from session_store import SessionStore
+from state_db import StateDB
+from result_cache import ResultCache, hash_contents
+from cascade import plan_crops, letterbox_pixels
+from tiling import TiledImage, merge_tile_columns
+from attribution import attribute_damages, split_attribution, ATTRIBUTION_KEY, ATTRIBUTION_VERSION
+from detections import extract_columns, empty_columns, concat_columns, offset_columns, format_detections, RESPONSE_FORMATS
+from mask_encoding import MASK_ENCODINGS
+from jobs import Job, JobIndex, JobManager, JobQueueFull
+from rendering import render_overlay, encode_render, RENDER_FORMATS
+from metrics import (
+    UPLOAD_READ_SECONDS, DECODE_SECONDS, INFERENCE_SECONDS, EXTRACTION_SECONDS, SERIALIZATION_SECONDS,
+    REQUEST_SECONDS, REQUESTS, IMAGES, DETECTIONS, ERRORS, CACHE_HITS,
+    MODEL_CACHE_SIZE, INFLIGHT_REQUESTS, TMP_DISK_BYTES, render_metrics
+)
+from process_memory import process_memory, model_weights_bytes
+from model_registry import ModelRegistry
 
 # Настройка логирования
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+REQUEST_LOGGER_NAME = 'app.requests'
+
 def setup_logging():
     log_dir = Path(__file__).resolve().parent / "logs"
     log_dir.mkdir(exist_ok=True)
     
     # Создаем логгер
     logger = logging.getLogger('app')
-    logger.setLevel(logging.INFO)
+    logger.setLevel(LOG_LEVEL)
     
     # Очищаем существующие обработчики
     logger.handlers.clear()
@@ -42,56 +69,128 @@ def setup_logging():
     
     # Обработчик для консоли
     console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(logging.INFO)
+    console_handler.setLevel(LOG_LEVEL)
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
     
     # Обработчик для файла
     file_handler = logging.FileHandler(
         log_dir / f"app_{datetime.now().strftime('%Y%m%d')}.log", 
         encoding='utf-8'
     )
-    file_handler.setLevel(logging.INFO)
+    file_handler.setLevel(LOG_LEVEL)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    
+    # Итоговые записи запросов идут отдельным файлом JSON lines
+    requests_handler = logging.FileHandler(
+        log_dir / f"requests_{datetime.now().strftime('%Y%m%d')}.jsonl",
+        encoding='utf-8'
+    )
+    requests_handler.setFormatter(logging.Formatter('%(message)s'))
+    requests_handler.addFilter(lambda record: record.name == REQUEST_LOGGER_NAME)
+    console_handler.addFilter(lambda record: record.name != REQUEST_LOGGER_NAME)
+    file_handler.addFilter(lambda record: record.name != REQUEST_LOGGER_NAME)
+    
+    # Запросы только кладут записи в очередь, запись в консоль и файлы идет в фоновом потоке
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, console_handler, file_handler, requests_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
     
     return logger
 
 logger = setup_logging()
+request_logger = logging.getLogger(REQUEST_LOGGER_NAME)
+# Итог запроса пишется всегда, даже если LOG_LEVEL выше INFO
+request_logger.setLevel(logging.INFO)
 
 BASE_DIR = Path(__file__).resolve().parent
+# Каталог с весами моделей (бенчмарки подставляют свои модели со случайными весами)
+MODELS_DIR = Path(os.getenv("MODELS_DIR", str(BASE_DIR / "models_from_hub")))
 TMP_DIR = BASE_DIR / "tmp"
 TMP_DIR.mkdir(exist_ok=True)
 
-# Глобальный словарь для хранения цветов классов (как в YOLO)
-CLASS_COLORS = {}
+# Жизненный цикл сессий в tmp: TTL с последнего обращения, квота на диск и период очистки
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", str(6 * 3600)))
+TMP_QUOTA_BYTES = int(os.getenv("TMP_QUOTA_BYTES", str(5 * 1024 * 1024 * 1024)))
+JANITOR_INTERVAL_SECONDS = float(os.getenv("JANITOR_INTERVAL_SECONDS", "60"))
+# Общая для воркеров prefork.py база учета сессий и задач (вне раздаваемой /tmp)
+STATE_DB_PATH = Path(os.getenv("STATE_DB_PATH", str(BASE_DIR / "state" / "state.db")))
+STATE_DB = StateDB(STATE_DB_PATH)
+SESSION_STORE = SessionStore(TMP_DIR, SESSION_TTL_SECONDS, TMP_QUOTA_BYTES, STATE_DB)
 
-def get_class_color(class_id: int) -> tuple:
-    """Получает цвет для класса, ПРИНУДИТЕЛЬНО исключая черный цвет"""
-    if class_id not in CLASS_COLORS:
-        # Используем функцию colors() от YOLO
-        class_color = colors(class_id, bgr=True)
-        logger.info(f"🎨 YOLO вернул цвет для класса {class_id}: BGR={class_color}")
-        
-        # БАН-ЛИСТ для черного цвета - принудительно заменяем на красный
-        b, g, r = class_color[0], class_color[1], class_color[2]  # BGR
-        
-        # ПРИНУДИТЕЛЬНО заменяем любой черный цвет на красный
-        if (b == 0 and g == 0 and r == 0) or (b < 30 and g < 30 and r < 30):
-            # Заменяем на красный цвет
-            class_color = (0, 0, 255)  # BGR формат: (0, 0, 255) = красный
-            logger.info(f"🎨 БАН-ЛИСТ: черный цвет для класса {class_id} заменен на КРАСНЫЙ: {class_color}")
-        else:
-            logger.info(f"🎨 НОВЫЙ цвет для класса {class_id}: {class_color}")
-        
-        CLASS_COLORS[class_id] = class_color
-    else:
-        logger.info(f"🎨 ИСПОЛЬЗУЮ кэшированный цвет для класса {class_id}: {CLASS_COLORS[class_id]}")
-    
-    return CLASS_COLORS[class_id]
+# Максимальная сторона изображения перед инференсом
+MAX_IMAGE_SIZE = 512
+
+# Лимиты загрузки: на один файл и на запрос целиком
+MAX_UPLOAD_FILE_BYTES = int(os.getenv("MAX_UPLOAD_FILE_BYTES", str(50 * 1024 * 1024)))
+MAX_UPLOAD_REQUEST_BYTES = int(os.getenv("MAX_UPLOAD_REQUEST_BYTES", str(1024 * 1024 * 1024)))
+# Запас на заголовки multipart и поля формы при проверке Content-Length
+MULTIPART_OVERHEAD_BYTES = 1024 * 1024
+
+# Кэш результатов по содержимому изображения: память (LRU с бюджетом) + диск.
+# Дисковый кэш общий для всех пользователей, поэтому лежит вне раздаваемой /tmp
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE", "1") == "1"
+RESULT_CACHE_BYTES = int(os.getenv("RESULT_CACHE_BYTES", str(256 * 1024 * 1024)))
+RESULT_CACHE_DISK_BYTES = int(os.getenv("RESULT_CACHE_DISK_BYTES", str(2 * 1024 * 1024 * 1024)))
+RESULT_CACHE_DIR = Path(os.getenv("RESULT_CACHE_DIR", str(BASE_DIR / "result_cache")))
+# Прежнее место дискового кэша: его файлы были доступны через /tmp
+LEGACY_RESULT_CACHE_DIR = TMP_DIR / ".result_cache"
+if LEGACY_RESULT_CACHE_DIR.resolve() != RESULT_CACHE_DIR.resolve():
+    shutil.rmtree(LEGACY_RESULT_CACHE_DIR, ignore_errors=True)
+RESULT_CACHE = ResultCache(RESULT_CACHE_BYTES, RESULT_CACHE_DIR, RESULT_CACHE_DISK_BYTES) if RESULT_CACHE_ENABLED else None
+
+# Реестр загруженных моделей: бюджет памяти (0 - без ограничения), закрепленные модели
+# и период проверки файлов весов для горячей замены (0 - без проверки)
+MODEL_MEMORY_BUDGET_BYTES = int(os.getenv("MODEL_MEMORY_BUDGET_BYTES", "0"))
+PINNED_MODELS = [name.strip() for name in os.getenv("PINNED_MODELS", "").split(",") if name.strip()]
+MODEL_RELOAD_INTERVAL_SECONDS = float(os.getenv("MODEL_RELOAD_INTERVAL_SECONDS", "30"))
+
+# Номер воркера при запуске через prefork.py (None - один процесс)
+WORKER_ID = None
+
+# Блокировки моделей: предиктор ultralytics не потокобезопасен,
+# поэтому одна и та же модель не вызывается из двух потоков одновременно
+MODEL_LOCKS = {}
+MODEL_LOCKS_GUARD = threading.Lock()
+
+# Микробатчинг изображений из разных запросов для одной модели
+MICRO_BATCHING = os.getenv("MICRO_BATCHING", "1") == "1"
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "5"))
+BATCH_SCHEDULERS = {}
+
+# Количество слотов пула инференса. Задачи, ждущие микробатч, слот отпускают,
+# поэтому в батч одной модели могут попасть изображения INFERENCE_WORKERS +
+# INFERENCE_MAX_WAITING запросов (по умолчанию - до полного батча)
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "2"))
+INFERENCE_MAX_WAITING = int(os.getenv("INFERENCE_MAX_WAITING", str(BATCH_MAX_SIZE if MICRO_BATCHING else 0)))
+INFERENCE_EXECUTOR = InferenceExecutor(INFERENCE_WORKERS, INFERENCE_MAX_WAITING)
+
+# Параллельный запуск моделей внутри одного запроса (all_models, damage_only)
+PARALLEL_MODELS = os.getenv("PARALLEL_MODELS", "1") == "1"
+# Количество ядер, которые делятся между параллельно работающими моделями
+CPU_THREADS = int(os.getenv("CPU_THREADS", str(os.cpu_count() or 1)))
+
+# Сколько изображений одной модели прогоняется за раз в потоковом /process/stream:
+# меньше - раньше первый результат, больше - выше пропускная способность
+STREAM_CHUNK_SIZE = max(1, int(os.getenv("STREAM_CHUNK_SIZE", "1")))
+
+# Очередь задач /jobs: фиксированное число обработчиков и ограниченная очередь
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "16"))
+JOBS_KEEP = int(os.getenv("JOBS_KEEP", "256"))
+JOBS_TTL_SECONDS = float(os.getenv("JOBS_TTL_SECONDS", "3600"))
 
-# Глобальный кэш для моделей
-MODEL_CACHE = {}
+# Бэкенд инференса (torch, onnx, openvino) - настройка развертывания
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")
+if INFERENCE_BACKEND not in SUPPORTED_BACKENDS:
+    # Опечатка в настройке иначе всплыла бы только при первой загрузке модели
+    logger.error(f"❌ Неизвестный бэкенд INFERENCE_BACKEND={INFERENCE_BACKEND}, доступны: {', '.join(SUPPORTED_BACKENDS)}")
+    raise SystemExit(1)
+INFERENCE_INT8 = os.getenv("INFERENCE_INT8", "0") == "1"
+CALIBRATION_DIR = os.getenv("CALIBRATION_DIR")
+EXPORT_IMGSZ = int(os.getenv("EXPORT_IMGSZ", "640"))
 
 # Обновленный MODEL_MAP с поддержкой новых типов обработки
 MODEL_MAP = {
@@ -108,396 +207,659 @@ PROCESSING_TYPES = {
     'all_models': list(MODEL_MAP.keys()),
     'damage_only': [k for k in MODEL_MAP.keys() if 'damage' in k],
     'parts_only': [k for k in MODEL_MAP.keys() if 'parts' in k],
-    'damage_parts': ['auto_damage_united_with_third_part_yolo_model', 'auto_parts_full_dataset_1']
+    'damage_parts': ['auto_damage_united_with_third_part_yolo_model', 'auto_parts_full_dataset_1'],
+    # Каскад: детектор (первая модель) находит области, модели повреждений смотрят только их
+    'cascade': [
+        os.getenv("CASCADE_DETECTOR", "auto_parts_full_dataset_1"),
+        *[name.strip() for name in os.getenv(
+            "CASCADE_DAMAGE_MODELS",
+            "auto_damage_yolo_first_part_model,auto_damage_yolo_second_part_model,auto_damage_yolo_third_part_model"
+        ).split(",") if name.strip()]
+    ]
 }
 
+# Типы обработки с одним общим результатом на изображение: тип -> ключ результата
+COMPOSITE_KEYS = {'damage_parts': 'combined', 'cascade': 'cascade'}
+COMPOSITE_TYPES = {key: processing_type for processing_type, key in COMPOSITE_KEYS.items()}
+
+# Каскад: порог уверенности детектора для областей (не ниже conf запроса), расширение
+# найденных областей (доля стороны бокса), доля кадра, при которой
+# выгоднее смотреть кадр целиком, множитель разрешения кропов (>1 - мелкие повреждения
+# смотрятся крупнее) и минимальный размер входа для кропа
+CASCADE_REGION_CONF = float(os.getenv("CASCADE_REGION_CONF", "0.25"))
+CASCADE_PAD_RATIO = float(os.getenv("CASCADE_PAD_RATIO", "0.1"))
+CASCADE_FULL_FRAME_RATIO = float(os.getenv("CASCADE_FULL_FRAME_RATIO", "0.6"))
+CASCADE_CROP_SCALE = float(os.getenv("CASCADE_CROP_SCALE", "1.0"))
+CASCADE_MIN_IMGSZ = int(os.getenv("CASCADE_MIN_IMGSZ", "128"))
+
+# Потайловый режим (tile_size > 0 в запросе): изображение декодируется в исходном разрешении
+# (не больше TILE_MAX_IMAGE_SIZE), тайлы идут батчами по TILE_BATCH_SIZE, целый кадр
+# добавляется для крупных объектов, детекции разных тайлов склеиваются при IoS >= TILE_MERGE_IOS
+TILE_MAX_IMAGE_SIZE = int(os.getenv("TILE_MAX_IMAGE_SIZE", "4096"))
+TILE_BATCH_SIZE = int(os.getenv("TILE_BATCH_SIZE", "8"))
+TILE_FULL_FRAME = os.getenv("TILE_FULL_FRAME", "1") == "1"
+TILE_MERGE_IOS = float(os.getenv("TILE_MERGE_IOS", "0.5"))
+TILE_MAX_TILES = int(os.getenv("TILE_MAX_TILES", "256"))
+TILE_MIN_SIZE = 128
+TILE_MAX_OVERLAP = 0.5
+
+# Привязка повреждений к деталям (damage_parts): маски растеризуются на сетке
+# со стороной не больше ATTRIBUTION_MAX_SIDE клеток
+ATTRIBUTION_MAX_SIDE = int(os.getenv("ATTRIBUTION_MAX_SIDE", "256"))
+
+# Прогрев при старте: модели загружаются и прогоняют пробный кадр на каждом imgsz,
+# после чего воркер сообщает о готовности через /ready
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "1") == "1"
+WARMUP_IMGSZ = [int(value) for value in os.getenv("WARMUP_IMGSZ", "640").split(",") if value.strip()]
+# По умолчанию прогреваются все модели, а при ограниченном бюджете памяти - закрепленные
+WARMUP_MODELS = [name.strip() for name in os.getenv("WARMUP_MODELS", "").split(",") if name.strip()] or (
+    PINNED_MODELS if MODEL_MEMORY_BUDGET_BYTES > 0 else list(MODEL_MAP))
+WARMUP_STATE = {"status": "pending" if MODEL_WARMUP else "skipped", "models": {}, "seconds": None, "error": None}
+
+# Пул для одновременного запуска моделей одного запроса (по потоку на модель)
+MODEL_FANOUT_POOL = ThreadPoolExecutor(max_workers=len(MODEL_MAP) * (INFERENCE_WORKERS + INFERENCE_MAX_WAITING), thread_name_prefix='model')
+
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/tmp", StaticFiles(directory="tmp"), name="tmp")
 
 templates = Jinja2Templates(directory="templates")
 
+@app.on_event("shutdown")
+def shutdown_inference_executor():
+    for scheduler in BATCH_SCHEDULERS.values():
+        scheduler.stop()
+    INFERENCE_EXECUTOR.shutdown()
+    MODEL_FANOUT_POOL.shutdown(wait=False, cancel_futures=True)
+
+def submit_fanout(func, *args):
+    """Запускает func в пуле моделей в счет слота текущей задачи пула инференса"""
+    return MODEL_FANOUT_POOL.submit(INFERENCE_EXECUTOR.carry(func), *args)
+
+def wait_fanout(futures):
+    """Ждет потоки пула моделей; слот задачи отпускается, только когда все они ждут микробатч"""
+    with INFERENCE_EXECUTOR.paused():
+        wait(futures)
+
+def get_model_lock(model_name: str) -> threading.Lock:
+    """Возвращает блокировку для вызова конкретной модели"""
+    with MODEL_LOCKS_GUARD:
+        if model_name not in MODEL_LOCKS:
+            MODEL_LOCKS[model_name] = threading.Lock()
+        return MODEL_LOCKS[model_name]
+
+def model_path(model_name: str) -> Path:
+    return MODELS_DIR / MODEL_MAP[model_name]
+
 def load_model(model_name: str):
-    """Загружает модель из кэша или загружает новую"""
+    """Загружает модель из реестра или с диска (None при ошибке загрузки)"""
     try:
-        if model_name in MODEL_CACHE:
-            logger.info(f"📦 Модель {model_name} загружена из кэша")
-            return MODEL_CACHE[model_name]
-        
-        pt_file = BASE_DIR / "models_from_hub" / MODEL_MAP[model_name]
-        if not pt_file.exists():
-            logger.error(f"❌ Модель {model_name} не найдена по пути: {pt_file}")
-            logger.error(f"📂 Содержимое директории models_from_hub:")
-            models_dir = BASE_DIR / "models_from_hub"
-            if models_dir.exists():
-                for file in models_dir.iterdir():
-                    logger.error(f"   - {file.name}")
-            else:
-                logger.error(f"   Директория {models_dir} не существует")
-            raise FileNotFoundError(f"Файл модели {pt_file} не найден")
-        
-        logger.info(f"🔄 Загрузка модели {model_name}...")
-        start_time = time.time()
-        
-        # Принудительно используем CPU для сервера
-        device = 'cpu'
-        logger.info(f"💻 Используется устройство: {device}")
-        
-        model = YOLO(str(pt_file))
-        model.to(device)
-        
-        # Оптимизация модели для CPU
-        model.fuse()
-        
-        # Дополнительные оптимизации для CPU
-        model.eval()
-        
-        load_time = time.time() - start_time
-        logger.info(f"⚡ Модель {model_name} загружена за {load_time:.2f}с")
-        
-        MODEL_CACHE[model_name] = model
-        return model
-        
+        model = MODEL_REGISTRY.get(model_name)
+    except FileNotFoundError:
+        pt_file = model_path(model_name)
+        logger.error(f"❌ Модель {model_name} не найдена по пути: {pt_file}")
+        logger.error(f"📂 Содержимое директории {MODELS_DIR.name}:")
+        models_dir = MODELS_DIR
+        if models_dir.exists():
+            for file in models_dir.iterdir():
+                logger.error(f"   - {file.name}")
+        else:
+            logger.error(f"   Директория {models_dir} не существует")
+        return None
     except Exception as e:
         logger.error(f"❌ Ошибка загрузки модели {model_name}: {str(e)}")
         logger.error(f"📋 Трейсбек: {traceback.format_exc()}")
         return None
+    MODEL_CACHE_SIZE.set(len(MODEL_REGISTRY))
+    return model
 
-def optimize_image_size(image_path: Path, max_size: int = 512):
-    """Оптимизирует размер изображения для быстрой обработки на CPU"""
+def load_model_file(model_name: str, pt_file: Path):
+    """Загружает модель с диска через выбранный бэкенд (вызывается реестром)"""
+    logger.info(f"🔄 Загрузка модели {model_name}...")
+    start_time = time.time()
+    
+    # Принудительно используем CPU для сервера
+    logger.info(f"💻 Используется устройство: cpu, бэкенд: {INFERENCE_BACKEND}{' INT8' if INFERENCE_INT8 else ''}")
+    
+    model = load_backend_model(
+        pt_file,
+        INFERENCE_BACKEND,
+        export_dir=BASE_DIR / "models_exported",
+        imgsz=EXPORT_IMGSZ,
+        int8=INFERENCE_INT8,
+        calibration_dir=Path(CALIBRATION_DIR) if CALIBRATION_DIR else None
+    )
+    
+    logger.info(f"⚡ Модель {model_name} загружена за {time.time() - start_time:.2f}с")
+    return model
+
+MODEL_REGISTRY = ModelRegistry(load_model_file, model_path, model_weights_bytes,
+                               MODEL_MEMORY_BUDGET_BYTES, PINNED_MODELS)
+
+def preload_models(model_names: List[str] = None):
+    """Загружает модели заранее (в главном процессе prefork.py - до fork, чтобы воркеры делили веса)"""
+    for model_name in model_names or WARMUP_MODELS:
+        if load_model(model_name) is None:
+            raise RuntimeError(f"Не удалось загрузить модель {model_name}")
+
+def warmup_models():
+    """Загружает модели и прогоняет через каждую пробные кадры на всех WARMUP_IMGSZ.
+
+    Первый вызов модели создает предиктор ultralytics, а первый проход на новом
+    размере входа - ядра свертки под него; без прогрева это платит первый запрос.
+    Кадры повторяют форму реальных входов: фото 4:3 в обеих ориентациях после
+    уменьшения до MAX_IMAGE_SIZE.
+    """
+    WARMUP_STATE["status"] = "warming"
+    started = time.time()
+    short_side = MAX_IMAGE_SIZE * 3 // 4
+    frames = [np.full((short_side, MAX_IMAGE_SIZE, 3), 114, dtype=np.uint8),
+              np.full((MAX_IMAGE_SIZE, short_side, 3), 114, dtype=np.uint8)]
     try:
-        with Image.open(image_path) as img:
-            # Получаем размеры
-            width, height = img.size
-            
-            # Если изображение больше max_size, уменьшаем его
-            if max(width, height) > max_size:
-                # Вычисляем новые размеры с сохранением пропорций
-                if width > height:
-                    new_width = max_size
-                    new_height = int(height * max_size / width)
-                else:
-                    new_height = max_size
-                    new_width = int(width * max_size / height)
-                
-                # Изменяем размер
-                img_resized = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                
-                # Сохраняем с оптимизацией
-                img_resized.save(image_path, 'JPEG', quality=80, optimize=True)
-                
-                logger.info(f"🔧 Изображение {image_path.name} оптимизировано: {width}x{height} -> {new_width}x{new_height}")
-            else:
-                logger.info(f"🔧 Изображение {image_path.name} уже оптимального размера: {width}x{height}")
-                
+        for model_name in WARMUP_MODELS:
+            model_start = time.time()
+            if load_model(model_name) is None:
+                raise RuntimeError(f"Не удалось загрузить модель {model_name}")
+            for imgsz in WARMUP_IMGSZ:
+                for frame in frames:
+                    forward_model_batch(model_name, [frame], imgsz, 0.25, 0.45, CPU_THREADS)
+            WARMUP_STATE["models"][model_name] = round(time.time() - model_start, 3)
+            logger.info(f"🔥 Модель {model_name} прогрета за {time.time() - model_start:.2f}с (imgsz {WARMUP_IMGSZ})")
     except Exception as e:
-        logger.error(f"❌ Ошибка оптимизации изображения {image_path}: {str(e)}")
+        WARMUP_STATE["status"] = "failed"
+        WARMUP_STATE["error"] = str(e)
+        logger.error(f"❌ Ошибка прогрева моделей: {str(e)}")
+        logger.error(f"📋 Трейсбек: {traceback.format_exc()}")
+        return
+    WARMUP_STATE["seconds"] = round(time.time() - started, 3)
+    WARMUP_STATE["status"] = "ready"
+    logger.info(f"✅ Прогрев завершен за {WARMUP_STATE['seconds']:.2f}с, моделей: {len(WARMUP_MODELS)}")
+
+def init_worker(worker_id: int, workers: int, num_threads: int):
+    """Настройка процесса-воркера после fork: логирование и потоки torch"""
+    global WORKER_ID, CPU_THREADS
+    WORKER_ID = worker_id
+    # Поток записи логов не переживает fork - поднимаем очередь и слушателя заново
+    setup_logging()
+    CPU_THREADS = num_threads
+    import torch
+    torch.set_num_threads(num_threads)
+    logger.info(f"👷 Воркер {worker_id} (pid {os.getpid()}): {num_threads} потоков torch, моделей в памяти: {len(MODEL_REGISTRY)}")
 
 def extract_detection_data(result, model_name):
-    """Извлекает данные обнаружения из результата YOLO с масками сегментации"""
+    """Извлекает данные обнаружения из результата YOLO с масками сегментации (в колонках)"""
     try:
-        detections = []
-        
-        logger.info(f"🔍 Извлечение данных для модели {model_name}")
-        logger.info(f"📊 Результат имеет boxes: {hasattr(result, 'boxes')}")
-        
-        # Проверяем, что result - это объект Results (не список)
-        if hasattr(result, 'boxes') and result.boxes is not None:
-            boxes = result.boxes
-            logger.info(f"📦 Количество боксов: {len(boxes)}")
-            
-            if len(boxes) > 0:
-                # Безопасное получение данных с проверкой типа
-                try:
-                    # Проверяем, что это тензоры и безопасно конвертируем
-                    if hasattr(boxes.xyxy, 'cpu'):
-                        xyxy = boxes.xyxy.cpu().numpy()
-                    else:
-                        xyxy = boxes.xyxy.numpy()
-                    
-                    if hasattr(boxes.cls, 'cpu'):
-                        classes = boxes.cls.cpu().numpy()
-                    else:
-                        classes = boxes.cls.numpy()
-                    
-                    if hasattr(boxes.conf, 'cpu'):
-                        confidences = boxes.conf.cpu().numpy()
-                    else:
-                        confidences = boxes.conf.numpy()
-                    
-                    class_names = result.names
-                    
-                    # Получаем маски сегментации
-                    masks_xy = None
-                    masks_xyn = None
-                    if hasattr(result, 'masks') and result.masks is not None:
-                        # Получаем маски в формате полигонов (списки)
-                        masks_xy = result.masks.xy  # полигоны в пикселях
-                        masks_xyn = result.masks.xyn  # нормализованные полигоны
-                        logger.info(f"🎭 Найдены маски: {len(masks_xy) if masks_xy else 0} масок")
-                        if masks_xy and len(masks_xy) > 0:
-                            logger.info(f"🎭 Пример маски [0]: тип={type(masks_xy[0])}, длина={len(masks_xy[0]) if hasattr(masks_xy[0], '__len__') else 'N/A'}")
-                        if masks_xy and len(masks_xy) > 0:
-                            sample_mask = masks_xy[0]
-                            logger.info(f"🎭 Пример маски [0]: форма={sample_mask.shape if hasattr(sample_mask, 'shape') else 'N/A'}, первые 6 значений={sample_mask[:6] if hasattr(sample_mask, '__getitem__') else 'N/A'}")
-                    
-                    for i in range(len(boxes)):
-                        class_id = int(classes[i])
-                        # Получаем цвет для конкретного класса (как в YOLO)
-                        class_color = get_class_color(class_id)
-                        
-                        detection = {
-                            'bbox': [float(x) for x in xyxy[i].tolist()],
-                            'class_id': class_id,
-                            'class_name': str(class_names[class_id]),
-                            'confidence': float(confidences[i]),
-                            'model_color': list(class_color)  # Сохраняем цвет класса
-                        }
-                        
-                        logger.info(f"🎨 Класс {class_id} '{class_names[class_id]}' получил цвет {list(class_color)}")
-                        
-                        # Добавляем маски сегментации если есть
-                        if masks_xy is not None and i < len(masks_xy):
-                            # Конвертируем маски в списки float
-                            # masks_xy[i] - это numpy array с формой (N, 2) где каждая строка [x, y]
-                            mask_array = masks_xy[i]
-                            if hasattr(mask_array, 'tolist'):
-                                mask_list = mask_array.tolist()
-                            else:
-                                mask_list = list(mask_array)
-                            # Преобразуем [[x1,y1], [x2,y2], ...] в [x1,y1,x2,y2,...]
-                            detection['mask_polygon'] = [float(coord) for point in mask_list for coord in point]
-                            
-                            mask_norm_array = masks_xyn[i]
-                            if hasattr(mask_norm_array, 'tolist'):
-                                mask_norm_list = mask_norm_array.tolist()
-                            else:
-                                mask_norm_list = list(mask_norm_array)
-                            # Преобразуем [[x1,y1], [x2,y2], ...] в [x1,y1,x2,y2,...]
-                            detection['mask_polygon_normalized'] = [float(coord) for point in mask_norm_list for coord in point]
-                        
-                        detections.append(detection)
-                        
-                except Exception as e:
-                    logger.error(f"❌ Ошибка при обработке боксов для модели {model_name}: {str(e)}")
-                    logger.error(f"📋 Трейсбек: {traceback.format_exc()}")
-                    return []
-        
-        logger.info(f"✅ Извлечено {len(detections)} детекций для модели {model_name}")
-        if detections:
-            for i, det in enumerate(detections[:3]):  # Показываем первые 3
-                logger.info(f"  {i+1}. {det['class_name']} - {det['confidence']:.2f}")
-        
-        return detections
+        columns = extract_columns(result)
+        logger.debug(f"✅ Извлечено {columns['count']} детекций для модели {model_name}")
+        return columns
         
     except Exception as e:
         logger.error(f"❌ Общая ошибка в extract_detection_data для модели {model_name}: {str(e)}")
         logger.error(f"📋 Трейсбек: {traceback.format_exc()}")
-        return []
+        return empty_columns()
+
+def get_batch_scheduler(model_name: str) -> BatchScheduler:
+    """Возвращает планировщик микробатчей для модели (создается при первом обращении)"""
+    with MODEL_LOCKS_GUARD:
+        if model_name not in BATCH_SCHEDULERS:
+            BATCH_SCHEDULERS[model_name] = BatchScheduler(
+                model_name, forward_model_batch, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, INFERENCE_EXECUTOR.busy, CPU_THREADS
+            )
+        return BATCH_SCHEDULERS[model_name]
 
-def combine_detection_results(results_list):
-    """Объединяет результаты нескольких моделей на одном изображении с масками сегментации"""
+def run_model_batch(mn: str, images: list, imgsz: int, conf: float, iou: float, num_threads: int = None):
+    """Прогоняет батч изображений через модель и возвращает сырые результаты YOLO"""
+    if MICRO_BATCHING:
+        # Изображения объединяются с изображениями других запросов к этой же модели;
+        # пока батч собирается и считается, слот пула инференса свободен для них
+        with INFERENCE_EXECUTOR.paused():
+            return get_batch_scheduler(mn).submit(images, imgsz, conf, iou, num_threads)
+    return forward_model_batch(mn, images, imgsz, conf, iou, num_threads)
+
+def forward_model_batch(mn: str, images: list, imgsz: int, conf: float, iou: float, num_threads: int = None):
+    """Один forward-проход модели по батчу изображений"""
+    import torch
+    model = load_model(mn)
+    # Количество intra-op потоков задается для потока ОС и остается в нем после вызова,
+    # а потоки пулов переиспользуются: без разделения явно берем все ядра,
+    # а прежнее значение восстанавливаем
+    previous_threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads or CPU_THREADS)
     try:
-        if not results_list or len(results_list) == 0:
-            return None, []
-        
-        # Берем первое изображение как основу
-        first_result = results_list[0]
-        if not first_result:
-            return None, []
-        
-        # Получаем изображение из первого результата
-        combined_img = first_result.orig_img.copy()
-        
-        # Собираем все обнаружения
-        all_detections = []
-        
-        # Цвета для разных моделей
-        model_colors = {
-            'auto_damage_united_with_third_part_yolo_model': (0, 255, 0),  # Зеленый для повреждений
-            'auto_parts_full_dataset_1': (255, 0, 0)  # Красный для деталей
-        }
-        
-        for result_idx, result in enumerate(results_list):
-            if result is None:
-                continue
-                
-            # Проверяем, что result - это объект Results (не список)
-            if hasattr(result, 'boxes') and result.boxes is not None:
-                boxes = result.boxes
-                if len(boxes) > 0:
-                    try:
-                        # Безопасное получение данных с проверкой типа
-                        if hasattr(boxes.xyxy, 'cpu'):
-                            xyxy = boxes.xyxy.cpu().numpy()
-                        else:
-                            xyxy = boxes.xyxy.numpy()
-                        
-                        if hasattr(boxes.cls, 'cpu'):
-                            classes = boxes.cls.cpu().numpy()
-                        else:
-                            classes = boxes.cls.numpy()
-                        
-                        if hasattr(boxes.conf, 'cpu'):
-                            confidences = boxes.conf.cpu().numpy()
-                        else:
-                            confidences = boxes.conf.numpy()
-                        
-                        class_names = result.names
-                        
-                        # Получаем маски сегментации
-                        masks_xy = None
-                        if hasattr(result, 'masks') and result.masks is not None:
-                            masks_xy = result.masks.xy  # полигоны в пикселях
-                        
-                        for i in range(len(boxes)):
-                            class_id = int(classes[i])
-                            # Получаем цвет для конкретного класса (как в YOLO)
-                            class_color = get_class_color(class_id)
-                            
-                            detection = {
-                                'bbox': [float(x) for x in xyxy[i].tolist()],
-                                'class_id': class_id,
-                                'class_name': str(class_names[class_id]),
-                                'confidence': float(confidences[i]),
-                                'model_color': list(class_color)  # Сохраняем цвет класса
-                            }
-                            
-                            logger.info(f"🎨 Mix модель: Класс {class_id} '{class_names[class_id]}' получил цвет {list(class_color)}")
-                            
-                            # Добавляем маски сегментации если есть
-                            if masks_xy is not None and i < len(masks_xy):
-                                # Конвертируем маски в списки float
-                                # masks_xy[i] - это numpy array с формой (N, 2) где каждая строка [x, y]
-                                mask_array = masks_xy[i]
-                                if hasattr(mask_array, 'tolist'):
-                                    mask_list = mask_array.tolist()
-                                else:
-                                    mask_list = list(mask_array)
-                                # Преобразуем [[x1,y1], [x2,y2], ...] в [x1,y1,x2,y2,...]
-                                detection['mask_polygon'] = [float(coord) for point in mask_list for coord in point]
-                            
-                            all_detections.append(detection)
-                            
-                    except Exception as e:
-                        logger.error(f"❌ Ошибка при обработке боксов в combine_detection_results для result_idx {result_idx}: {str(e)}")
-                        logger.error(f"📋 Трейсбек: {traceback.format_exc()}")
-                        continue
-        
-        # Используем PIL для рисования текста с поддержкой кириллицы
-        from PIL import Image, ImageDraw, ImageFont
-        import numpy as np
-        
-        # Конвертируем OpenCV изображение в PIL
-        pil_img = Image.fromarray(cv2.cvtColor(combined_img, cv2.COLOR_BGR2RGB))
-        draw = ImageDraw.Draw(pil_img)
-        
-        # Пытаемся загрузить шрифт с поддержкой кириллицы
+        with get_model_lock(mn):
+            return model(images, conf=conf, iou=iou, imgsz=imgsz, verbose=False)
+    finally:
+        torch.set_num_threads(previous_threads)
+
+def run_tiled_batch(mn: str, images: List[TiledImage], imgsz: int, conf: float, iou: float, num_threads: int = None) -> list:
+    """Прогоняет тайлы всех изображений и возвращает по изображению список колонок его тайлов.
+
+    Тайлы одной формы со всех изображений идут общими батчами (прямоугольный вход),
+    мимо микробатчинга: запрос сам набирает полные батчи. Детекции извлекаются сразу
+    после каждого батча: результаты YOLO с масками всех тайлов не помещаются в память.
+    """
+    groups = {}
+    for image_index, tiled in enumerate(images):
+        for source_index, source in enumerate(tiled.sources()):
+            groups.setdefault(source.shape[:2], []).append((image_index, source_index, source))
+    results = [[None] * len(tiled.offsets()) for tiled in images]
+    for group in groups.values():
+        for start in range(0, len(group), TILE_BATCH_SIZE):
+            chunk = group[start:start + TILE_BATCH_SIZE]
+            chunk_results = forward_model_batch(mn, [source for _, _, source in chunk], imgsz, conf, iou, num_threads)
+            for (image_index, source_index, _), result in zip(chunk, chunk_results):
+                results[image_index][source_index] = extract_detection_data(result, mn)
+    return results
+
+def detect_batch(mn: str, images: list, imgsz: int, conf: float, iou: float, num_threads: int = None) -> list:
+    """Сырые результаты модели по изображениям (для TiledImage - списки колонок тайлов)"""
+    if images and isinstance(images[0], TiledImage):
+        return run_tiled_batch(mn, images, imgsz, conf, iou, num_threads)
+    return run_model_batch(mn, images, imgsz, conf, iou, num_threads)
+
+def extract_batch(mn: str, images: list, results: list) -> list:
+    """Колонки детекций по изображениям; детекции тайлов склеиваются в координатах изображения"""
+    if images and isinstance(images[0], TiledImage):
+        return [
+            merge_tile_columns(tiled, tile_columns, TILE_MERGE_IOS)
+            for tiled, tile_columns in zip(images, results)
+        ]
+    return [extract_detection_data(result, mn) for result in results]
+
+def run_model_inference(mn: str, images: list, filenames: List[str], imgsz: int, conf: float, iou: float, num_threads: int = None):
+    """Инференс одной модели на переданных изображениях (выполняется в пуле инференса).
+
+    Возвращает колонки детекций в порядке изображений и время этапов.
+    """
+    model_start = time.time()
+    logger.debug(f"🔍 {mn}: начало инференса...")
+    
+    results = detect_batch(mn, images, imgsz, conf, iou, num_threads)
+    inference_time = time.time() - model_start
+    logger.info(f"⚡ Модель {mn}: инференс за {inference_time:.2f}с ({inference_time/len(images):.2f}с на изображение)")
+    
+    # Сохраняем результаты
+    save_start = time.time()
+    # results - по объекту Results (или списку колонок тайлов) на изображение
+    detections_list = extract_batch(mn, images, results)
+    
+    for original_filename, detections in zip(filenames, detections_list):
+        if detections['count']:
+            logger.debug(f"💾 Извлечено {detections['count']} детекций для {original_filename} модель {mn}")
+        else:
+            logger.debug(f"⚠️ Нет детекций для {original_filename} модель {mn}")
+    
+    save_time = time.time() - save_start
+    model_time = time.time() - model_start
+    logger.info(f"✅ Модель {mn}: инференс {inference_time:.2f}с, сохранение {save_time:.2f}с, всего {model_time:.2f}с")
+    INFERENCE_SECONDS.labels(mn).observe(inference_time)
+    EXTRACTION_SECONDS.labels(mn).observe(save_time)
+    IMAGES.labels(mn).inc(len(images))
+    DETECTIONS.labels(mn).inc(sum(detections['count'] for detections in detections_list))
+    
+    timings = {
+        "inference": round(inference_time, 4),
+        "extraction": round(save_time, 4),
+        "total": round(model_time, 4),
+        "threads": num_threads or CPU_THREADS
+    }
+    if images and isinstance(images[0], TiledImage):
+        timings["tiles"] = sum(len(tiled.offsets()) for tiled in images)
+    return detections_list, timings
+
+def run_models_parallel(batches: Dict[str, tuple], imgsz: int, conf: float, iou: float) -> dict:
+    """Запускает несколько моделей одновременно, каждую на своем батче (images, filenames).
+
+    Ядра CPU делятся поровну между моделями, поэтому время запроса стремится
+    к времени самой медленной модели, а не к сумме всех.
+    """
+    threads_per_model = max(1, CPU_THREADS // len(batches))
+    logger.info(f"🔀 Параллельный запуск {len(batches)} моделей по {threads_per_model} потоков")
+    
+    futures = {
+        mn: submit_fanout(
+            run_model_inference, mn, images, filenames, imgsz, conf, iou, threads_per_model
+        )
+        for mn, (images, filenames) in batches.items()
+    }
+    wait_fanout(futures.values())
+    
+    outputs = {}
+    for mn, future in futures.items():
         try:
-            # Попробуем найти системный шрифт
-            font = ImageFont.truetype("arial.ttf", 16)
-        except:
-            try:
-                # Альтернативный шрифт
-                font = ImageFont.truetype("DejaVuSans.ttf", 16)
-            except:
-                # Используем стандартный шрифт
-                font = ImageFont.load_default()
-        
-        # Рисуем все обнаружения
-        for detection in all_detections:
-            bbox = detection['bbox']
-            x1, y1, x2, y2 = map(int, bbox)
-            
-            # Используем цвет модели
-            color = detection.get('model_color', (0, 255, 0))
-            
-            # Если есть маска сегментации, рисуем её
-            if 'mask_polygon' in detection:
-                mask_polygon = detection['mask_polygon']
-                if len(mask_polygon) > 0:
-                    # Конвертируем полигон в формат для PIL
-                    polygon_points = []
-                    for j in range(0, len(mask_polygon), 2):
-                        if j + 1 < len(mask_polygon):
-                            polygon_points.append((mask_polygon[j], mask_polygon[j + 1]))
-                    
-                    if len(polygon_points) > 2:
-                        # Рисуем заливку маски с прозрачностью
-                        # Создаем временное изображение для маски
-                        mask_img = Image.new('RGBA', pil_img.size, (0, 0, 0, 0))
-                        mask_draw = ImageDraw.Draw(mask_img)
-                        
-                        # Рисуем полигон с прозрачностью
-                        mask_draw.polygon(polygon_points, fill=(color[0], color[1], color[2], 76))  # 30% прозрачность
-                        
-                        # Накладываем маску на основное изображение
-                        pil_img = Image.alpha_composite(pil_img.convert('RGBA'), mask_img).convert('RGB')
-                        draw = ImageDraw.Draw(pil_img)
-            
-            # Рисуем границу
-            draw.rectangle([x1, y1, x2, y2], outline=color, width=2)
-            
-            # Добавляем текст с классом и уверенностью
-            label = f"{detection['class_name']} {detection['confidence']:.2f}"
-            
-            # Получаем размер текста
-            bbox_text = draw.textbbox((0, 0), label, font=font)
-            text_width = bbox_text[2] - bbox_text[0]
-            text_height = bbox_text[3] - bbox_text[1]
-            
-            # Позиционируем текст так, чтобы он всегда был виден
-            text_x = x1
-            text_y = y1 - text_height - 5
-            
-            # Если текст выходит за границы изображения, перемещаем его
-            img_width, img_height = pil_img.size
-            if text_y < 0:
-                text_y = y2 + 5  # Помещаем текст под объект
-            if text_x + text_width > img_width:
-                text_x = img_width - text_width - 5
-            if text_x < 0:
-                text_x = 5
-            
-            # Рисуем фон для текста
-            draw.rectangle([text_x, text_y, text_x + text_width + 5, text_y + text_height + 5], fill=color)
-            
-            # Рисуем текст
-            draw.text((text_x + 2, text_y + 2), label, fill=(0, 0, 0), font=font)
-        
-        # Конвертируем обратно в OpenCV формат
-        combined_img = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
-        
-        return combined_img, all_detections
-        
-    except Exception as e:
-        logger.error(f"❌ Общая ошибка в combine_detection_results: {str(e)}")
-        logger.error(f"📋 Трейсбек: {traceback.format_exc()}")
-        return None, []
+            outputs[mn] = future.result()
+        except Exception as e:
+            logger.error(f"❌ Ошибка модели {mn}: {str(e)}")
+            logger.error(f"📋 Трейсбек: {traceback.format_exc()}")
+            ERRORS.labels(mn).inc()
+            outputs[mn] = e
+    return outputs
 
-@app.get("/")
-async def read_root(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+def run_damage_parts_batch(images: list, imgsz: int, conf: float, iou: float):
+    """Прогоняет весь батч через модели повреждений и деталей одновременно и объединяет результаты по изображениям.
 
-@app.post("/process")
-async def process_images(
-    files: list[UploadFile] = File(...),
-    model_name: str = Form(...),
-    imgsz: int = Form(...),
-    conf: float = Form(...),
-    iou: float = Form(...)
-):
-    request_start = time.time()
-    logger.info(f"🚀 НАЧАЛО ОБРАБОТКИ: {len(files)} файлов, imgsz={imgsz}, conf={conf}, iou={iou}")
-    logger.info(f"📋 Детали запроса:")
-    logger.info(f"  - model_name: {model_name}")
-    logger.info(f"  - imgsz: {imgsz} (тип: {type(imgsz)})")
-    logger.info(f"  - conf: {conf} (тип: {type(conf)})")
-    logger.info(f"  - iou: {iou} (тип: {type(iou)})")
+    К общему результату добавляется привязка повреждений к деталям (ATTRIBUTION_KEY).
+    """
+    damage_model, parts_model = PROCESSING_TYPES['damage_parts']
+    threads_per_model = max(1, CPU_THREADS // 2)
+    
+    batch_start = time.time()
+    damage_future = submit_fanout(detect_batch, damage_model, images, imgsz, conf, iou, threads_per_model)
+    parts_future = submit_fanout(detect_batch, parts_model, images, imgsz, conf, iou, threads_per_model)
+    wait_fanout([damage_future, parts_future])
+    damage_results = damage_future.result()
+    parts_results = parts_future.result()
+    inference_time = time.time() - batch_start
+    logger.info(f"⚡ Повреждения + детали: инференс {len(images)} изображений за {inference_time:.2f}с")
+    
+    # Объединяем результаты попарно для каждого изображения
+    merge_start = time.time()
+    damage_columns = extract_batch(damage_model, images, damage_results)
+    parts_columns = extract_batch(parts_model, images, parts_results)
+    combined = [concat_columns([damage, parts]) for damage, parts in zip(damage_columns, parts_columns)]
+    merge_time = time.time() - merge_start
+    
+    attribution_start = time.time()
+    for columns, damage, parts in zip(combined, damage_columns, parts_columns):
+        try:
+            columns[ATTRIBUTION_KEY] = attribute_damages(damage, parts, ATTRIBUTION_MAX_SIDE)
+        except Exception as e:
+            logger.error(f"❌ Ошибка привязки повреждений к деталям: {str(e)}")
+            logger.error(f"📋 Трейсбек: {traceback.format_exc()}")
+    attribution_time = time.time() - attribution_start
+    logger.debug(f"🧩 Привязка повреждений к деталям: {attribution_time:.3f}с")
+    INFERENCE_SECONDS.labels('combined').observe(inference_time)
+    EXTRACTION_SECONDS.labels('combined').observe(merge_time)
+    IMAGES.labels('combined').inc(len(images))
+    DETECTIONS.labels('combined').inc(sum(columns['count'] for columns in combined))
+    
+    timings = {
+        "inference": round(inference_time, 4),
+        "extraction": round(merge_time, 4),
+        "attribution": round(attribution_time, 4),
+        "total": round(time.time() - batch_start, 4),
+        "threads": threads_per_model
+    }
+    return combined, timings
 
-    for i, file in enumerate(files):
-        logger.info(f"  - файл {i+1}: {file.filename} ({file.content_type}, {file.size} байт)")
+def run_cascade_batch(images: list, imgsz: int, conf: float, iou: float):
+    """Каскад: детектор по целым кадрам, затем модели повреждений только по кропам найденных областей.
 
+    Кропы одной формы со всех изображений батча идут одним forward-проходом с прямоугольным
+    входом без дополнения, размер выбирается по кропу так, чтобы масштаб пикселей
+    совпадал с целым кадром.
+    Детекции кропов переводятся в координаты изображения и объединяются с детекциями
+    детектора.
+    """
+    detector, *damage_models = PROCESSING_TYPES['cascade']
+    batch_start = time.time()
+    detector_results = run_model_batch(detector, images, imgsz, conf, iou, CPU_THREADS)
+    detector_columns = [extract_detection_data(result, detector) for result in detector_results]
+    detector_time = time.time() - batch_start
+    
+    # Кропы всех изображений группируются по размеру входа и форме: ultralytics подает батч
+    # прямоугольным входом, только если все изображения в нем одного размера
+    groups = {}
+    crops_count = 0
+    full_frames = 0
+    input_pixels = sum(letterbox_pixels(image.shape[1], image.shape[0], imgsz) for image in images)
+    full_frame_pixels = input_pixels
+    region_conf = max(conf, CASCADE_REGION_CONF)
+    for image_index, (image, columns) in enumerate(zip(images, detector_columns)):
+        height, width = image.shape[:2]
+        boxes = [box for box, score in zip(columns['bbox'], columns['confidence']) if score >= region_conf]
+        crops = plan_crops(boxes, width, height, imgsz, CASCADE_PAD_RATIO,
+                           CASCADE_FULL_FRAME_RATIO, CASCADE_CROP_SCALE, CASCADE_MIN_IMGSZ)
+        if len(crops) == 1 and crops[0][:4] == (0, 0, width, height):
+            full_frames += 1
+        full_frame_pixels += letterbox_pixels(width, height, imgsz) * len(damage_models)
+        for x0, y0, x1, y1, crop_size in crops:
+            input_pixels += letterbox_pixels(x1 - x0, y1 - y0, crop_size) * len(damage_models)
+            groups.setdefault((crop_size, y1 - y0, x1 - x0), []).append((image_index, x0, y0, image[y0:y1, x0:x1]))
+            crops_count += 1
+    
+    def run_damage_model(mn: str, num_threads: int) -> list:
+        # Кропы идут мимо микробатчинга: планировщик собирает батч только по imgsz/conf/iou
+        # и смешал бы кропы разной формы в один квадратный вход
+        found = [[] for _ in images]
+        for (crop_size, _, _), crops in groups.items():
+            for start in range(0, len(crops), BATCH_MAX_SIZE):
+                chunk = crops[start:start + BATCH_MAX_SIZE]
+                results = forward_model_batch(mn, [crop for _, _, _, crop in chunk], crop_size, conf, iou, num_threads)
+                for (image_index, x0, y0, _), result in zip(chunk, results):
+                    height, width = images[image_index].shape[:2]
+                    found[image_index].append(offset_columns(extract_detection_data(result, mn), x0, y0, width, height))
+        return found
+    
+    damage_start = time.time()
+    threads_per_model = max(1, CPU_THREADS // len(damage_models))
+    futures = [submit_fanout(run_damage_model, mn, threads_per_model) for mn in damage_models]
+    wait_fanout(futures)
+    damage_found = [future.result() for future in futures]
+    inference_time = time.time() - batch_start
+    logger.info(f"⚡ Каскад: {len(images)} изображений, {crops_count} кропов ({full_frames} целых кадров), "
+                f"детектор {detector_time:.2f}с, повреждения {time.time() - damage_start:.2f}с, "
+                f"вход {input_pixels / full_frame_pixels:.0%} от целых кадров")
+    
+    merge_start = time.time()
+    combined = [
+        concat_columns([columns] + [part for found in damage_found for part in found[image_index]])
+        for image_index, columns in enumerate(detector_columns)
+    ]
+    merge_time = time.time() - merge_start
+    INFERENCE_SECONDS.labels('cascade').observe(inference_time)
+    EXTRACTION_SECONDS.labels('cascade').observe(merge_time)
+    IMAGES.labels('cascade').inc(len(images))
+    DETECTIONS.labels('cascade').inc(sum(columns['count'] for columns in combined))
+    
+    timings = {
+        "inference": round(inference_time, 4),
+        "extraction": round(merge_time, 4),
+        "total": round(time.time() - batch_start, 4),
+        "threads": threads_per_model,
+        "detector": round(detector_time, 4),
+        "crops": crops_count,
+        "full_frames": full_frames,
+        # Площадь входов всех моделей каскада и те же модели по целым кадрам (мера вычислений)
+        "input_pixels": input_pixels,
+        "full_frame_pixels": full_frame_pixels
+    }
+    return combined, timings
+
+# Обработчики составных типов: ключ результата -> функция (изображения, imgsz, conf, iou)
+COMPOSITE_RUNNERS = {'combined': run_damage_parts_batch, 'cascade': run_cascade_batch}
+
+def run_models_streaming(jobs: Dict[str, list], decoded: dict, filenames: List[str],
+                         imgsz: int, conf: float, iou: float, parallel: bool, emit,
+                         cancel_event: threading.Event = None):
+    """Прогоняет модели по частям и отдает результаты через emit по мере готовности.
+
+    jobs - индексы изображений для каждой модели или составного типа (COMPOSITE_RUNNERS).
+    emit(kind, key, indices, payload) вызывается из рабочих потоков.
+    cancel_event проверяется перед каждой частью: отмена не прерывает уже идущий forward.
+    """
+    threads_per_model = max(1, CPU_THREADS // len(jobs)) if parallel and len(jobs) > 1 else None
+    
+    def run_job(key: str, indices: list):
+        try:
+            for start in range(0, len(indices), STREAM_CHUNK_SIZE):
+                if cancel_event is not None and cancel_event.is_set():
+                    emit('cancelled', key, None, None)
+                    return
+                chunk = indices[start:start + STREAM_CHUNK_SIZE]
+                images = [decoded[i][0] for i in chunk]
+                if key in COMPOSITE_RUNNERS:
+                    output = COMPOSITE_RUNNERS[key](images, imgsz, conf, iou)
+                else:
+                    output = run_model_inference(key, images, [filenames[i] for i in chunk], imgsz, conf, iou, threads_per_model)
+                emit('result', key, chunk, output)
+            emit('model_done', key, None, None)
+        except Exception as e:
+            logger.error(f"❌ Ошибка модели {key}: {str(e)}")
+            logger.error(f"📋 Трейсбек: {traceback.format_exc()}")
+            ERRORS.labels(key).inc()
+            emit('error', key, None, e)
+    
+    if threads_per_model:
+        futures = [submit_fanout(run_job, key, indices) for key, indices in jobs.items()]
+        wait_fanout(futures)
+        for future in futures:
+            future.result()
+    else:
+        for key, indices in jobs.items():
+            run_job(key, indices)
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора до завершения
+BACKGROUND_TASKS = set()
+
+def run_in_background(coro):
+    """Запускает корутину в фоне, не дожидаясь ее завершения"""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+def release_session(session_id: str):
+    """Освобождает сессию после обработки; при превышении квоты сразу запускает очистку"""
+    def release():
+        SESSION_STORE.release(session_id)
+        if SESSION_STORE.over_quota():
+            SESSION_STORE.evict()
+        TMP_DISK_BYTES.set(tmp_disk_usage())
+    run_in_background(asyncio.to_thread(release))
+
+def log_request_record(record: dict):
+    """Пишет одну структурированную запись (JSON lines) об итогах запроса"""
+    record = {"timestamp": datetime.now().isoformat(timespec='milliseconds'), **record}
+    request_logger.info(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+
+def model_version(model_key: str) -> str:
+    """Версия весов модели для ключа кэша: при замене .pt старые результаты не используются"""
+    names = PROCESSING_TYPES[COMPOSITE_TYPES[model_key]] if model_key in COMPOSITE_TYPES else [model_key]
+    # Версия загруженных весов, а не файла: пока новая версия не подменила старую, ключ прежний
+    version = '-'.join(MODEL_REGISTRY.version(name) for name in names)
+    if model_key == 'cascade':
+        # Результат каскада зависит и от его настроек
+        version += f"-{CASCADE_REGION_CONF}-{CASCADE_PAD_RATIO}-{CASCADE_FULL_FRAME_RATIO}-{CASCADE_CROP_SCALE}-{CASCADE_MIN_IMGSZ}"
+    return version
+
+def result_cache_key(content_hash: str, model_key: str, imgsz: int, conf: float, iou: float, tiling: tuple = None) -> str:
+    """Ключ кэша: содержимое изображения + модель + параметры инференса"""
+    backend = f"{INFERENCE_BACKEND}{'-int8' if INFERENCE_INT8 else ''}"
+    # В кэше лежат колонки детекций, формат ответа к ключу не относится
+    key = f"{content_hash}:{model_key}:columns:{model_version(model_key)}:{backend}:{MAX_IMAGE_SIZE}:{imgsz}:{conf}:{iou}"
+    if tiling:
+        tile_size, tile_overlap = tiling
+        key += f":tiles-{tile_size}-{tile_overlap}-{TILE_MAX_IMAGE_SIZE}-{int(TILE_FULL_FRAME)}-{TILE_MERGE_IOS}"
+    if model_key == COMPOSITE_KEYS['damage_parts']:
+        # Привязка повреждений к деталям хранится в тех же колонках: записи без нее
+        # или посчитанные на другой сетке не должны попадать в ответ
+        key += f":attribution-{ATTRIBUTION_VERSION}-{ATTRIBUTION_MAX_SIDE}"
+    return key
+
+def display_cache_key(content_hash: str) -> str:
+    """Ключ кэша для копии изображения, которая показывается в браузере"""
+    return f"{content_hash}:display:{MAX_IMAGE_SIZE}"
+
+def lookup_cached_results(content_hashes: List[str], model_keys: List[str], imgsz: int, conf: float, iou: float,
+                          tiling: tuple = None):
+    """Ищет в кэше готовые детекции и копии для отображения"""
+    cached_detections = {}
+    cached_display = {}
+    if RESULT_CACHE is None:
+        return cached_detections, cached_display
+    for i, content_hash in enumerate(content_hashes):
+        for model_key in model_keys:
+            detections = RESULT_CACHE.get_json(result_cache_key(content_hash, model_key, imgsz, conf, iou, tiling))
+            if detections is not None:
+                cached_detections[(i, model_key)] = detections
+        display = RESULT_CACHE.get_bytes(display_cache_key(content_hash))
+        if display is not None:
+            cached_display[i] = display
+    return cached_detections, cached_display
+
+def cache_new_detections(new_detections: dict, content_hashes: List[str], imgsz: int, conf: float, iou: float,
+                         tiling: tuple = None):
+    """Кладет посчитанные в запросе детекции в кэш (в фоне, ответ их не ждет)"""
+    if RESULT_CACHE is None or not new_detections:
+        return
+    run_in_background(asyncio.to_thread(lambda: [
+        RESULT_CACHE.put_json(result_cache_key(content_hashes[i], key, imgsz, conf, iou, tiling), detections)
+        for (i, key), detections in new_detections.items()
+    ]))
+
+def store_display_image(image_path: Path, image: np.ndarray, changed: bool, content_hash: str):
+    """Сохраняет копию для отображения и кладет ее в кэш"""
+    written = persist_image(image_path, image, changed)
+    if RESULT_CACHE is not None:
+        RESULT_CACHE.put_bytes(display_cache_key(content_hash), written)
+
+# Файл сессии с колонками детекций по изображениям и моделям
+SESSION_DETECTIONS_FILE = ".detections.json"
+
+def render_path(session_id: str, filename: str, model_key: str) -> str:
+    """Ссылка на отрисовку детекций модели поверх изображения"""
+    return f"/render/{session_id}/{quote(filename)}?models={quote(model_key)}"
+
+def write_session_detections(session_dir: Path, detections_all: dict):
+    """Сохраняет колонки детекций сессии для /render"""
+    (session_dir / SESSION_DETECTIONS_FILE).write_text(
+        json.dumps(detections_all, ensure_ascii=False, separators=(',', ':')), encoding='utf-8'
+    )
+
+def split_session_attribution(detections_all: dict) -> tuple:
+    """Детекции без привязки повреждений к деталям и сама привязка по файлам (исходные словари не меняются)"""
+    detections, attribution = {}, {}
+    for filename, models_data in detections_all.items():
+        detections[filename] = {}
+        for key, columns in models_data.items():
+            detections[filename][key], found = split_attribution(columns)
+            if found is not None:
+                attribution[filename] = found
+    return detections, attribution
+
+def render_session_image(session_dir: Path, filename: str, model_keys: List[str], render_format: str) -> bytes:
+    """Отрисовывает детекции выбранных моделей поверх изображения сессии"""
+    manifest_path = session_dir / SESSION_DETECTIONS_FILE
+    manifest = json.loads(manifest_path.read_text(encoding='utf-8')) if manifest_path.exists() else {}
+    file_detections = manifest.get(filename, {})
+    image = cv2.imread(str(session_dir / filename))
+    if image is None:
+        raise ValueError(f"Не удалось прочитать изображение {filename}")
+    
+    # Модели без детекций в файл сессии не попадают, для них рисовать нечего
+    columns = concat_columns([file_detections[key] for key in model_keys if key in file_detections])
+    return encode_render(render_overlay(image, columns), render_format)
+
+# Готовые отрисовки хранятся в самой сессии: удаляются вместе с ней и учитываются в квоте tmp
+SESSION_RENDER_PREFIX = ".render."
+
+def session_render_path(session_dir: Path, filename: str, model_keys: List[str], render_format: str) -> Path:
+    """Файл отрисовки в сессии; после перезаписи детекций (обработка еще шла) имя меняется"""
+    manifest_path = session_dir / SESSION_DETECTIONS_FILE
+    version = manifest_path.stat().st_mtime_ns if manifest_path.exists() else 0
+    digest = hash_contents(f"{filename}:{','.join(model_keys)}:{version}".encode('utf-8'))
+    return session_dir / f"{SESSION_RENDER_PREFIX}{digest}{RENDER_FORMATS[render_format][0]}"
+
+def read_session_render(path: Path):
+    try:
+        return path.read_bytes()
+    except FileNotFoundError:
+        return None
+
+def save_session_render(session_id: str, path: Path, body: bytes):
+    """Сохраняет отрисовку в сессию (если сессия еще существует)"""
+    # Запись через временный файл: параллельный запрос не прочитает файл наполовину
+    temp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}")
+    try:
+        temp_path.write_bytes(body)
+        os.replace(temp_path, path)
+    except FileNotFoundError:
+        return
+    SESSION_STORE.refresh(session_id)
+
+def resolve_request_models(model_name: str, response_format: str, mask_encoding: str, mask_tolerance: float):
+    """Проверяет параметры запроса и возвращает список моделей или ответ с ошибкой"""
     # Определяем какие модели использовать
     if model_name in PROCESSING_TYPES:
         model_names = PROCESSING_TYPES[model_name]
@@ -509,161 +871,351 @@ async def process_images(
 
     if not model_names:
         logger.error(f"❌ Неизвестный тип обработки или модель: {model_name}")
-        return JSONResponse(
+        # Произвольные имена не попадают в метки, чтобы не раздувать число серий
+        REQUESTS.labels('unknown', '400').inc()
+        return None, JSONResponse(
             status_code=400,
             content={"error": f"Неизвестный тип обработки: {model_name}"}
         )
 
+    if response_format not in RESPONSE_FORMATS:
+        logger.error(f"❌ Неизвестный формат ответа: {response_format}")
+        REQUESTS.labels(model_name, '400').inc()
+        return None, JSONResponse(
+            status_code=400,
+            content={"error": f"Неизвестный формат ответа: {response_format}, доступны: {', '.join(RESPONSE_FORMATS)}"}
+        )
+
+    if mask_encoding not in MASK_ENCODINGS or mask_tolerance < 0:
+        logger.error(f"❌ Неверная кодировка масок: {mask_encoding}, допуск {mask_tolerance}")
+        REQUESTS.labels(model_name, '400').inc()
+        return None, JSONResponse(
+            status_code=400,
+            content={"error": f"Неверная кодировка масок: {mask_encoding} (доступны: {', '.join(MASK_ENCODINGS)}), допуск должен быть >= 0"}
+        )
+
+    return model_names, None
+
+def resolve_tiling(model_name: str, tile_size: int, tile_overlap: float):
+    """Проверяет параметры потайлового режима. Возвращает (tile_size, tile_overlap) или None и ответ с ошибкой"""
+    if not tile_size:
+        return None, None
+    error = None
+    if model_name == 'cascade':
+        error = "Потайловый режим недоступен для каскада: он сам выбирает области изображения"
+    elif tile_size < TILE_MIN_SIZE:
+        error = f"tile_size должен быть 0 (без тайлов) или не меньше {TILE_MIN_SIZE}"
+    elif not 0 <= tile_overlap <= TILE_MAX_OVERLAP:
+        error = f"tile_overlap должен быть от 0 до {TILE_MAX_OVERLAP}"
+    if error is not None:
+        logger.error(f"❌ {error}")
+        REQUESTS.labels(model_name, '400').inc()
+        return None, JSONResponse(status_code=400, content={"error": error})
+    return (tile_size, tile_overlap), None
+
+def decode_tiled_upload(path: Path, name: str, tiling: tuple):
+    """Копия для отображения и изображение в исходном разрешении, разбитое на тайлы (файл декодируется один раз)"""
+    (display, changed), image = decode_upload_full(path, name, MAX_IMAGE_SIZE, TILE_MAX_IMAGE_SIZE)
+    tile_size, tile_overlap = tiling
+    tiled = TiledImage(image, (display.shape[1], display.shape[0]), tile_size, tile_overlap, TILE_FULL_FRAME)
+    if len(tiled.tiles) > TILE_MAX_TILES:
+        raise ValueError(f"Изображение {name} делится на {len(tiled.tiles)} тайлов, допустимо не больше "
+                         f"{TILE_MAX_TILES}: увеличьте tile_size")
+    return (display, changed), tiled
+
+async def save_request_uploads(files: List[UploadFile], session_dir: Path, stage_timings: dict):
+    """Копирует файлы запроса в сессию частями с проверкой лимитов (UploadTooLarge).
+
+    Возвращает очищенные уникальные имена файлов и хэши содержимого.
+    """
+    stage_start = time.time()
+    logger.info(f"💾 Начинаю чтение {len(files)} файлов...")
+    filenames, content_hashes = await save_uploads(
+        files, session_dir, MAX_UPLOAD_FILE_BYTES, MAX_UPLOAD_REQUEST_BYTES
+    )
+    stage_timings['read'] = time.time() - stage_start
+    UPLOAD_READ_SECONDS.observe(stage_timings['read'])
+    return filenames, content_hashes
+
+async def prepare_saved_uploads(filenames: List[str], content_hashes: List[str], session_dir: Path,
+                                model_keys: List[str], imgsz: int, conf: float, iou: float, stage_timings: dict,
+                                tiling: tuple = None):
+    """Ищет готовые результаты в кэше, декодирует нужные изображения с диска
+    и запускает подготовку копий для отображения.
+
+    Возвращает найденные в кэше детекции, индексы для инференса по моделям,
+    декодированные изображения и задачи сохранения. ValueError - битый файл.
+    В потайловом режиме (tiling) изображения для инференса - TiledImage в исходном разрешении.
+    """
+    # Ищем готовые результаты по хэшу содержимого
+    stage_start = time.time()
+    cached_detections, cached_display = await asyncio.to_thread(
+        lookup_cached_results, content_hashes, model_keys, imgsz, conf, iou, tiling
+    )
+    pending = {
+        key: [i for i in range(len(filenames)) if (i, key) not in cached_detections]
+        for key in model_keys
+    }
+    CACHE_HITS.inc(len(cached_detections))
+    if cached_detections:
+        logger.info(f"🗄️ Из кэша: {len(cached_detections)} из {len(filenames) * len(model_keys)} результатов")
+    stage_timings['cache_lookup'] = time.time() - stage_start
+    
+    # Декодируем только то, что нужно для инференса или для копии на отображение.
+    # Файлы читаются с диска в пуле, в памяти остаются только уменьшенные изображения
+    to_infer = {i for indices in pending.values() for i in indices}
+    to_decode = sorted(to_infer | (set(range(len(filenames))) - set(cached_display)))
+    stage_start = time.time()
+    decoded_list = await asyncio.gather(*(
+        INFERENCE_EXECUTOR.run(decode_tiled_upload, session_dir / filenames[i], filenames[i], tiling)
+        if tiling and i in to_infer else
+        INFERENCE_EXECUTOR.run(decode_upload, session_dir / filenames[i], filenames[i], MAX_IMAGE_SIZE)
+        for i in to_decode
+    ))
+    decoded = dict(zip(to_decode, decoded_list))
+    # Исходное разрешение читается до того, как копия для отображения заменит оригинал
+    tiled_images = {}
+    if tiling:
+        for i in to_infer:
+            decoded[i], tiled_images[i] = decoded[i]
+    stage_timings['decode'] = time.time() - stage_start
+    DECODE_SECONDS.observe(stage_timings['decode'])
+    
+    # Копии для отображения заменяют оригиналы параллельно с инференсом и не занимают слоты пула
+    persist_tasks = []
+    for i, filename in enumerate(filenames):
+        if i in cached_display:
+            persist_tasks.append(asyncio.create_task(asyncio.to_thread((session_dir / filename).write_bytes, cached_display[i])))
+        else:
+            image, changed = decoded[i]
+            persist_tasks.append(asyncio.create_task(asyncio.to_thread(
+                store_display_image, session_dir / filename, image, changed, content_hashes[i]
+            )))
+    
+    # Модели получают тайлы вместо уменьшенной копии
+    for i, tiled in tiled_images.items():
+        decoded[i] = (tiled, decoded[i][1])
+    
+    return cached_detections, pending, decoded, persist_tasks
+
+async def prepare_uploads(files: List[UploadFile], session_dir: Path, model_keys: List[str],
+                          imgsz: int, conf: float, iou: float, stage_timings: dict, tiling: tuple = None):
+    """Сохраняет файлы в сессию и готовит их к инференсу.
+
+    Возвращает имена файлов, хэши, найденные в кэше детекции, индексы для инференса
+    по моделям, декодированные изображения и задачи сохранения.
+    UploadTooLarge - превышен лимит размера, ValueError - битый файл.
+    """
+    filenames, content_hashes = await save_request_uploads(files, session_dir, stage_timings)
+    cached_detections, pending, decoded, persist_tasks = await prepare_saved_uploads(
+        filenames, content_hashes, session_dir, model_keys, imgsz, conf, iou, stage_timings, tiling
+    )
+    return filenames, content_hashes, cached_detections, pending, decoded, persist_tasks
+
+def upload_too_large_response(e: UploadTooLarge, model_name: str, session_dir: Path) -> JSONResponse:
+    """Ответ 413 и удаление уже сохраненных файлов сессии"""
+    logger.warning(f"⚠️ {str(e)}")
+    REQUESTS.labels(model_name, '413').inc()
+    run_in_background(asyncio.to_thread(SESSION_STORE.remove, session_dir.name))
+    return JSONResponse(status_code=413, content={"error": str(e)})
+
+@app.middleware("http")
+async def touch_viewed_session(request: Request, call_next):
+    """Просмотр изображений сессии через /tmp продлевает ее жизнь"""
+    path = request.url.path
+    if path.startswith("/tmp/"):
+        await asyncio.to_thread(SESSION_STORE.touch, path[5:].split("/", 1)[0])
+    return await call_next(request)
+
+@app.middleware("http")
+async def limit_request_size(request: Request, call_next):
+    """Отклоняет слишком большие загрузки по Content-Length до чтения тела"""
+    content_length = request.headers.get("content-length")
+    if request.method == "POST" and content_length and content_length.isdigit():
+        if int(content_length) > MAX_UPLOAD_REQUEST_BYTES + MULTIPART_OVERHEAD_BYTES:
+            logger.warning(f"⚠️ Запрос {request.url.path} отклонен: {content_length} байт")
+            return JSONResponse(
+                status_code=413,
+                content={"error": f"Запрос больше допустимых {MAX_UPLOAD_REQUEST_BYTES} байт"}
+            )
+    return await call_next(request)
+
+@app.get("/")
+async def read_root(request: Request):
+    return templates.TemplateResponse("index.html", {"request": request})
+
+@app.post("/process")
+async def process_images(
+    files: list[UploadFile] = File(...),
+    model_name: str = Form(...),
+    imgsz: int = Form(...),
+    conf: float = Form(...),
+    iou: float = Form(...),
+    parallel: bool = Form(None),
+    response_format: str = Form("records"),
+    mask_encoding: str = Form("polygon"),
+    mask_tolerance: float = Form(0.0),
+    tile_size: int = Form(0),
+    tile_overlap: float = Form(0.2)
+):
+    request_start = time.time()
+    logger.info(f"🚀 НАЧАЛО ОБРАБОТКИ: {len(files)} файлов, imgsz={imgsz}, conf={conf}, iou={iou}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"📋 Детали запроса:")
+        logger.debug(f"  - model_name: {model_name}")
+        logger.debug(f"  - imgsz: {imgsz} (тип: {type(imgsz)})")
+        logger.debug(f"  - conf: {conf} (тип: {type(conf)})")
+        logger.debug(f"  - iou: {iou} (тип: {type(iou)})")
+
+        for i, file in enumerate(files):
+            logger.debug(f"  - файл {i+1}: {file.filename} ({file.content_type}, {file.size} байт)")
+
+    model_names, error_response = resolve_request_models(model_name, response_format, mask_encoding, mask_tolerance)
+    if error_response is not None:
+        return error_response
+    tiling, error_response = resolve_tiling(model_name, tile_size, tile_overlap)
+    if error_response is not None:
+        return error_response
+
     # Создаем временную сессию
     session_id = str(uuid.uuid4())
-    session_dir = TMP_DIR / session_id
-    session_dir.mkdir(exist_ok=True)
-    
-    # Очищаем кэш цветов для нового запроса
-    global CLASS_COLORS
-    CLASS_COLORS.clear()
-    logger.info(f"🎨 Кэш цветов очищен для новой сессии")
+    session_dir = SESSION_STORE.create(session_id)
     
     logger.info(f"📁 Создана сессия: {session_id}")
 
+    INFLIGHT_REQUESTS.inc()
     try:
-        # Сохраняем и оптимизируем изображения
-        saved_file_paths = []
-        logger.info(f"💾 Начинаю сохранение {len(files)} файлов...")
-        
-        for i, file in enumerate(files):
-            logger.info(f"📁 [{i+1}/{len(files)}] Сохранение файла: {file.filename}")
-            
-            # Читаем содержимое файла
-            contents = await file.read()
-            logger.info(f"📄 Размер файла {file.filename}: {len(contents)} байт")
-            
-            # Сохраняем файл
-            tmp_file_path = session_dir / file.filename
-            with open(tmp_file_path, "wb") as f:
-                f.write(contents)
-            
-            logger.info(f"💾 Файл сохранен: {tmp_file_path}")
-            
-            # Оптимизируем изображение
-            logger.info(f"🔧 Оптимизация изображения: {file.filename}")
-            optimize_image_size(tmp_file_path, max_size=512)
-            
-            saved_file_paths.append(tmp_file_path)
+        stage_timings = {}  # Время этапов запроса для итоговой записи в лог
+        model_keys = [COMPOSITE_KEYS[model_name]] if model_name in COMPOSITE_KEYS else model_names
+        try:
+            filenames, content_hashes, cached_detections, pending, decoded, persist_tasks = await prepare_uploads(
+                files, session_dir, model_keys, imgsz, conf, iou, stage_timings, tiling
+            )
+        except UploadTooLarge as e:
+            return upload_too_large_response(e, model_name, session_dir)
+        except ValueError as e:
+            logger.error(f"❌ {str(e)}")
+            REQUESTS.labels(model_name, '400').inc()
+            return JSONResponse(
+                status_code=400,
+                content={"error": str(e)}
+            )
 
         # Обрабатываем изображения моделями
         results_all_models = {}
         detections_all = {}
         original_images = {}  # Пути к оригинальным изображениям
+        model_timings = {}  # Время работы каждой модели
+        new_detections = {}  # (индекс файла, модель) -> детекции, посчитанные в этом запросе
         
-        # Специальная обработка для "Повреждения + детали"
-        if model_name == 'damage_parts':
-            logger.info("🔄 Специальная обработка: объединение результатов повреждений и деталей")
+        for original_filename in filenames:
+            if original_filename not in original_images:
+                original_images[original_filename] = f"/tmp/{session_id}/{original_filename}"
+        
+        stage_start = time.time()
+        # Специальная обработка для составных типов ("Повреждения + детали", каскад)
+        if model_name in COMPOSITE_KEYS:
+            key = COMPOSITE_KEYS[model_name]
+            logger.info(f"🔄 Специальная обработка: общий результат {key}")
             
-            # Обрабатываем каждое изображение
-            for i, file_path in enumerate(saved_file_paths):
-                filename = file_path.name
-                
+            indices = pending[key]
+            combined_outputs = []
+            if indices:
+                # Прогоняем все изображения одним батчем
                 try:
-                    # Загружаем модели
-                    damage_model = 'auto_damage_united_with_third_part_yolo_model'
-                    parts_model = 'auto_parts_full_dataset_1'
-                    
-                    damage_model_obj = load_model(damage_model)
-                    parts_model_obj = load_model(parts_model)
-                    
-                    # Получаем результаты для одного файла
-                    damage_results = damage_model_obj(str(file_path), conf=conf, iou=iou, imgsz=imgsz, verbose=False)
-                    parts_results = parts_model_obj(str(file_path), conf=conf, iou=iou, imgsz=imgsz, verbose=False)
-                    
-                    if damage_results and parts_results:
-                        # Объединяем результаты - damage_results и parts_results это списки, берем первый элемент
-                        combined_img, combined_detections = combine_detection_results([damage_results[0], parts_results[0]])
-                        
-                        if combined_img is not None:
-                            # Создаем один объединенный результат (без сохранения PNG)
-                            combined_result = {
-                                "original_filename": filename,
-                                "result_path": f"/tmp/{session_id}/{filename}"  # Путь к оригиналу
-                            }
-                            
-                            # Сохраняем только объединенный результат
-                            if 'combined' not in results_all_models:
-                                results_all_models['combined'] = []
-                            results_all_models['combined'].append(combined_result)
-                            
-                            # Сохраняем объединенные данные обнаружения
-                            if filename not in detections_all:
-                                detections_all[filename] = {}
-                            detections_all[filename]['combined'] = combined_detections
-                            
-                            # Сохраняем путь к оригинальному изображению
-                            if filename not in original_images:
-                                original_images[filename] = f"/tmp/{session_id}/{filename}"
-                            
-                            logger.info(f"✅ Объединен результат для {filename}")
-                
+                    combined_outputs, model_timings[key] = await INFERENCE_EXECUTOR.run(
+                        COMPOSITE_RUNNERS[key], [decoded[i][0] for i in indices], imgsz, conf, iou
+                    )
                 except Exception as e:
-                    logger.error(f"❌ Ошибка объединения для {filename}: {str(e)}")
+                    logger.error(f"❌ Ошибка обработки {model_name}: {str(e)}")
                     logger.error(f"📋 Трейсбек: {traceback.format_exc()}")
+                    ERRORS.labels(key).inc()
+            
+            for i, combined_detections in zip(indices, combined_outputs):
+                new_detections[(i, key)] = combined_detections
+            
+            for i, filename in enumerate(filenames):
+                combined_detections = cached_detections.get((i, key), new_detections.get((i, key)))
+                if combined_detections is None:
                     continue
+                
+                # Создаем один объединенный результат (без сохранения PNG)
+                results_all_models.setdefault(key, []).append({
+                    "original_filename": filename,
+                    "result_path": f"/tmp/{session_id}/{filename}",  # Путь к оригиналу
+                    "render_path": render_path(session_id, filename, key)
+                })
+                
+                # Сохраняем объединенные данные обнаружения
+                detections_all.setdefault(filename, {})[key] = combined_detections
+                logger.debug(f"✅ Объединен результат для {filename}")
         else:
             # Обычная обработка для всех остальных типов
-            for i, mn in enumerate(model_names):
-                model_start = time.time()
-                logger.info(f"🤖 [{i+1}/{len(model_names)}] Обработка модели: {mn}")
-                
-                try:
-                    model = load_model(mn)
-                    inference_start = time.time()
-                    logger.info(f"🔍 [{i}/{len(model_names)}] {mn}: начало инференса...")
-                    
-                    results = model([str(p) for p in saved_file_paths], conf=conf, iou=iou, imgsz=imgsz, verbose=False)
-                    inference_time = time.time() - inference_start
-                    logger.info(f"⚡ Модель {mn}: инференс за {inference_time:.2f}с ({inference_time/len(files):.2f}с на изображение)")
-                    
-                    # Сохраняем результаты
-                    save_start = time.time()
-                    model_results = []
-                    
-                    # results - это список объектов Results, по одному для каждого изображения
-                    for j, result in enumerate(results):
-                        # Сохраняем путь к оригинальному изображению
-                        original_filename = saved_file_paths[j].name
-                        if original_filename not in original_images:
-                            original_images[original_filename] = f"/tmp/{session_id}/{original_filename}"
-                        
-                        # Извлекаем данные обнаружения
-                        detections = extract_detection_data(result, mn)
-                        logger.info(f"🔍 Извлечено {len(detections)} детекций для {original_filename} модель {mn}")
-
-                        # Сохраняем результат (без PNG файла)
-                        model_result = {
-                            "original_filename": original_filename,
-                            "result_path": f"/tmp/{session_id}/{original_filename}"  # Путь к оригиналу
-                        }
-                        model_results.append(model_result)
-                        
-                        # Сохраняем данные обнаружения
-                        if detections:
-                            if original_filename not in detections_all:
-                                detections_all[original_filename] = {}
-                            detections_all[original_filename][mn] = detections
-                            logger.info(f"💾 Сохранено {len(detections)} детекций для {original_filename} модель {mn}")
-                        else:
-                            logger.warning(f"⚠️ Нет детекций для {original_filename} модель {mn}")
-                    
-                    results_all_models[mn] = model_results
-                    
-                    save_time = time.time() - save_start
-                    model_time = time.time() - model_start
-                    logger.info(f"✅ Модель {mn}: инференс {inference_time:.2f}с, сохранение {save_time:.2f}с, всего {model_time:.2f}с")
-                    
-                except Exception as e:
-                    logger.error(f"❌ Ошибка модели {mn}: {str(e)}")
-                    logger.error(f"📋 Трейсбек: {traceback.format_exc()}")
+            batches = {
+                mn: ([decoded[i][0] for i in pending[mn]], [filenames[i] for i in pending[mn]])
+                for mn in model_names if pending[mn]
+            }
+            
+            if parallel is None:
+                parallel = PARALLEL_MODELS
+            
+            if parallel and len(batches) > 1:
+                model_outputs = await INFERENCE_EXECUTOR.run(run_models_parallel, batches, imgsz, conf, iou)
+            else:
+                model_outputs = {}
+                for i, (mn, (images, batch_filenames)) in enumerate(batches.items()):
+                    logger.info(f"🤖 [{i+1}/{len(batches)}] Обработка модели: {mn}")
+                    try:
+                        model_outputs[mn] = await INFERENCE_EXECUTOR.run(
+                            run_model_inference, mn, images, batch_filenames, imgsz, conf, iou
+                        )
+                    except Exception as e:
+                        logger.error(f"❌ Ошибка модели {mn}: {str(e)}")
+                        logger.error(f"📋 Трейсбек: {traceback.format_exc()}")
+                        ERRORS.labels(mn).inc()
+                        model_outputs[mn] = e
+            
+            for mn in model_names:
+                output = model_outputs.get(mn)
+                if isinstance(output, Exception):
                     results_all_models[mn] = []
                     continue
+                
+                if output is not None:
+                    detections_list, model_timings[mn] = output
+                    for i, detections in zip(pending[mn], detections_list):
+                        new_detections[(i, mn)] = detections
+                
+                # Сохраняем результат (без PNG файла)
+                results_all_models[mn] = [
+                    {
+                        "original_filename": filename,
+                        "result_path": f"/tmp/{session_id}/{filename}",  # Путь к оригиналу
+                        "render_path": render_path(session_id, filename, mn)
+                    }
+                    for filename in filenames
+                ]
+                
+                # Сохраняем данные обнаружения
+                for i, filename in enumerate(filenames):
+                    detections = cached_detections.get((i, mn), new_detections.get((i, mn)))
+                    if detections and detections['count']:
+                        detections_all.setdefault(filename, {})[mn] = detections
+        
+        stage_timings['inference'] = time.time() - stage_start
+        
+        # Кладем новые результаты в кэш (в фоне, ответ их не ждет)
+        cache_new_detections(new_detections, content_hashes, imgsz, conf, iou, tiling)
+
+        # Колонки детекций сессии нужны для отрисовки по запросу (/render)
+        persist_tasks.append(asyncio.create_task(asyncio.to_thread(
+            write_session_detections, session_dir, detections_all
+        )))
+
+        # Файлы должны быть на диске до ответа: фронтенд сразу загружает их по result_path
+        stage_start = time.time()
+        await asyncio.gather(*persist_tasks)
+        stage_timings['persist_wait'] = time.time() - stage_start
 
         total_time = time.time() - request_start
         avg_time_per_model = total_time / len(model_names) if model_names else 0
@@ -675,14 +1227,30 @@ async def process_images(
         logger.info(f"⏱️ Среднее время на изображение: {avg_time_per_image:.2f}с")
         
         # Логируем итоговые данные детекций
-        logger.info(f"📋 ИТОГОВЫЕ ДАННЫЕ ДЕТЕКЦИЙ:")
-        logger.info(f"  - Всего файлов с детекциями: {len(detections_all)}")
-        for filename, models_data in detections_all.items():
-            logger.info(f"  - Файл {filename}:")
-            for model_name, detections in models_data.items():
-                logger.info(f"    - Модель {model_name}: {len(detections)} детекций")
-                for i, detection in enumerate(detections[:3]):  # Показываем первые 3
-                    logger.info(f"      {i+1}. {detection.get('class_name', 'Unknown')} - {detection.get('confidence', 0):.2f}")
+        detections_count = sum(columns['count'] for models_data in detections_all.values() for columns in models_data.values())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"📋 ИТОГОВЫЕ ДАННЫЕ ДЕТЕКЦИЙ:")
+            logger.debug(f"  - Всего файлов с детекциями: {len(detections_all)}")
+            for filename, models_data in detections_all.items():
+                logger.debug(f"  - Файл {filename}:")
+                for key, detections in models_data.items():
+                    logger.debug(f"    - Модель {key}: {detections['count']} детекций")
+                    for i, (class_name, confidence) in enumerate(zip(detections['class_name'][:3], detections['confidence'][:3])):  # Показываем первые 3
+                        logger.debug(f"      {i+1}. {class_name} - {confidence:.2f}")
+
+        # Колонки переводятся в формат ответа и кодировку масок только здесь:
+        # в кэше и внутри они хранятся с полными полигонами
+        stage_start = time.time()
+        # Привязка повреждений к деталям - отдельное поле ответа, а не колонка детекций
+        detections_all, attribution_all = split_session_attribution(detections_all)
+        if response_format != 'columnar' or mask_encoding != 'polygon' or mask_tolerance > 0:
+            detections_all = await asyncio.to_thread(lambda: {
+                filename: {
+                    key: format_detections(columns, response_format, mask_encoding, mask_tolerance)
+                    for key, columns in models_data.items()
+                }
+                for filename, models_data in detections_all.items()
+            })
 
         # Формируем ответ
         response_data = {
@@ -690,44 +1258,524 @@ async def process_images(
             "detections": detections_all,
             "original_images": original_images,
             "processing_time": total_time,
+            "model_timings": model_timings,
+            "cache_hits": len(cached_detections),
+            "response_format": response_format,
+            "mask_encoding": mask_encoding,
             "models_processed": len(model_names),
             "files_processed": len(files)
         }
+        if attribution_all:
+            response_data["attribution"] = attribution_all
+        
+        # Сериализуем сами и вне event loop: ответ уже из примитивов, jsonable_encoder не нужен
+        body = await asyncio.to_thread(
+            json.dumps, response_data, ensure_ascii=False, separators=(',', ':')
+        )
+        stage_timings['serialize'] = time.time() - stage_start
+        SERIALIZATION_SECONDS.observe(stage_timings['serialize'])
+        REQUEST_SECONDS.labels(model_name).observe(time.time() - request_start)
+        REQUESTS.labels(model_name, '200').inc()
+
+        log_request_record({
+            "session_id": session_id,
+            "model_name": model_name,
+            "status": 200,
+            "files": len(files),
+            "cache_hits": len(cached_detections),
+            "detections": detections_count,
+            "response_format": response_format,
+            "mask_encoding": mask_encoding,
+            "stages": {stage: round(seconds, 4) for stage, seconds in stage_timings.items()},
+            "models": model_timings,
+            "total": round(time.time() - request_start, 4)
+        })
 
-        return response_data
+        return Response(content=body, media_type="application/json")
 
     except Exception as e:
         logger.error(f"❌ Ошибка обработки: {str(e)}")
+        REQUESTS.labels(model_name, '500').inc()
+        ERRORS.labels('request').inc()
+        log_request_record({
+            "session_id": session_id,
+            "model_name": model_name,
+            "status": 500,
+            "files": len(files),
+            "error": str(e),
+            "total": round(time.time() - request_start, 4)
+        })
         return JSONResponse(
             status_code=500,
             content={"error": f"Ошибка обработки: {str(e)}"}
         )
+    finally:
+        INFLIGHT_REQUESTS.dec()
+        release_session(session_id)
+
+class ProcessRequest:
+    """Параметры и подготовленные данные одного запроса обработки (потокового или задачи)"""
+
+    def __init__(self, model_name: str, model_names: List[str], imgsz: int, conf: float, iou: float,
+                 parallel: bool, response_format: str, mask_encoding: str, mask_tolerance: float,
+                 tiling: tuple = None):
+        self.model_name = model_name
+        self.model_names = model_names
+        self.model_keys = [COMPOSITE_KEYS[model_name]] if model_name in COMPOSITE_KEYS else model_names
+        self.imgsz = imgsz
+        self.conf = conf
+        self.iou = iou
+        self.parallel = PARALLEL_MODELS if parallel is None else parallel
+        self.response_format = response_format
+        self.mask_encoding = mask_encoding
+        self.mask_tolerance = mask_tolerance
+        self.tiling = tiling
+        self.request_start = time.time()
+        self.stage_timings = {}
+        # Создаем временную сессию
+        self.session_id = str(uuid.uuid4())
+        self.session_dir = SESSION_STORE.create(self.session_id)
+        logger.info(f"📁 Создана сессия: {self.session_id}")
+
+    async def save_uploads(self, files):
+        """Сохраняет файлы запроса в сессию (UploadTooLarge - превышен лимит)"""
+        self.filenames, self.content_hashes = await save_request_uploads(files, self.session_dir, self.stage_timings)
+        SESSION_STORE.refresh(self.session_id)
+
+    async def prepare_images(self):
+        """Ищет результаты в кэше и декодирует сохраненные изображения (ValueError - битый файл)"""
+        self.cached_detections, self.pending, self.decoded, self.persist_tasks = await prepare_saved_uploads(
+            self.filenames, self.content_hashes, self.session_dir, self.model_keys,
+            self.imgsz, self.conf, self.iou, self.stage_timings, self.tiling
+        )
+
+    async def prepare(self, files):
+        await self.save_uploads(files)
+        await self.prepare_images()
+
+    def result_event(self, i: int, key: str, columns: dict, cached: bool) -> dict:
+        columns, attribution = split_attribution(columns)
+        event = {
+            "type": "result",
+            "file": self.filenames[i],
+            "model": key,
+            "cached": cached,
+            "result_path": f"/tmp/{self.session_id}/{self.filenames[i]}",
+            "render_path": render_path(self.session_id, self.filenames[i], key),
+            "detections": format_detections(columns, self.response_format, self.mask_encoding, self.mask_tolerance)
+        }
+        if attribution is not None:
+            event["attribution"] = attribution
+        return event
+
+async def process_events(req: ProcessRequest, cancel_event: threading.Event = None):
+    """Обрабатывает подготовленный запрос и отдает события по мере готовности каждой пары (файл, модель).
+
+    События: session (пути к изображениям), result (детекции одного файла одной модели),
+    progress, model_done, error и итоговое done со временем этапов.
+    """
+    INFLIGHT_REQUESTS.inc()
+    status = 200
+    filenames = req.filenames
+    total = len(filenames) * len(req.model_keys)
+    completed = 0
+    detections_all = {}
+    new_detections = {}
+    model_timings = {}
+    try:
+        yield {
+            "type": "session",
+            "session_id": req.session_id,
+            "original_images": {filename: f"/tmp/{req.session_id}/{filename}" for filename in filenames},
+            "models": req.model_keys,
+            "total": total
+        }
+        # Клиент сразу загружает изображения по result_path
+        await asyncio.gather(*req.persist_tasks)
+
+        for (i, key), columns in req.cached_detections.items():
+            detections_all.setdefault(filenames[i], {})[key] = columns
+            completed += 1
+            yield req.result_event(i, key, columns, True)
+        if req.cached_detections:
+            yield {"type": "progress", "completed": completed, "total": total}
+
+        stage_start = time.time()
+        jobs = {key: req.pending[key] for key in req.model_keys if req.pending[key]}
+        if jobs:
+            loop = asyncio.get_running_loop()
+            queue_events = asyncio.Queue()
+
+            def emit(*item):
+                loop.call_soon_threadsafe(queue_events.put_nowait, item)
+
+            inference = asyncio.ensure_future(INFERENCE_EXECUTOR.run(
+                run_models_streaming, jobs, req.decoded, filenames, req.imgsz, req.conf, req.iou,
+                req.parallel, emit, cancel_event
+            ))
+            remaining = len(jobs)
+            while remaining:
+                kind, key, indices, payload = await queue_events.get()
+                if kind == 'result':
+                    detections_list, timings = payload
+                    summary = model_timings.setdefault(key, {"inference": 0.0, "extraction": 0.0, "total": 0.0})
+                    for stage in summary:
+                        summary[stage] = round(summary[stage] + timings[stage], 4)
+                    for i, columns in zip(indices, detections_list):
+                        new_detections[(i, key)] = columns
+                        detections_all.setdefault(filenames[i], {})[key] = columns
+                        completed += 1
+                        yield req.result_event(i, key, columns, False)
+                    yield {"type": "progress", "completed": completed, "total": total}
+                elif kind == 'model_done':
+                    remaining -= 1
+                    yield {"type": "model_done", "model": key, "timings": model_timings.get(key)}
+                elif kind == 'cancelled':
+                    remaining -= 1
+                else:
+                    remaining -= 1
+                    yield {"type": "error", "model": key, "error": str(payload)}
+            await inference
+        req.stage_timings['inference'] = time.time() - stage_start
+
+        cache_new_detections(new_detections, req.content_hashes, req.imgsz, req.conf, req.iou, req.tiling)
+        await asyncio.to_thread(write_session_detections, req.session_dir, detections_all)
+
+        yield {
+            "type": "done",
+            "cancelled": bool(cancel_event and cancel_event.is_set()),
+            "processing_time": time.time() - req.request_start,
+            "model_timings": model_timings,
+            "cache_hits": len(req.cached_detections),
+            "models_processed": len(req.model_names),
+            "files_processed": len(filenames),
+            "response_format": req.response_format,
+            "mask_encoding": req.mask_encoding
+        }
+
+    except Exception as e:
+        status = 500
+        logger.error(f"❌ Ошибка потоковой обработки: {str(e)}")
+        logger.error(f"📋 Трейсбек: {traceback.format_exc()}")
+        ERRORS.labels('request').inc()
+        yield {"type": "error", "error": f"Ошибка обработки: {str(e)}"}
+    finally:
+        INFLIGHT_REQUESTS.dec()
+        REQUESTS.labels(req.model_name, str(status)).inc()
+        REQUEST_SECONDS.labels(req.model_name).observe(time.time() - req.request_start)
+        log_request_record({
+            "session_id": req.session_id,
+            "model_name": req.model_name,
+            "status": status,
+            "stream": True,
+            "files": len(filenames),
+            "cache_hits": len(req.cached_detections),
+            "completed": completed,
+            "stages": {stage: round(seconds, 4) for stage, seconds in req.stage_timings.items()},
+            "models": model_timings,
+            "total": round(time.time() - req.request_start, 4)
+        })
+
+async def prepare_process_request(files: List[UploadFile], model_name: str, imgsz: int, conf: float, iou: float,
+                                  parallel: bool, response_format: str, mask_encoding: str, mask_tolerance: float,
+                                  tile_size: int = 0, tile_overlap: float = 0.0):
+    """Проверяет параметры и готовит запрос. Возвращает запрос или ответ с ошибкой"""
+    model_names, error_response = resolve_request_models(model_name, response_format, mask_encoding, mask_tolerance)
+    if error_response is not None:
+        return None, error_response
+    tiling, error_response = resolve_tiling(model_name, tile_size, tile_overlap)
+    if error_response is not None:
+        return None, error_response
+    
+    req = ProcessRequest(model_name, model_names, imgsz, conf, iou, parallel, response_format, mask_encoding, mask_tolerance,
+                         tiling)
+    try:
+        await req.prepare(files)
+    except UploadTooLarge as e:
+        return None, upload_too_large_response(e, model_name, req.session_dir)
+    except ValueError as e:
+        logger.error(f"❌ {str(e)}")
+        REQUESTS.labels(model_name, '400').inc()
+        release_session(req.session_id)
+        return None, JSONResponse(status_code=400, content={"error": str(e)})
+    except Exception as e:
+        logger.error(f"❌ Ошибка обработки: {str(e)}")
+        REQUESTS.labels(model_name, '500').inc()
+        release_session(req.session_id)
+        return None, JSONResponse(status_code=500, content={"error": f"Ошибка обработки: {str(e)}"})
+    return req, None
+
+@app.post("/process/stream")
+async def process_images_stream(
+    files: list[UploadFile] = File(...),
+    model_name: str = Form(...),
+    imgsz: int = Form(...),
+    conf: float = Form(...),
+    iou: float = Form(...),
+    parallel: bool = Form(None),
+    response_format: str = Form("records"),
+    mask_encoding: str = Form("polygon"),
+    mask_tolerance: float = Form(0.0),
+    tile_size: int = Form(0),
+    tile_overlap: float = Form(0.2)
+):
+    """Потоковый вариант /process: события NDJSON по мере готовности каждой пары (файл, модель)"""
+    logger.info(f"🚀 НАЧАЛО ПОТОКОВОЙ ОБРАБОТКИ: {len(files)} файлов, imgsz={imgsz}, conf={conf}, iou={iou}")
+    req, error_response = await prepare_process_request(
+        files, model_name, imgsz, conf, iou, parallel, response_format, mask_encoding, mask_tolerance,
+        tile_size, tile_overlap
+    )
+    if error_response is not None:
+        return error_response
+
+    async def lines():
+        try:
+            async for event in process_events(req):
+                yield json.dumps(event, ensure_ascii=False, separators=(',', ':')) + "\n"
+        finally:
+            release_session(req.session_id)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+async def run_process_job(job: Job, req: ProcessRequest):
+    """Выполняет задачу: декодирует сохраненные файлы и собирает события в состояние задачи"""
+    try:
+        await req.prepare_images()
+        await collect_job_events(job, req)
+    finally:
+        release_session(req.session_id)
+
+async def collect_job_events(job: Job, req: ProcessRequest):
+    """Переносит события обработки в состояние задачи"""
+    async for event in process_events(req, job.cancel_event):
+        if event["type"] == "session":
+            job.original_images = event["original_images"]
+            job.total = event["total"]
+            job.results = {key: [] for key in event["models"]}
+        elif event["type"] == "result":
+            job.results[event["model"]].append({
+                "original_filename": event["file"],
+                "result_path": event["result_path"],
+                "render_path": event["render_path"]
+            })
+            job.detections.setdefault(event["file"], {})[event["model"]] = event["detections"]
+            job.completed += 1
+            # Прогресс виден из других воркеров через общую базу
+            await asyncio.to_thread(save_job_progress, job)
+        elif event["type"] == "error":
+            if "model" not in event:
+                raise RuntimeError(event["error"])
+            job.model_errors[event["model"]] = event["error"]
+        elif event["type"] == "done":
+            job.summary = {key: value for key, value in event.items() if key != "type"}
+
+# Снимок задачи с результатами в ее сессии, живой статус и прогресс - в общей базе
+JOB_SNAPSHOT_FILE = ".job.json"
+JOB_INDEX = JobIndex(STATE_DB, JOBS_TTL_SECONDS)
+# Как часто воркер проверяет запросы отмены своих задач, пришедшие через другие воркеры
+JOB_CANCEL_POLL_SECONDS = float(os.getenv("JOB_CANCEL_POLL_SECONDS", "0.5"))
+
+def save_job_progress(job: Job):
+    try:
+        JOB_INDEX.progress(job)
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения прогресса задачи {job.id}: {str(e)}")
+
+def save_job_state(job: Job):
+    """Сохраняет смену состояния задачи: снимок с результатами и живой статус в общей базе"""
+    JOB_INDEX.save(job)
+    write_job_snapshot(job)
+
+def write_job_snapshot(job: Job):
+    """Сохраняет состояние задачи в файл сессии (если сессия еще существует)"""
+    session_dir = TMP_DIR / job.id
+    if not session_dir.is_dir():
+        return
+    # Запись через временный файл: другой воркер никогда не прочитает снимок наполовину
+    temp_path = session_dir / f"{JOB_SNAPSHOT_FILE}.{os.getpid()}"
+    temp_path.write_text(json.dumps(job.snapshot(include_results=True), ensure_ascii=False, separators=(',', ':')),
+                         encoding='utf-8')
+    os.replace(temp_path, session_dir / JOB_SNAPSHOT_FILE)
+
+def read_job_snapshot(job_id: str):
+    """Состояние задачи другого воркера из файла ее сессии"""
+    try:
+        uuid.UUID(job_id)
+        return json.loads((TMP_DIR / job_id / JOB_SNAPSHOT_FILE).read_text(encoding='utf-8'))
+    except (ValueError, OSError):
+        return None
+
+JOB_MANAGER = JobManager(run_process_job, JOB_WORKERS, JOB_QUEUE_SIZE, JOBS_KEEP, JOBS_TTL_SECONDS,
+                         on_change=save_job_state)
+
+@app.on_event("startup")
+async def start_job_workers():
+    JOB_MANAGER.start()
+
+def cancel_local_job(job_id: str):
+    """Отменяет задачу этого воркера; файлы не запускавшейся задачи удаляются"""
+    job = JOB_MANAGER.cancel(job_id)
+    if job is None:
+        return None
+    logger.info(f"🛑 Отмена задачи {job_id}: {job.status}")
+    if job.started_at is None:
+        # Задача не запускалась: ее файлы больше не нужны
+        run_in_background(asyncio.to_thread(SESSION_STORE.remove, job_id))
+    return job
+
+async def watch_job_cancellations(interval: float):
+    """Выполняет отмены задач этого воркера, запрошенные через другие воркеры"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            for job_id in await asyncio.to_thread(JOB_INDEX.cancel_requests, os.getpid()):
+                cancel_local_job(job_id)
+        except Exception as e:
+            logger.error(f"❌ Ошибка проверки отмены задач: {str(e)}")
+
+@app.on_event("startup")
+async def start_job_cancel_watcher():
+    run_in_background(watch_job_cancellations(JOB_CANCEL_POLL_SECONDS))
+
+@app.on_event("startup")
+async def start_tmp_janitor():
+    if JANITOR_INTERVAL_SECONDS > 0:
+        run_in_background(SESSION_STORE.run_janitor(JANITOR_INTERVAL_SECONDS))
+        logger.info(f"🧹 Очистка tmp: TTL {SESSION_TTL_SECONDS:.0f}с, квота {SESSION_STORE.max_bytes} байт, каждые {JANITOR_INTERVAL_SECONDS:.0f}с")
+
+@app.on_event("startup")
+async def start_model_reloader():
+    if MODEL_RELOAD_INTERVAL_SECONDS > 0:
+        run_in_background(MODEL_REGISTRY.run_reloader(MODEL_RELOAD_INTERVAL_SECONDS))
+        logger.info(f"♻️ Проверка файлов моделей каждые {MODEL_RELOAD_INTERVAL_SECONDS:.0f}с, "
+                    f"бюджет памяти: {MODEL_MEMORY_BUDGET_BYTES or 'без ограничения'}, закреплены: {PINNED_MODELS}")
+
+@app.on_event("startup")
+async def start_model_warmup():
+    # Прогрев идет в фоне: сервер сразу принимает соединения, а /ready отвечает 503 до его окончания
+    if MODEL_WARMUP:
+        run_in_background(asyncio.to_thread(warmup_models))
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    await JOB_MANAGER.stop()
+
+@app.post("/jobs")
+async def create_job(
+    files: list[UploadFile] = File(...),
+    model_name: str = Form(...),
+    imgsz: int = Form(...),
+    conf: float = Form(...),
+    iou: float = Form(...),
+    parallel: bool = Form(None),
+    response_format: str = Form("records"),
+    mask_encoding: str = Form("polygon"),
+    mask_tolerance: float = Form(0.0),
+    tile_size: int = Form(0),
+    tile_overlap: float = Form(0.2)
+):
+    """Ставит обработку в очередь и сразу возвращает id задачи (429 + Retry-After, если очередь полна)"""
+    model_names, error_response = resolve_request_models(model_name, response_format, mask_encoding, mask_tolerance)
+    if error_response is not None:
+        return error_response
+    tiling, error_response = resolve_tiling(model_name, tile_size, tile_overlap)
+    if error_response is not None:
+        return error_response
+    
+    try:
+        # Проверяем место до сохранения файлов, чтобы не тратить диск на отклоненные задачи
+        JOB_MANAGER.check_capacity()
+        req = ProcessRequest(model_name, model_names, imgsz, conf, iou, parallel, response_format, mask_encoding, mask_tolerance,
+                             tiling)
+        job = Job(req.session_id, model_name, len(files))
+        
+        try:
+            await req.save_uploads(files)
+        except UploadTooLarge as e:
+            return upload_too_large_response(e, model_name, req.session_dir)
+        
+        try:
+            JOB_MANAGER.submit(job, req)
+        except JobQueueFull:
+            await asyncio.to_thread(SESSION_STORE.remove, req.session_id)
+            raise
+        
+        logger.info(f"📬 Задача {job.id} поставлена в очередь: {len(files)} файлов, {model_name}")
+        return JSONResponse(
+            status_code=202,
+            content={"job_id": job.id, "status": job.status, "status_url": f"/jobs/{job.id}"}
+        )
+    
+    except JobQueueFull as e:
+        logger.warning(f"⏳ {str(e)}")
+        REQUESTS.labels(model_name, '429').inc()
+        return JSONResponse(
+            status_code=429,
+            content={"error": str(e)},
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, results: bool = Query(True)):
+    """Статус, прогресс и (по готовности - полные) результаты задачи"""
+    job = JOB_MANAGER.get(job_id)
+    if job is None:
+        # Задача могла быть принята другим воркером
+        snapshot = await asyncio.to_thread(read_shared_job, job_id)
+        if snapshot is None:
+            return JSONResponse(status_code=404, content={"error": f"Задача {job_id} не найдена"})
+        if not results:
+            for key in ("results", "detections", "original_images", "summary"):
+                snapshot.pop(key, None)
+        return snapshot
+    return job.snapshot(include_results=results)
+
+def read_shared_job(job_id: str):
+    """Задача другого воркера: результаты из снимка в сессии, статус и прогресс из общей базы"""
+    live = JOB_INDEX.get(job_id)
+    snapshot = read_job_snapshot(job_id)
+    if live is None:
+        return snapshot
+    return {**(snapshot or {}), **live}
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Отменяет задачу в очереди или останавливает запущенную после текущей части"""
+    job = cancel_local_job(job_id)
+    if job is not None:
+        return job.snapshot(include_results=False)
+    # Задача другого воркера: он выполнит отмену при следующей проверке запросов
+    if not await asyncio.to_thread(JOB_INDEX.request_cancel, job_id):
+        snapshot = await asyncio.to_thread(JOB_INDEX.get, job_id)
+        if snapshot is None:
+            return JSONResponse(status_code=404, content={"error": f"Задача {job_id} не найдена"})
+        return snapshot
+    logger.info(f"🛑 Запрошена отмена задачи {job_id} другого воркера")
+    snapshot = await asyncio.to_thread(JOB_INDEX.get, job_id)
+    return JSONResponse(status_code=202, content={**snapshot, "cancel_requested": True})
 
 @app.post("/clear_tmp")
 async def clear_tmp():
-    """Очищает ВСЕ временные файлы"""
+    """Очищает временные файлы всех сессий, кроме занятых обработкой или задачами в очереди"""
     try:
-        logger.info("🧹 Начало очистки ВСЕХ временных файлов...")
+        logger.info("🧹 Начало очистки временных файлов...")
         
-        # Удаляем ВСЕ сессии и файлы в tmp
-        cleared_sessions = 0
-        cleared_files = 0
+        cleared_sessions, busy_sessions = await asyncio.to_thread(SESSION_STORE.clear)
         
+        # Отдельные файлы в корне tmp не относятся ни к одной сессии
+        cleared_files = 0
         for item in TMP_DIR.iterdir():
+            if item.name.startswith('.') or not item.is_file():
+                continue
             try:
-                if item.is_dir():
-                    shutil.rmtree(item)
-                    cleared_sessions += 1
-                    logger.info(f"🗑️ Удалена сессия: {item.name}")
-                elif item.is_file():
-                    item.unlink()
-                    cleared_files += 1
-                    logger.info(f"🗑️ Удален файл: {item.name}")
+                item.unlink()
+                cleared_files += 1
+                logger.info(f"🗑️ Удален файл: {item.name}")
             except Exception as e:
                 logger.error(f"❌ Ошибка удаления {item.name}: {str(e)}")
                 continue
         
-        logger.info(f"✅ Очистка завершена. Удалено сессий: {cleared_sessions}, файлов: {cleared_files}")
+        logger.info(f"✅ Очистка завершена. Удалено сессий: {cleared_sessions}, файлов: {cleared_files}, занято сессий: {busy_sessions}")
         return {"message": f"Очищено {cleared_sessions} сессий и {cleared_files} файлов"}
         
     except Exception as e:
@@ -737,36 +1785,117 @@ async def clear_tmp():
             content={"error": f"Ошибка очистки: {str(e)}"}
         )
 
+@app.get("/render/{session_id}/{filename}")
+async def render_result(
+    session_id: str,
+    filename: str,
+    models: str = Query(None),
+    render_format: str = Query("jpeg", alias="format")
+):
+    """Изображение с отрисованными детекциями (models - список через запятую, по умолчанию все)"""
+    try:
+        uuid.UUID(session_id)
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": f"Неверный идентификатор сессии: {session_id}"})
+    
+    if render_format not in RENDER_FORMATS:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"Неизвестный формат: {render_format}, доступны: {', '.join(RENDER_FORMATS)}"}
+        )
+    
+    await asyncio.to_thread(SESSION_STORE.touch, session_id)
+    session_dir = TMP_DIR / session_id
+    if Path(filename).name != filename or not (session_dir / filename).is_file():
+        return JSONResponse(status_code=404, content={"error": f"Изображение {filename} не найдено в сессии {session_id}"})
+    
+    model_keys = sorted(set(models.split(','))) if models else sorted(set(MODEL_MAP) | set(COMPOSITE_TYPES))
+    unknown = [key for key in model_keys if key not in MODEL_MAP and key not in COMPOSITE_TYPES]
+    if unknown:
+        return JSONResponse(status_code=400, content={"error": f"Неизвестные модели: {', '.join(unknown)}"})
+    
+    try:
+        cached_path = await asyncio.to_thread(session_render_path, session_dir, filename, model_keys, render_format)
+        body = await asyncio.to_thread(read_session_render, cached_path)
+        if body is None:
+            render_start = time.time()
+            body = await INFERENCE_EXECUTOR.run(render_session_image, session_dir, filename, model_keys, render_format)
+            logger.info(f"🖼️ Отрисовка {filename} ({', '.join(model_keys)}) за {time.time() - render_start:.3f}с")
+            run_in_background(asyncio.to_thread(save_session_render, session_id, cached_path, body))
+        return Response(content=body, media_type=RENDER_FORMATS[render_format][1])
+    
+    except Exception as e:
+        logger.error(f"❌ Ошибка отрисовки {filename}: {str(e)}")
+        logger.error(f"📋 Трейсбек: {traceback.format_exc()}")
+        return JSONResponse(
+            status_code=500,
+            content={"error": f"Ошибка отрисовки: {str(e)}"}
+        )
+
+def tmp_disk_usage() -> int:
+    """Объем временной директории (сессии) по счетчикам, без обхода диска"""
+    return SESSION_STORE.total_bytes()
+
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики в формате Prometheus"""
+    TMP_DISK_BYTES.set(tmp_disk_usage())
+    body, content_type = await asyncio.to_thread(render_metrics)
+    return Response(content=body, media_type=content_type)
+
+@app.get("/ready")
+async def get_ready():
+    """Готовность воркера принимать трафик: модели загружены и прогреты"""
+    ready = WARMUP_STATE["status"] in ("ready", "skipped")
+    return JSONResponse(status_code=200 if ready else 503, content={"ready": ready, "warmup": WARMUP_STATE})
+
 @app.get("/status")
 async def get_status():
     """Возвращает статус приложения"""
     try:
         logger.info("📊 Запрос статуса приложения")
         
+        # torch импортируется вместе с первой моделью: статус не ждет его загрузки
+        torch = sys.modules.get("torch")
+        
         # Проверяем доступность CUDA
-        cuda_available = torch.cuda.is_available()
+        cuda_available = torch is not None and torch.cuda.is_available()
         cuda_device_count = torch.cuda.device_count() if cuda_available else 0
         
-        # Подсчитываем временные файлы
-        tmp_files_count = sum(1 for _ in TMP_DIR.rglob('*') if _.is_file())
-        tmp_sessions_count = sum(1 for _ in TMP_DIR.iterdir() if _.is_dir())
+        # Временные файлы считаются по счетчикам хранилища сессий
+        tmp_stats = SESSION_STORE.stats()
         
-        # Информация о кэше моделей
-        cached_models = list(MODEL_CACHE.keys())
+        # Информация о загруженных моделях
+        cached_models = MODEL_REGISTRY.names()
         
         status_info = {
             "status": "running",
             "cuda_available": cuda_available,
             "cuda_device_count": cuda_device_count,
             "device_used": "cpu",
-            "tmp_files_count": tmp_files_count,
-            "tmp_sessions_count": tmp_sessions_count,
+            "inference_backend": INFERENCE_BACKEND,
+            "inference_int8": INFERENCE_INT8,
+            "tmp_files_count": tmp_stats["files"],
+            "tmp_sessions_count": tmp_stats["sessions"],
+            "tmp_sessions": tmp_stats,
             "cached_models": cached_models,
+            "inference_executor": INFERENCE_EXECUTOR.stats(),
+            "result_cache": RESULT_CACHE.stats() if RESULT_CACHE is not None else None,
+            "micro_batching": {mn: scheduler.stats() for mn, scheduler in BATCH_SCHEDULERS.items()},
+            "jobs": JOB_MANAGER.stats(),
+            "model_registry": MODEL_REGISTRY.stats(),
+            "warmup": WARMUP_STATE,
+            "process": {
+                "pid": os.getpid(),
+                "worker": WORKER_ID,
+                "torch_threads": torch.get_num_threads() if torch is not None else None,
+                "memory": process_memory()
+            },
             "available_models": list(MODEL_MAP.keys()),
             "processing_types": list(PROCESSING_TYPES.keys())
         }
         
-        logger.info(f"📊 Статус: {status_info}")
+        logger.debug(f"📊 Статус: {status_info}")
         return status_info
         
     except Exception as e:
@@ -777,6 +1906,7 @@ async def get_status():
         )
 
 if __name__ == "__main__":
+    import torch
     logger.info("🚀 Запуск приложения...")
     logger.info(f"🐍 Версия PyTorch: {torch.__version__}")
     logger.info(f"🔧 CUDA доступна: {torch.cuda.is_available()}")
@@ -785,4 +1915,5 @@ if __name__ == "__main__":
     logger.info(f"📁 Временная директория: {TMP_DIR}")
     logger.info(f"🎯 Доступные типы обработки: {list(PROCESSING_TYPES.keys())}")
     
+    # Один процесс; несколько воркеров с общими весами моделей - python prefork.py --workers N
     uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
@@ -0,0 +1,83 @@
+import base64
+
+import cv2
+import numpy as np
+
+# Кодировки масок в ответе /process: полные полигоны (по умолчанию),
+# int16 координаты в base64 и COCO RLE
+MASK_ENCODINGS = ('polygon', 'int16', 'rle')
+
+# Поле колонок/детекций, в котором лежит маска для каждой кодировки
+MASK_FIELDS = {
+    'polygon': 'mask_polygon',
+    'int16': 'mask_polygon_int16',
+    'rle': 'mask_rle',
+}
+
+
+def simplify_polygon(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """Упрощает полигон алгоритмом Дугласа-Пекера с допуском tolerance пикселей"""
+    if tolerance <= 0 or len(points) < 4:
+        return points
+    approx = cv2.approxPolyDP(points.reshape(-1, 1, 2).astype(np.float32), tolerance, True)
+    return approx.reshape(-1, 2)
+
+
+def encode_int16(points: np.ndarray) -> str:
+    """Координаты, округленные до пикселя, как little-endian Int16Array в base64"""
+    return base64.b64encode(np.rint(points).astype('<i2').tobytes()).decode('ascii')
+
+
+def rle_counts_to_string(counts: list) -> str:
+    """Сжатая строка COCO RLE (совместима с pycocotools.mask.frPyObjects/decode)"""
+    chars = []
+    for i, value in enumerate(counts):
+        if i > 2:
+            value -= counts[i - 2]
+        more = True
+        while more:
+            char = value & 0x1f
+            value >>= 5
+            more = value != -1 if char & 0x10 else value != 0
+            if more:
+                char |= 0x20
+            chars.append(chr(char + 48))
+    return ''.join(chars)
+
+
+def encode_rle(points: np.ndarray, width: int, height: int) -> dict:
+    """Растеризует полигон и кодирует маску в COCO RLE (обход по столбцам)"""
+    mask = np.zeros((height, width), dtype=np.uint8)
+    # Пустой или вырожденный полигон (ultralytics возвращает такие для крошечных масок)
+    if len(points) >= 3:
+        cv2.fillPoly(mask, [np.rint(points).astype(np.int32)], 1)
+    flat = mask.ravel(order='F')
+    # Границы серий: RLE всегда начинается с серии нулей (возможно, пустой)
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [flat.size]))
+    counts = np.diff(bounds).tolist()
+    if flat[0] == 1:
+        counts.insert(0, 0)
+    return {'size': [height, width], 'counts': rle_counts_to_string(counts)}
+
+
+def encode_masks(columns: dict, encoding: str = 'polygon', tolerance: float = 0.0) -> dict:
+    """Возвращает копию колонок с масками в выбранной кодировке"""
+    if encoding == 'polygon' and tolerance <= 0:
+        return columns
+    width, height = columns['image_size']
+    encoded = []
+    for polygon in columns['mask_polygon']:
+        if polygon is None:
+            encoded.append(None)
+            continue
+        points = simplify_polygon(np.asarray(polygon, dtype=np.float32).reshape(-1, 2), tolerance)
+        if encoding == 'int16':
+            encoded.append(encode_int16(points))
+        elif encoding == 'rle':
+            encoded.append(encode_rle(points, width, height))
+        else:
+            encoded.append(points.ravel().tolist())
+    result = {key: value for key, value in columns.items() if key != 'mask_polygon'}
+    result[MASK_FIELDS[encoding]] = encoded
+    return result
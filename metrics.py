@@ -0,0 +1,57 @@
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# При запуске несколькими воркерами (prefork.py) значения пишутся в файлы этой директории
+# и собираются со всех процессов при выгрузке
+MULTIPROCESS = bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+
+# Бакеты для быстрых этапов (чтение, декодирование, сериализация)
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Бакеты для инференса и запроса целиком (CPU, батчи по несколько изображений)
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+UPLOAD_READ_SECONDS = Histogram(
+    'app_upload_read_seconds', 'Чтение загруженных файлов запроса', buckets=FAST_BUCKETS
+)
+DECODE_SECONDS = Histogram(
+    'app_decode_seconds', 'Декодирование и уменьшение изображений запроса', buckets=FAST_BUCKETS
+)
+INFERENCE_SECONDS = Histogram(
+    'app_model_inference_seconds', 'Инференс модели на батче изображений', ['model'], buckets=SLOW_BUCKETS
+)
+EXTRACTION_SECONDS = Histogram(
+    'app_extraction_seconds', 'Извлечение детекций из результатов модели', ['model'], buckets=FAST_BUCKETS
+)
+SERIALIZATION_SECONDS = Histogram(
+    'app_serialization_seconds', 'Формирование и сериализация ответа /process', buckets=FAST_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    'app_request_seconds', 'Полное время запроса /process', ['processing_type'], buckets=SLOW_BUCKETS
+)
+
+REQUESTS = Counter('app_requests_total', 'Запросы /process', ['processing_type', 'status'])
+IMAGES = Counter('app_images_total', 'Изображения, прогнанные через модель', ['model'])
+DETECTIONS = Counter('app_detections_total', 'Найденные детекции', ['model'])
+ERRORS = Counter('app_errors_total', 'Ошибки моделей и запросов', ['model'])
+CACHE_HITS = Counter('app_result_cache_hits_total', 'Результаты, взятые из кэша вместо инференса')
+
+MODEL_CACHE_SIZE = Gauge('app_model_cache_size', 'Загруженные модели', multiprocess_mode='max')
+INFLIGHT_REQUESTS = Gauge('app_inflight_requests', 'Запросы /process в обработке', multiprocess_mode='livesum')
+# Объем общий для всех воркеров (учет в общей базе): берется последнее значение, а не сумма
+TMP_DISK_BYTES = Gauge('app_tmp_disk_bytes', 'Объем временной директории', multiprocess_mode='mostrecent')
+
+
+def render_metrics() -> tuple:
+    """Текущие метрики в текстовом формате Prometheus и их content type"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: int):
+    """Убирает живые gauge завершившегося воркера из общих файлов метрик"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
@@ -1,21 +1,85 @@
-import os
-from hub_sdk import HUBClient
-from dotenv import load_dotenv
-
-load_dotenv()
-
-api_key = os.getenv("ULTRALYTICS_API_KEY")
-
-client = HUBClient({"api_key": api_key})
-
-def get_model_map():
-    private_models_list = client.model_list().results
-    return {
-        model['meta']['name']: model['id']
-        for model in private_models_list
-    }
-
-MODEL_MAP = get_model_map()
-
-if __name__ == "__main__":
-    print(api_key)
+import json
+import os
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+api_key = os.getenv("ULTRALYTICS_API_KEY")
+
+# Локальная копия списка моделей HUB: импорт модуля не ходит в сеть
+MANIFEST_PATH = Path(os.getenv(
+    "HUB_MANIFEST_PATH", str(Path(__file__).resolve().parent / "models_from_hub" / "hub_manifest.json")
+))
+# Возраст копии, после которого список запрашивается заново (0 - не обновлять никогда)
+MANIFEST_TTL_SECONDS = float(os.getenv("HUB_MANIFEST_TTL_SECONDS", str(24 * 3600)))
+
+_client = None
+
+
+def get_client():
+    """Клиент HUB создается при первом сетевом запросе"""
+    global _client
+    if _client is None:
+        from hub_sdk import HUBClient
+        _client = HUBClient({"api_key": api_key})
+    return _client
+
+
+def fetch_model_map():
+    """Список приватных моделей из HUB (сетевой вызов)"""
+    private_models_list = get_client().model_list().results
+    return {
+        model['meta']['name']: model['id']
+        for model in private_models_list
+    }
+
+
+def refresh_model_map():
+    """Запрашивает список в HUB и перезаписывает локальную копию"""
+    model_map = fetch_model_map()
+    MANIFEST_PATH.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = MANIFEST_PATH.with_name(MANIFEST_PATH.name + ".tmp")
+    temp_path.write_text(json.dumps(model_map, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(temp_path, MANIFEST_PATH)
+    return model_map
+
+
+def read_cached_model_map():
+    try:
+        return json.loads(MANIFEST_PATH.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def get_model_map():
+    """Список моделей из локальной копии; в HUB идем, только если копии нет или она устарела"""
+    cached = read_cached_model_map()
+    if cached is not None:
+        age = time.time() - MANIFEST_PATH.stat().st_mtime
+        if MANIFEST_TTL_SECONDS <= 0 or age <= MANIFEST_TTL_SECONDS:
+            return cached
+    try:
+        return refresh_model_map()
+    except Exception:
+        # HUB недоступен: устаревшая копия лучше, чем ошибка
+        if cached is not None:
+            return cached
+        raise
+
+
+def __getattr__(name):
+    # MODEL_MAP вычисляется при первом обращении, а не при импорте модуля
+    if name == "MODEL_MAP":
+        model_map = get_model_map()
+        globals()["MODEL_MAP"] = model_map
+        return model_map
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+if __name__ == "__main__":
+    # Обновление локальной копии, например при деплое или по расписанию
+    for name, model_id in refresh_model_map().items():
+        print(f"{name}: {model_id}")
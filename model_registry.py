@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from result_cache import content_hasher
+
+logger = logging.getLogger('app')
+
+# Файл моделей читается частями при подсчете хэша
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path: Path) -> str:
+    hasher = content_hasher()
+    with open(path, 'rb') as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class ModelEntry:
+    """Загруженная модель и ее учет: версия файла весов, память, время загрузки и обращения"""
+
+    __slots__ = ('model', 'path', 'mtime_ns', 'size', 'digest', 'memory_bytes', 'weights_bytes',
+                 'load_seconds', 'loaded_at', 'loaded_by_pid', 'last_used', 'uses', 'reloads', 'reload_error')
+
+    def __init__(self, model, path: Path, stat: os.stat_result, digest: str, weights_bytes: int, load_seconds: float):
+        self.model = model
+        self.path = path
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.digest = digest
+        self.weights_bytes = weights_bytes
+        # Для экспортированных бэкендов объем весов неизвестен - берем размер файла
+        self.memory_bytes = weights_bytes if weights_bytes is not None else stat.st_size
+        self.load_seconds = load_seconds
+        self.loaded_at = time.time()
+        self.loaded_by_pid = os.getpid()
+        self.last_used = self.loaded_at
+        self.uses = 0
+        self.reloads = 0
+        self.reload_error = None
+
+
+class ModelRegistry:
+    """Загруженные модели с бюджетом памяти, LRU-вытеснением, закреплением и горячей заменой весов.
+
+    Пока сумма памяти моделей больше бюджета, выгружаются давно не использованные
+    незакрепленные модели. Запросы, уже получившие модель, держат ссылку на нее,
+    поэтому вытеснение и замена весов их не прерывают: память освобождается после
+    завершения последнего такого запроса. Фоновая проверка сравнивает mtime и размер
+    файла весов, при изменении содержимого (хэш) загружает новую версию рядом со старой
+    и подменяет ее одной операцией.
+    """
+
+    def __init__(self, loader, path_for, measure, max_bytes: int = 0, pinned=(), settle_seconds: float = 2.0):
+        self._loader = loader
+        self._path_for = path_for
+        self._measure = measure
+        self.max_bytes = max_bytes
+        self.pinned = set(pinned)
+        self.settle_seconds = settle_seconds
+        self._lock = threading.Lock()
+        # Загрузки (и перезагрузки) идут по одной: бюджет не превышается гонкой двух загрузок
+        self._load_lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.evictions = 0
+        self.reloads = 0
+        self.reload_failures = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name: str):
+        return name in self._entries
+
+    def names(self) -> list:
+        return list(self._entries)
+
+    def _touch(self, name: str):
+        entry = self._entries.get(name)
+        if entry is not None:
+            entry.last_used = time.time()
+            entry.uses += 1
+            self._entries.move_to_end(name)
+        return entry
+
+    def get(self, name: str):
+        """Модель из памяти или с диска (с вытеснением сверх бюджета)"""
+        with self._lock:
+            entry = self._touch(name)
+        if entry is not None:
+            return entry.model
+        with self._load_lock:
+            with self._lock:
+                entry = self._touch(name)
+            if entry is not None:
+                return entry.model
+            entry = self._load(name)
+            with self._lock:
+                self._entries[name] = entry
+                self._bytes += entry.memory_bytes
+                entry.uses = 1
+                evicted = self._evict(keep=name)
+        for evicted_name, evicted_entry in evicted:
+            logger.info(f"📤 Модель {evicted_name} выгружена по бюджету памяти ({evicted_entry.memory_bytes} байт)")
+        if self.max_bytes > 0 and self._bytes > self.max_bytes:
+            logger.warning(f"⚠️ Модели занимают {self._bytes} байт при бюджете {self.max_bytes}: остальные закреплены или используются")
+        return entry.model
+
+    def _load(self, name: str) -> ModelEntry:
+        path = self._path_for(name)
+        stat = path.stat()
+        # Хэш запоминается при загрузке: с ним сравнивается файл после замены
+        digest = file_digest(path)
+        start_time = time.time()
+        model = self._loader(name, path)
+        load_seconds = time.time() - start_time
+        return ModelEntry(model, path, stat, digest, self._measure(model), load_seconds)
+
+    def _evict(self, keep: str) -> list:
+        """Выгружает LRU незакрепленные модели, пока превышен бюджет (под self._lock)"""
+        evicted = []
+        if self.max_bytes <= 0:
+            return evicted
+        for name in list(self._entries):
+            if self._bytes <= self.max_bytes:
+                break
+            if name == keep or name in self.pinned:
+                continue
+            entry = self._entries.pop(name)
+            self._bytes -= entry.memory_bytes
+            self.evictions += 1
+            evicted.append((name, entry))
+        return evicted
+
+    def version(self, name: str) -> str:
+        """Версия весов, которыми сейчас отвечает модель (до загрузки - версия файла на диске)"""
+        entry = self._entries.get(name)
+        if entry is not None:
+            return str(entry.mtime_ns)
+        try:
+            return str(self._path_for(name).stat().st_mtime_ns)
+        except (OSError, KeyError):
+            return '0'
+
+    def _changed(self, name: str, entry: ModelEntry):
+        """stat файла, если веса на диске отличаются от загруженных и запись файла закончена"""
+        try:
+            path = self._path_for(name)
+            stat = path.stat()
+        except (OSError, KeyError):
+            return None
+        if path == entry.path and stat.st_mtime_ns == entry.mtime_ns and stat.st_size == entry.size:
+            return None
+        # Файл еще могут дописывать: ждем, пока он перестанет меняться
+        if time.time() - stat.st_mtime < self.settle_seconds:
+            return None
+        return stat
+
+    def reload_changed(self) -> int:
+        """Один проход проверки весов. Возвращает число перезагруженных моделей"""
+        reloaded = 0
+        for name, entry in list(self._entries.items()):
+            if self._changed(name, entry) is None:
+                continue
+            with self._load_lock:
+                current = self._entries.get(name)
+                if current is None or self._changed(name, current) is None:
+                    continue
+                path = self._path_for(name)
+                digest = file_digest(path)
+                if digest == current.digest:
+                    # Файл перезаписан тем же содержимым - запоминаем новую версию без загрузки
+                    stat = path.stat()
+                    current.path, current.mtime_ns, current.size = path, stat.st_mtime_ns, stat.st_size
+                    continue
+                try:
+                    # Старая версия продолжает отвечать, пока новая загружается
+                    fresh = self._load(name)
+                except Exception as e:
+                    current.reload_error = str(e)
+                    self.reload_failures += 1
+                    # Та же версия файла не перезагружается повторно до следующего изменения
+                    stat = path.stat()
+                    current.path, current.mtime_ns, current.size = path, stat.st_mtime_ns, stat.st_size
+                    logger.error(f"❌ Не удалось перезагрузить модель {name}, остается прежняя версия: {str(e)}")
+                    continue
+                fresh.reloads = current.reloads + 1
+                fresh.uses = current.uses
+                fresh.last_used = current.last_used
+                with self._lock:
+                    if self._entries.get(name) is current:
+                        self._entries[name] = fresh
+                        self._bytes += fresh.memory_bytes - current.memory_bytes
+                    self.reloads += 1
+            reloaded += 1
+            logger.info(f"♻️ Модель {name} перезагружена за {fresh.load_seconds:.2f}с (версия {fresh.mtime_ns})")
+        return reloaded
+
+    async def run_reloader(self, interval: float):
+        """Фоновая проверка файлов весов раз в interval секунд"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.reload_changed)
+            except Exception as e:
+                logger.error(f"❌ Ошибка проверки файлов моделей: {str(e)}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "bytes": self._bytes,
+                "pinned": sorted(self.pinned),
+                "evictions": self.evictions,
+                "reloads": self.reloads,
+                "reload_failures": self.reload_failures,
+                "models": {
+                    name: {
+                        "pinned": name in self.pinned,
+                        "memory_bytes": entry.memory_bytes,
+                        "weights_bytes": entry.weights_bytes,
+                        "load_seconds": round(entry.load_seconds, 3),
+                        "loaded_at": entry.loaded_at,
+                        "loaded_by_pid": entry.loaded_by_pid,
+                        "last_used": entry.last_used,
+                        "uses": entry.uses,
+                        "version": str(entry.mtime_ns),
+                        "reloads": entry.reloads,
+                        "reload_error": entry.reload_error,
+                    }
+                    for name, entry in self._entries.items()
+                },
+            }
@@ -0,0 +1,148 @@
+"""Запуск нескольких воркеров uvicorn с общими весами моделей (pre-fork).
+
+Главный процесс загружает все модели и только потом делает fork: страницы с весами
+остаются общими (copy-on-write), пока их никто не изменяет, поэтому N воркеров занимают
+в памяти веса один раз. Воркеры слушают один и тот же сокет, ядро распределяет
+между ними соединения. Упавший воркер перезапускается.
+
+Запуск:
+    python prefork.py --workers 4 --host 0.0.0.0 --port 5000
+
+Ядра делятся между воркерами: каждому достается CPU_THREADS // workers потоков torch.
+Метрики Prometheus собираются со всех воркеров через PROMETHEUS_MULTIPROC_DIR.
+"""
+import argparse
+import gc
+import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+logger = logging.getLogger('app')
+
+# Если воркер падает сразу после старта, перезапуск не чаще раза в секунду
+RESPAWN_DELAY_SECONDS = 1.0
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    """Слушающий сокет, который наследуют все воркеры"""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(main, sock: socket.socket, worker_id: int, workers: int, threads: int):
+    """Тело дочернего процесса: собственный event loop и uvicorn на общем сокете"""
+    import uvicorn
+
+    # Сигналы главного процесса воркеру не нужны: uvicorn ставит свои обработчики
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    main.init_worker(worker_id, workers, threads)
+    server = uvicorn.Server(uvicorn.Config(main.app, log_level='warning', timeout_keep_alive=30))
+    server.run(sockets=[sock])
+
+
+def spawn(main, sock: socket.socket, worker_id: int, workers: int, threads: int) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(main, sock, worker_id, workers, threads)
+        except BaseException:
+            logger.exception(f"❌ Воркер {worker_id} завершился с ошибкой")
+            code = 1
+        finally:
+            logging.shutdown()
+        os._exit(code)
+    return pid
+
+
+def serve(host: str, port: int, workers: int):
+    threads = int(os.getenv('CPU_THREADS', str(os.cpu_count() or 1)))
+    threads_per_worker = max(1, threads // workers)
+    os.environ['CPU_THREADS'] = str(threads_per_worker)
+
+    # Метрики воркеров пишутся в общую директорию; ее нужно задать до импорта prometheus_client
+    multiproc_dir = None
+    if not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiproc_dir = tempfile.mkdtemp(prefix='prometheus_')
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = multiproc_dir
+
+    import torch
+    # Пул потоков OpenMP не переживает fork: до fork torch работает в одном потоке
+    torch.set_num_threads(1)
+
+    import main
+    from metrics import mark_process_dead
+
+    started = time.time()
+    main.preload_models()
+    # Объекты, созданные до fork, не трогаются сборщиком мусора в воркерах,
+    # иначе запись счетчиков ссылок копировала бы их страницы
+    gc.collect()
+    gc.freeze()
+    logger.info(f"📦 Модели загружены до fork за {time.time() - started:.2f}с, воркеров: {workers}, "
+                f"потоков torch на воркер: {threads_per_worker}")
+
+    sock = bind_socket(host, port)
+    children = {}
+    for worker_id in range(workers):
+        children[spawn(main, sock, worker_id, workers, threads_per_worker)] = worker_id
+    logger.info(f"🚀 Слушаем http://{host}:{port}, воркеры: {sorted(children)}")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            worker_id = children.pop(pid, None)
+            if worker_id is None:
+                continue
+            mark_process_dead(pid)
+            if stopping:
+                continue
+            logger.warning(f"⚠️ Воркер {worker_id} (pid {pid}) завершился с кодом {os.waitstatus_to_exitcode(status)}, перезапуск")
+            time.sleep(RESPAWN_DELAY_SECONDS)
+            children[spawn(main, sock, worker_id, workers, threads_per_worker)] = worker_id
+    finally:
+        sock.close()
+        if multiproc_dir:
+            shutil.rmtree(multiproc_dir, ignore_errors=True)
+        logger.info("🛑 Все воркеры остановлены")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WEB_WORKERS', '2')))
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+    if args.workers < 1:
+        sys.exit("--workers должен быть не меньше 1")
+    serve(args.host, args.port, args.workers)
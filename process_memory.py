@@ -0,0 +1,39 @@
+import resource
+
+# Поля /proc/self/smaps_rollup, которые показывают разделение памяти между воркерами
+SMAPS_FIELDS = {
+    'Rss': 'rss_bytes',
+    'Pss': 'pss_bytes',
+    'Shared_Clean': 'shared_clean_bytes',
+    'Shared_Dirty': 'shared_dirty_bytes',
+    'Private_Clean': 'private_clean_bytes',
+    'Private_Dirty': 'private_dirty_bytes',
+}
+
+
+def process_memory() -> dict:
+    """Память текущего процесса.
+
+    Pss делит общие страницы поровну между процессами, которые их используют,
+    поэтому сумма Pss воркеров - реальный расход памяти. Веса, загруженные
+    до fork, попадают в Shared_*, пока их никто не изменяет.
+    """
+    memory = {}
+    try:
+        with open('/proc/self/smaps_rollup', encoding='ascii') as smaps:
+            for line in smaps:
+                name, _, value = line.partition(':')
+                if name in SMAPS_FIELDS:
+                    memory[SMAPS_FIELDS[name]] = int(value.split()[0]) * 1024
+    except OSError:
+        # Не Linux: доступен только пик RSS (в Linux ru_maxrss в килобайтах, в macOS в байтах)
+        memory['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return memory
+
+
+def model_weights_bytes(model) -> int:
+    """Объем весов torch-модели (для экспортированных бэкендов неизвестен)"""
+    module = getattr(model, 'model', None)
+    if module is None or not hasattr(module, 'state_dict'):
+        return None
+    return sum(tensor.numel() * tensor.element_size() for tensor in module.state_dict().values())
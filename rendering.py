@@ -0,0 +1,96 @@
+import logging
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+logger = logging.getLogger('app')
+
+# Прозрачность заливки масок (как раньше: 76 из 255)
+MASK_ALPHA = 0.3
+LABEL_FONT_SIZE = 16
+
+# Форматы отрисованного изображения: расширение для cv2.imencode и media type
+RENDER_FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg'),
+    'png': ('.png', 'image/png'),
+}
+
+
+@lru_cache(maxsize=4)
+def get_font(size: int = LABEL_FONT_SIZE):
+    """Шрифт с поддержкой кириллицы загружается один раз на процесс"""
+    for name in ("arial.ttf", "DejaVuSans.ttf"):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    logger.warning("⚠️ TrueType шрифт не найден, используется стандартный")
+    return ImageFont.load_default()
+
+
+def render_overlay(image: np.ndarray, columns: dict, alpha: float = MASK_ALPHA) -> np.ndarray:
+    """Рисует маски, рамки и подписи детекций на BGR-изображении.
+
+    Все маски заливаются в один слой и смешиваются с изображением одной операцией,
+    подписи рисуются через PIL за одно преобразование.
+    """
+    output = image.copy()
+    if not columns['count']:
+        return output
+
+    height, width = image.shape[:2]
+    color_layer = np.zeros_like(image)
+    coverage = np.zeros((height, width), dtype=np.uint8)
+    for polygon, color in zip(columns['mask_polygon'], columns['model_color']):
+        if not polygon or len(polygon) < 6:
+            continue
+        points = np.rint(np.asarray(polygon, dtype=np.float32).reshape(-1, 2)).astype(np.int32)
+        cv2.fillPoly(color_layer, [points], tuple(int(c) for c in color))
+        cv2.fillPoly(coverage, [points], 255)
+
+    covered = coverage.astype(bool)
+    if covered.any():
+        blended = cv2.addWeighted(image, 1.0 - alpha, color_layer, alpha, 0)
+        output[covered] = blended[covered]
+
+    boxes = np.asarray(columns['bbox'], dtype=np.float32).astype(np.int32)
+    for (x1, y1, x2, y2), color in zip(boxes.tolist(), columns['model_color']):
+        cv2.rectangle(output, (x1, y1), (x2, y2), tuple(int(c) for c in color), 2)
+
+    # Подписи рисуются через PIL: cv2.putText не умеет кириллицу
+    font = get_font()
+    pil_img = Image.fromarray(cv2.cvtColor(output, cv2.COLOR_BGR2RGB))
+    draw = ImageDraw.Draw(pil_img)
+    for (x1, y1, x2, y2), color, class_name, confidence in zip(
+        boxes.tolist(), columns['model_color'], columns['class_name'], columns['confidence']
+    ):
+        label = f"{class_name} {confidence:.2f}"
+        left, top, right, bottom = draw.textbbox((0, 0), label, font=font)
+        text_width, text_height = right - left, bottom - top
+
+        # Позиционируем текст так, чтобы он всегда был виден
+        text_x = x1
+        text_y = y1 - text_height - 5
+        if text_y < 0:
+            text_y = y2 + 5
+        if text_x + text_width > width:
+            text_x = width - text_width - 5
+        text_x = max(text_x, 5)
+
+        fill = (int(color[2]), int(color[1]), int(color[0]))  # BGR -> RGB
+        draw.rectangle([text_x, text_y, text_x + text_width + 5, text_y + text_height + 5], fill=fill)
+        draw.text((text_x + 2, text_y + 2), label, fill=(0, 0, 0), font=font)
+
+    return cv2.cvtColor(np.asarray(pil_img), cv2.COLOR_RGB2BGR)
+
+
+def encode_render(image: np.ndarray, render_format: str = 'jpeg') -> bytes:
+    """Кодирует отрисованное изображение в JPEG или PNG"""
+    extension, _ = RENDER_FORMATS[render_format]
+    params = [cv2.IMWRITE_JPEG_QUALITY, 90] if render_format == 'jpeg' else []
+    ok, encoded = cv2.imencode(extension, image, params)
+    if not ok:
+        raise ValueError(f"Не удалось закодировать изображение в {render_format}")
+    return encoded.tobytes()
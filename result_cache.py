@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger('app')
+
+
+def content_hasher():
+    """Инкрементальный хэш содержимого (для файлов, читаемых частями)"""
+    return hashlib.blake2b(digest_size=16)
+
+
+def hash_contents(contents: bytes) -> str:
+    """Хэш содержимого загруженного файла (ключ кэша не зависит от имени файла)"""
+    hasher = content_hasher()
+    hasher.update(contents)
+    return hasher.hexdigest()
+
+
+class ResultCache:
+    """Двухуровневый LRU кэш результатов: память с бюджетом в байтах и опционально диск.
+
+    Значения хранятся сериализованными (JSON или сырые байты), поэтому бюджет
+    считается точно, а разные запросы не делят между собой изменяемые объекты.
+    Дисковый уровень переживает перезапуск сервера.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: Path = None, max_disk_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes if disk_dir else 0
+        self.disk_dir = Path(disk_dir) if disk_dir and max_disk_bytes > 0 else None
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.disk_dir:
+            self._load_disk_index()
+
+    def _load_disk_index(self):
+        """Восстанавливает индекс дискового уровня после перезапуска (от старых к новым)"""
+        self.disk_dir.mkdir(parents=True, exist_ok=True)
+        entries = sorted(
+            (entry for entry in os.scandir(self.disk_dir) if entry.is_file() and not entry.name.endswith('.part')),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in entries:
+            size = entry.stat().st_size
+            self._disk[entry.name] = size
+            self._disk_bytes += size
+        logger.info(f"🗄️ Дисковый кэш результатов: {len(self._disk)} записей, {self._disk_bytes / 1024 / 1024:.1f} МБ")
+
+    @staticmethod
+    def _file_name(key: str) -> str:
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=20).hexdigest()
+
+    def _remember(self, key: str, value: bytes):
+        """Кладет значение в память и вытесняет самые старые записи сверх бюджета"""
+        if len(value) > self.max_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[key] = value
+        self._memory_bytes += len(value)
+        while self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def get_bytes(self, key: str):
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return value
+
+        if self.disk_dir:
+            name = self._file_name(key)
+            try:
+                value = (self.disk_dir / name).read_bytes()
+            except OSError:
+                value = None
+            if value is not None:
+                with self._lock:
+                    if name in self._disk:
+                        self._disk.move_to_end(name)
+                    self._remember(key, value)
+                    self.hits += 1
+                    self.disk_hits += 1
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put_bytes(self, key: str, value: bytes):
+        with self._lock:
+            self._remember(key, value)
+
+        if not self.disk_dir or len(value) > self.max_disk_bytes:
+            return
+        name = self._file_name(key)
+        path = self.disk_dir / name
+        try:
+            # Пишем во временный файл и атомарно переименовываем
+            part = path.with_name(name + '.part')
+            part.write_bytes(value)
+            os.replace(part, path)
+        except OSError as e:
+            logger.error(f"❌ Ошибка записи в дисковый кэш: {str(e)}")
+            return
+
+        evicted = []
+        with self._lock:
+            previous = self._disk.pop(name, None)
+            if previous is not None:
+                self._disk_bytes -= previous
+            self._disk[name] = len(value)
+            self._disk_bytes += len(value)
+            while self._disk_bytes > self.max_disk_bytes:
+                old_name, old_size = self._disk.popitem(last=False)
+                self._disk_bytes -= old_size
+                evicted.append(old_name)
+        for old_name in evicted:
+            (self.disk_dir / old_name).unlink(missing_ok=True)
+
+    def get_json(self, key: str):
+        value = self.get_bytes(key)
+        return None if value is None else json.loads(value)
+
+    def put_json(self, key: str, value):
+        self.put_bytes(key, json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "memory_budget_bytes": self.max_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "disk_budget_bytes": self.max_disk_bytes,
+            }
@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from state_db import StateDB, pid_alive
+
+logger = logging.getLogger('app')
+
+
+def scan_session(session_dir: Path) -> tuple:
+    """Объем и число файлов одной сессии (файлы лежат в ней без вложенных каталогов)"""
+    total = 0
+    files = 0
+    try:
+        with os.scandir(session_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                        files += 1
+                except OSError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return total, files
+
+
+# Схема учета сессий. Итоги поддерживаются триггерами, поэтому статус читает одну строку
+SESSION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    files INTEGER NOT NULL DEFAULT 0,
+    last_access REAL NOT NULL,
+    active INTEGER NOT NULL DEFAULT 0,
+    pid INTEGER
+);
+CREATE INDEX IF NOT EXISTS sessions_last_access ON sessions (last_access);
+CREATE TABLE IF NOT EXISTS session_totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    sessions INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    files INTEGER NOT NULL,
+    evicted_ttl INTEGER NOT NULL,
+    evicted_quota INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO session_totals VALUES (0, 0, 0, 0, 0, 0);
+CREATE TRIGGER IF NOT EXISTS sessions_insert AFTER INSERT ON sessions BEGIN
+    UPDATE session_totals SET sessions = sessions + 1, bytes = bytes + NEW.bytes, files = files + NEW.files;
+END;
+CREATE TRIGGER IF NOT EXISTS sessions_resize AFTER UPDATE OF bytes, files ON sessions BEGIN
+    UPDATE session_totals SET bytes = bytes + NEW.bytes - OLD.bytes, files = files + NEW.files - OLD.files;
+END;
+CREATE TRIGGER IF NOT EXISTS sessions_delete AFTER DELETE ON sessions BEGIN
+    UPDATE session_totals SET sessions = sessions - 1, bytes = bytes - OLD.bytes, files = files - OLD.files;
+END;
+"""
+
+# Обращения к одной сессии (загрузка каждого изображения через /tmp) пишутся в базу не чаще
+TOUCH_INTERVAL_SECONDS = 5.0
+# Сколько сессий помнит троттлинг обращений, прежде чем забыть их
+TOUCH_MEMORY = 10000
+
+
+class SessionStore:
+    """Сессии во временной директории с TTL, квотой на диск и счетчиками за O(1).
+
+    Учет ведется в общей базе (StateDB), поэтому все воркеры видят одни и те же
+    сессии: просмотр через любой воркер продлевает жизнь сессии, очистка и квота
+    действуют на все сессии сразу. Объем сессии пересчитывается только при ее
+    изменении (refresh), поэтому статус не обходит директорию. Занятые сессии
+    (идет обработка или задача в очереди у живого процесса) не удаляются.
+    Сначала удаляются сессии старше TTL, затем, пока превышена квота, самые
+    давно использованные.
+    """
+
+    def __init__(self, root: Path, ttl_seconds: float, max_bytes: int, db: StateDB):
+        self.root = Path(root)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._db = db
+        self._db.executescript(SESSION_SCHEMA)
+        self._touch_lock = threading.Lock()
+        self._touched = {}
+        self._load_existing()
+
+    def _load_existing(self):
+        """Сверяет учет с диском (один обход при старте, в prefork.py - в главном процессе до fork)"""
+        found = {}
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and not entry.name.startswith('.'):
+                found[entry.name] = (entry.stat().st_mtime, *scan_session(self.root / entry.name))
+        with self._db.transaction() as connection:
+            known = {row[0]: row[1:] for row in connection.execute("SELECT id, active, pid FROM sessions")}
+            for session_id in known.keys() - found.keys():
+                connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            for session_id, (mtime, size, files) in found.items():
+                connection.execute(
+                    "INSERT INTO sessions (id, bytes, files, last_access) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (id) DO UPDATE SET bytes = excluded.bytes, files = excluded.files",
+                    (session_id, size, files, mtime)
+                )
+            # Занятость, оставшаяся от завершившихся процессов, больше не держит сессии
+            for session_id, (active, pid) in known.items():
+                if active and not pid_alive(pid):
+                    connection.execute("UPDATE sessions SET active = 0 WHERE id = ?", (session_id,))
+        if found:
+            logger.info(f"🗂️ Найдено сессий: {len(found)}, {self.total_bytes()} байт")
+
+    def create(self, session_id: str) -> Path:
+        """Создает каталог сессии, сразу занятой вызывающим (освобождается release)"""
+        session_dir = self.root / session_id
+        session_dir.mkdir(exist_ok=True)
+        self._db.execute(
+            "INSERT INTO sessions (id, last_access, active, pid) VALUES (?, ?, 1, ?) "
+            "ON CONFLICT (id) DO UPDATE SET active = active + 1, pid = excluded.pid, last_access = excluded.last_access",
+            (session_id, time.time(), os.getpid())
+        )
+        return session_dir
+
+    def refresh(self, session_id: str):
+        """Пересчитывает объем сессии после записи в нее файлов"""
+        size, files = scan_session(self.root / session_id)
+        self._db.execute("UPDATE sessions SET bytes = ?, files = ? WHERE id = ?", (size, files, session_id))
+
+    def touch(self, session_id: str):
+        """Отмечает обращение к сессии (просмотр результатов продлевает ее жизнь)"""
+        now = time.time()
+        with self._touch_lock:
+            if now - self._touched.get(session_id, 0.0) < TOUCH_INTERVAL_SECONDS:
+                return
+            if len(self._touched) >= TOUCH_MEMORY:
+                self._touched.clear()
+            self._touched[session_id] = now
+        self._db.execute("UPDATE sessions SET last_access = ? WHERE id = ?", (now, session_id))
+
+    def release(self, session_id: str):
+        """Освобождает сессию после обработки и учитывает записанные файлы"""
+        self.refresh(session_id)
+        self._db.execute(
+            "UPDATE sessions SET active = MAX(0, active - 1), last_access = ? WHERE id = ?",
+            (time.time(), session_id)
+        )
+
+    def remove(self, session_id: str) -> bool:
+        """Удаляет сессию с диска и из учета"""
+        removed = self._db.execute("DELETE FROM sessions WHERE id = ?", (session_id,)) > 0
+        shutil.rmtree(self.root / session_id, ignore_errors=True)
+        return removed
+
+    def _idle_sessions(self) -> list:
+        """(id, объем, последнее обращение) свободных сессий от давно использованных к недавним"""
+        rows = self._db.query("SELECT id, bytes, last_access, active, pid FROM sessions ORDER BY last_access")
+        return [(session_id, size, last_access) for session_id, size, last_access, active, pid in rows
+                if not (active and pid_alive(pid))]
+
+    def clear(self) -> tuple:
+        """Удаляет все свободные сессии. Возвращает число удаленных и пропущенных занятых"""
+        idle = self._idle_sessions()
+        busy = self.stats()["sessions"] - len(idle)
+        removed = sum(self.remove(session_id) for session_id, _, _ in idle)
+        return removed, busy
+
+    def _pick_evictions(self, now: float) -> tuple:
+        """Сессии к удалению: сначала по TTL, затем по LRU до соблюдения квоты"""
+        idle = self._idle_sessions()
+        remaining = self.total_bytes()
+        expired = []
+        over_quota = []
+        for session_id, size, last_access in idle:
+            if self.ttl_seconds > 0 and now - last_access > self.ttl_seconds:
+                expired.append(session_id)
+                remaining -= size
+        if self.max_bytes > 0 and remaining > self.max_bytes:
+            expired_set = set(expired)
+            # Свободные сессии упорядочены по последнему обращению: в начале самые старые
+            for session_id, size, _ in idle:
+                if remaining <= self.max_bytes:
+                    break
+                if session_id in expired_set:
+                    continue
+                over_quota.append(session_id)
+                remaining -= size
+        return expired, over_quota
+
+    def evict(self) -> int:
+        """Один проход очистки. Возвращает число удаленных сессий"""
+        expired, over_quota = self._pick_evictions(time.time())
+        # Очистка может идти в нескольких воркерах сразу: учитываем только свои удаления
+        removed_ttl = sum(self.remove(session_id) for session_id in expired)
+        removed_quota = sum(self.remove(session_id) for session_id in over_quota)
+        if removed_ttl or removed_quota:
+            self._db.execute(
+                "UPDATE session_totals SET evicted_ttl = evicted_ttl + ?, evicted_quota = evicted_quota + ?",
+                (removed_ttl, removed_quota)
+            )
+            logger.info(f"🧹 Удалено сессий: {removed_ttl} по TTL, {removed_quota} по квоте, осталось {self.total_bytes()} байт")
+        return removed_ttl + removed_quota
+
+    def over_quota(self) -> bool:
+        return self.max_bytes > 0 and self.total_bytes() > self.max_bytes
+
+    async def run_janitor(self, interval: float):
+        """Фоновая очистка раз в interval секунд"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.evict)
+            except Exception as e:
+                logger.error(f"❌ Ошибка очистки временных файлов: {str(e)}")
+
+    def total_bytes(self) -> int:
+        return self._db.query("SELECT bytes FROM session_totals")[0][0]
+
+    def stats(self) -> dict:
+        sessions, files, total, evicted_ttl, evicted_quota = self._db.query(
+            "SELECT sessions, files, bytes, evicted_ttl, evicted_quota FROM session_totals"
+        )[0]
+        return {
+            "sessions": sessions,
+            "files": files,
+            "bytes": total,
+            "quota_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "evicted_ttl": evicted_ttl,
+            "evicted_quota": evicted_quota,
+        }
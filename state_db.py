@@ -0,0 +1,83 @@
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger('app')
+
+# Сколько ждать блокировку базы, которую держит другой процесс
+BUSY_TIMEOUT_SECONDS = 30.0
+
+
+def pid_alive(pid) -> bool:
+    """Жив ли процесс на этой машине (по нему определяется, занята ли сессия упавшего воркера)"""
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class StateDB:
+    """Общая для всех воркеров SQLite-база состояния (учет сессий tmp, задачи).
+
+    Воркеры prefork.py - отдельные процессы, поэтому учет в памяти одного из них
+    не видят остальные. Соединение открывается заново в каждом процессе (открытое
+    до fork не используется), внутри процесса оно одно и защищено блокировкой.
+    База лежит вне раздаваемой /tmp.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        self._inherited = []
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None or self._pid != os.getpid():
+            if self._connection is not None:
+                # Соединение родителя нельзя ни использовать, ни закрывать после fork:
+                # закрытие может снять блокировки и удалить WAL, которыми пользуется родитель
+                self._inherited.append(self._connection)
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None,
+                                         check_same_thread=False)
+            # WAL: читатели не ждут писателей, запись не блокирует /status других воркеров
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def executescript(self, script: str):
+        """Создание таблиц (схема каждого хранилища идемпотентна)"""
+        with self._lock:
+            self._connect().executescript(script)
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция с блокировкой на запись с самого начала: счетчики не расходятся при гонке воркеров"""
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def query(self, sql: str, params=()) -> list:
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def execute(self, sql: str, params=()) -> int:
+        """Одна команда в своей транзакции. Возвращает число измененных строк"""
+        with self._lock:
+            return self._connect().execute(sql, params).rowcount
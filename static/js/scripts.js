@@ -208,6 +208,7 @@ async function handleFormSubmit(e) {
   startBtn.textContent = 'Обработка...';
 
   const processingMessage = document.getElementById('processingMessage');
+  processingMessage.textContent = 'Модель делает предсказания, ожидайте...';
   processingMessage.style.display = 'block';
 
   const formData = new FormData();
@@ -221,17 +222,28 @@ async function handleFormSubmit(e) {
   const imgsz = document.getElementById('imgsz').value;
   const conf = document.getElementById('conf').value;
   const iou = document.getElementById('iou').value;
+  const tileSize = document.getElementById('tileSize').value || '0';
+  const tileOverlap = document.getElementById('tileOverlap').value || '0.2';
 
   formData.append('model_name', modelName);
   formData.append('imgsz', imgsz);
   formData.append('conf', conf);
   formData.append('iou', iou);
+  // Тайлы в исходном разрешении находят мелкие повреждения, но работают дольше
+  formData.append('tile_size', tileSize);
+  formData.append('tile_overlap', tileOverlap);
+  // Колоночный формат компактнее и быстрее собирается на сервере
+  formData.append('response_format', 'columnar');
+  // Маски приходят как int16 координаты в base64, упрощенные с допуском в полпикселя
+  formData.append('mask_encoding', 'int16');
+  formData.append('mask_tolerance', '0.5');
 
   console.log('⚙️ Параметры запроса:');
   console.log('  - model_name:', modelName);
   console.log('  - imgsz:', imgsz);
   console.log('  - conf:', conf);
   console.log('  - iou:', iou);
+  console.log('  - tile_size:', tileSize, 'tile_overlap:', tileOverlap);
 
   currentParams = {
     imgsz: imgsz,
@@ -240,36 +252,65 @@ async function handleFormSubmit(e) {
   };
 
   const requestStart = Date.now();
-  console.log('📡 Отправка запроса на /process...');
+  console.log('📡 Отправка запроса на /process/stream...');
 
   try {
-    const response = await fetch('/process', {
+    const response = await fetch('/process/stream', {
       method: 'POST',
       body: formData
     });
 
-    const requestTime = Date.now() - requestStart;
-    console.log(`📡 Ответ получен за ${requestTime}мс`);
     console.log('📊 Статус ответа:', response.status, response.statusText);
 
-    const data = await response.json();
-    console.log('📦 Данные ответа:', data);
-
     if (!response.ok) {
+      const data = await response.json();
       throw new Error(data.error || 'Ошибка обработки');
     }
 
-    console.log('✅ Обработка завершена успешно');
-    console.log('📊 Результаты по моделям:', Object.keys(data.results));
+    // Результаты приходят построчно (NDJSON) и отрисовываются по мере готовности
+    detectionData = {};
+    originalImages = {};
+    const results = {};
+    let firstResultLogged = false;
+    let streamError = null;
+
+    await readEventStream(response, event => {
+      if (event.type === 'session') {
+        originalImages = event.original_images || {};
+        event.models.forEach(modelName => {
+          results[modelName] = [];
+        });
+      } else if (event.type === 'result') {
+        const detections = columnarToDetections({ [event.file]: { [event.model]: event.detections } });
+        detectionData[event.file] = detectionData[event.file] || {};
+        detectionData[event.file][event.model] = detections[event.file][event.model];
+        results[event.model].push({
+          original_filename: event.file,
+          result_path: event.result_path,
+          render_path: event.render_path
+        });
+        if (!firstResultLogged) {
+          firstResultLogged = true;
+          console.log(`⚡ Первый результат через ${Date.now() - requestStart}мс`);
+        }
+        scheduleResultsUpdate(results);
+      } else if (event.type === 'progress') {
+        processingMessage.textContent = `Обработка... ${event.completed} из ${event.total}`;
+      } else if (event.type === 'error') {
+        console.error('❌ Ошибка в потоке:', event.model || '', event.error);
+        if (!event.model) {
+          streamError = event.error;
+        }
+      } else if (event.type === 'done') {
+        console.log(`✅ Обработка завершена за ${Date.now() - requestStart}мс`, event.model_timings);
+      }
+    });
 
-    // Сохраняем данные обнаружения
-    detectionData = data.detections || {};
-    console.log('🔍 Данные детекций:', detectionData);
-    
-    // Сохраняем оригинальные изображения для перерисовки
-    originalImages = data.original_images || {};
+    if (streamError) {
+      throw new Error(streamError);
+    }
 
-    updateResults(data.results);
+    updateResults(results);
     processingMessage.style.display = 'none';
     showNotification('Обработка завершена успешно!', 'success');
 
@@ -284,6 +325,81 @@ async function handleFormSubmit(e) {
   }
 }
 
+// Читает NDJSON поток и вызывает onEvent для каждой строки
+async function readEventStream(response, onEvent) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+    const lines = buffer.split('\n');
+    buffer = lines.pop();
+    lines.filter(line => line.trim()).forEach(line => onEvent(JSON.parse(line)));
+  }
+  if (buffer.trim()) {
+    onEvent(JSON.parse(buffer));
+  }
+}
+
+// Перерисовка таблицы результатов не чаще одного раза за кадр
+let resultsUpdateScheduled = false;
+function scheduleResultsUpdate(results) {
+  if (resultsUpdateScheduled) {
+    return;
+  }
+  resultsUpdateScheduled = true;
+  requestAnimationFrame(() => {
+    resultsUpdateScheduled = false;
+    updateResults(results);
+  });
+}
+
+// Декодирует полигон из base64 little-endian Int16Array в плоский массив [x1, y1, x2, y2, ...]
+function decodeInt16Polygon(encoded) {
+  const binary = atob(encoded);
+  const view = new DataView(new ArrayBuffer(binary.length));
+  for (let i = 0; i < binary.length; i++) {
+    view.setUint8(i, binary.charCodeAt(i));
+  }
+  const polygon = new Array(binary.length / 2);
+  for (let i = 0; i < polygon.length; i++) {
+    polygon[i] = view.getInt16(i * 2, true);
+  }
+  return polygon;
+}
+
+// Преобразует колоночный формат (параллельные массивы по модели) в список детекций
+function columnarToDetections(columnarData) {
+  const result = {};
+  Object.entries(columnarData).forEach(([filename, models]) => {
+    result[filename] = {};
+    Object.entries(models).forEach(([modelName, columns]) => {
+      const detections = [];
+      for (let i = 0; i < columns.count; i++) {
+        const detection = {
+          bbox: columns.bbox[i],
+          class_id: columns.class_id[i],
+          class_name: columns.class_name[i],
+          confidence: columns.confidence[i],
+          model_color: columns.model_color[i]
+        };
+        if (columns.mask_polygon && columns.mask_polygon[i]) {
+          detection.mask_polygon = columns.mask_polygon[i];
+        } else if (columns.mask_polygon_int16 && columns.mask_polygon_int16[i]) {
+          detection.mask_polygon = decodeInt16Polygon(columns.mask_polygon_int16[i]);
+        }
+        detections.push(detection);
+      }
+      result[filename][modelName] = detections;
+    });
+  });
+  return result;
+}
+
 // Показать уведомление
 function showNotification(message, type = 'error') {
   const notification = document.getElementById('notification');
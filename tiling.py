@@ -0,0 +1,147 @@
+import math
+
+import cv2
+import numpy as np
+
+from detections import concat_columns, offset_columns, scale_columns
+
+# Сторона холста, на котором объединяются маски склеиваемых детекций
+MERGE_MASK_MAX_SIDE = 1024
+
+
+def _tile_starts(size: int, tile: int, step: int) -> list:
+    """Начала тайлов вдоль одной оси; последний тайл прижат к краю изображения"""
+    if size <= tile:
+        return [0]
+    count = math.ceil((size - tile) / step) + 1
+    return sorted({min(i * step, size - tile) for i in range(count)})
+
+
+def tile_boxes(width: int, height: int, tile_size: int, overlap: float) -> list:
+    """Перекрывающиеся тайлы (x0, y0, x1, y1) одного размера, покрывающие все изображение"""
+    step = max(1, round(tile_size * (1 - overlap)))
+    tile_width, tile_height = min(tile_size, width), min(tile_size, height)
+    return [
+        (x, y, x + tile_width, y + tile_height)
+        for y in _tile_starts(height, tile_height, step)
+        for x in _tile_starts(width, tile_width, step)
+    ]
+
+
+class TiledImage:
+    """Изображение в исходном разрешении, разбитое на перекрывающиеся тайлы.
+
+    Тайлы (и, если full_frame, целый кадр для крупных объектов) прогоняются как
+    отдельные изображения, детекции переводятся в координаты копии для отображения
+    размера display_size - так же, как в обычном режиме.
+    """
+
+    __slots__ = ('image', 'display_size', 'tiles', 'full_frame')
+
+    def __init__(self, image: np.ndarray, display_size: tuple, tile_size: int, overlap: float, full_frame: bool = True):
+        height, width = image.shape[:2]
+        self.image = image
+        self.display_size = display_size
+        self.tiles = tile_boxes(width, height, tile_size, overlap)
+        # Изображение в один тайл и есть целый кадр
+        self.full_frame = full_frame and len(self.tiles) > 1
+
+    def sources(self) -> list:
+        """Изображения для модели: тайлы (срезы без копирования), затем целый кадр"""
+        crops = [self.image[y0:y1, x0:x1] for x0, y0, x1, y1 in self.tiles]
+        return crops + [self.image] if self.full_frame else crops
+
+    def offsets(self) -> list:
+        return [(x0, y0) for x0, y0, _, _ in self.tiles] + ([(0, 0)] if self.full_frame else [])
+
+
+def union_polygon(polygons: list, box) -> list:
+    """Объединение масок-полигонов: растеризация в общей рамке и внешний контур наибольшей области"""
+    polygons = [np.asarray(polygon, dtype=np.float64).reshape(-1, 2) for polygon in polygons
+                if polygon is not None and len(polygon) >= 6]
+    if not polygons:
+        return None
+    if len(polygons) == 1:
+        return polygons[0].ravel().tolist()
+    x0, y0, x1, y1 = box
+    scale = min(1.0, MERGE_MASK_MAX_SIDE / max(x1 - x0, y1 - y0, 1.0))
+    canvas = np.zeros((math.ceil((y1 - y0) * scale) + 1, math.ceil((x1 - x0) * scale) + 1), dtype=np.uint8)
+    origin = np.array([x0, y0], dtype=np.float64)
+    cv2.fillPoly(canvas, [np.round((polygon - origin) * scale).astype(np.int32) for polygon in polygons], 1)
+    contours, _ = cv2.findContours(canvas, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return polygons[0].ravel().tolist()
+    contour = max(contours, key=cv2.contourArea).reshape(-1, 2)
+    # Округление при растеризации не должно выводить контур за общую рамку
+    return np.clip(contour / scale + origin, origin, [x1, y1]).ravel().tolist()
+
+
+def _ios_matrix(boxes: np.ndarray) -> np.ndarray:
+    """Попарное отношение пересечения к меньшей из двух площадей"""
+    top_left = np.maximum(boxes[:, None, :2], boxes[None, :, :2])
+    bottom_right = np.minimum(boxes[:, None, 2:], boxes[None, :, 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area = np.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+    return inter / np.maximum(np.minimum(area[:, None], area[None, :]), 1e-9)
+
+
+def merge_detections(columns: dict, sources: np.ndarray, merge_ios: float) -> dict:
+    """Склеивает детекции одного объекта из разных тайлов (жадное объединение по уверенности).
+
+    Части объекта, разрезанного границей тайла, почти целиком лежат в его полной детекции,
+    поэтому пары сравниваются по IoS (пересечение к меньшей площади), а не по IoU.
+    Объединяются детекции одного класса из разных источников: рамки - охватывающей рамкой,
+    маски - объединением, уверенность - максимальная. Пары считаются внутри класса,
+    чтобы матрицы оставались маленькими при сотнях детекций на тайл.
+    """
+    if columns['count'] < 2:
+        return columns
+    boxes = np.asarray(columns['bbox'], dtype=np.float64)
+    class_ids = np.asarray(columns['class_id'])
+    confidence = np.asarray(columns['confidence'])
+    absorbed = np.zeros(columns['count'], dtype=bool)
+    groups = {}
+    for class_id in np.unique(class_ids):
+        indices = np.flatnonzero(class_ids == class_id)
+        if len(indices) < 2:
+            continue
+        class_sources = sources[indices]
+        candidates = (_ios_matrix(boxes[indices]) >= merge_ios) & (class_sources[:, None] != class_sources[None, :])
+        if not candidates.any():
+            continue
+        assigned = np.zeros(len(indices), dtype=bool)
+        for i in np.argsort(-confidence[indices], kind='stable'):
+            if assigned[i]:
+                continue
+            group = np.flatnonzero(candidates[i] & ~assigned)
+            assigned[i] = True
+            if len(group):
+                assigned[group] = True
+                absorbed[indices[group]] = True
+                groups[indices[i]] = np.concatenate([[indices[i]], indices[group]])
+    if not groups:
+        return columns
+
+    keep = np.flatnonzero(~absorbed)
+    merged = {key: [columns[key][i] for i in keep] for key in columns if key not in ('count', 'image_size')}
+    for position, i in enumerate(keep):
+        members = groups.get(i)
+        if members is None:
+            continue
+        box = [*boxes[members, :2].min(axis=0).tolist(), *boxes[members, 2:].max(axis=0).tolist()]
+        merged['bbox'][position] = box
+        merged['confidence'][position] = float(confidence[members].max())
+        merged['mask_polygon'][position] = union_polygon([columns['mask_polygon'][j] for j in members], box)
+    return {'count': len(keep), 'image_size': columns['image_size'], **merged}
+
+
+def merge_tile_columns(tiled: TiledImage, columns_list: list, merge_ios: float) -> dict:
+    """Детекции всех тайлов одного изображения в координатах копии для отображения"""
+    height, width = tiled.image.shape[:2]
+    parts = [
+        offset_columns(columns, x0, y0, width, height)
+        for columns, (x0, y0) in zip(columns_list, tiled.offsets())
+    ]
+    sources = np.concatenate([np.full(part['count'], index) for index, part in enumerate(parts)])
+    merged = merge_detections(concat_columns(parts), sources, merge_ios)
+    return scale_columns(merged, *tiled.display_size)
@@ -0,0 +1,111 @@
+import logging
+import re
+import unicodedata
+from pathlib import Path
+
+import aiofiles
+
+from result_cache import content_hasher
+
+logger = logging.getLogger('app')
+
+# Размер части при копировании загрузки на диск
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_FILENAME_LENGTH = 100
+
+# Все, кроме букв, цифр, точки, дефиса и подчеркивания, заменяется на "_"
+UNSAFE_FILENAME_CHARS = re.compile(r'[^\w.\-]+')
+
+
+class UploadTooLarge(Exception):
+    """Файл или запрос целиком превышает допустимый размер (ответ 413)"""
+
+
+def sanitize_filename(name: str, fallback: str) -> str:
+    """Безопасное имя файла для сессии: без путей, управляющих символов и ведущих точек"""
+    name = unicodedata.normalize('NFKC', name or '').replace('\\', '/').rsplit('/', 1)[-1]
+    name = UNSAFE_FILENAME_CHARS.sub('_', name).lstrip('._')
+    if not name:
+        return fallback
+    stem, dot, suffix = name.rpartition('.')
+    if not dot:
+        stem, suffix = name, ''
+    suffix = suffix[:10]
+    stem = stem[:MAX_FILENAME_LENGTH - len(suffix) - 1] or fallback
+    return f"{stem}.{suffix}" if suffix else stem
+
+
+def unique_filenames(names: list) -> list:
+    """Добавляет к повторяющимся именам суффикс _1, _2, ... (без учета регистра)"""
+    used = set()
+    result = []
+    for name in names:
+        stem, dot, suffix = name.rpartition('.')
+        if not dot:
+            stem, suffix = name, ''
+        candidate = name
+        counter = 1
+        while candidate.lower() in used:
+            candidate = f"{stem}_{counter}.{suffix}" if suffix else f"{stem}_{counter}"
+            counter += 1
+        used.add(candidate.lower())
+        result.append(candidate)
+    return result
+
+
+async def save_upload(file, path: Path, max_bytes: int) -> tuple:
+    """Копирует загрузку на диск частями, считая хэш содержимого по ходу.
+
+    В памяти одновременно находится не больше одной части. При превышении
+    max_bytes частично записанный файл удаляется и поднимается UploadTooLarge.
+    Возвращает размер и хэш (совпадает с hash_contents).
+    """
+    hasher = content_hasher()
+    size = 0
+    try:
+        async with aiofiles.open(path, 'wb') as out:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"Файл {path.name} больше допустимых {max_bytes} байт")
+                hasher.update(chunk)
+                await out.write(chunk)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return size, hasher.hexdigest()
+
+
+async def save_uploads(files: list, session_dir: Path, max_file_bytes: int, max_request_bytes: int) -> tuple:
+    """Сохраняет файлы запроса в сессию под очищенными уникальными именами.
+
+    Лимиты проверяются до копирования по известному размеру и по ходу копирования.
+    Возвращает имена файлов и хэши содержимого.
+    """
+    filenames = unique_filenames([
+        sanitize_filename(file.filename, f"image_{i + 1}") for i, file in enumerate(files)
+    ])
+    known_sizes = [getattr(file, 'size', None) for file in files]
+    for file, size in zip(files, known_sizes):
+        if size is not None and size > max_file_bytes:
+            raise UploadTooLarge(f"Файл {file.filename} больше допустимых {max_file_bytes} байт")
+    if sum(size or 0 for size in known_sizes) > max_request_bytes:
+        raise UploadTooLarge(f"Запрос больше допустимых {max_request_bytes} байт")
+
+    content_hashes = []
+    total = 0
+    for i, (file, filename) in enumerate(zip(files, filenames)):
+        limit = min(max_file_bytes, max_request_bytes - total)
+        try:
+            size, content_hash = await save_upload(file, session_dir / filename, limit)
+        except UploadTooLarge:
+            if limit < max_file_bytes:
+                raise UploadTooLarge(f"Запрос больше допустимых {max_request_bytes} байт")
+            raise
+        total += size
+        content_hashes.append(content_hash)
+        logger.debug(f"📄 [{i+1}/{len(files)}] {file.filename} -> {filename}: {size} байт")
+    return filenames, content_hashes